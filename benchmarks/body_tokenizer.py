@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Checks that request bodies are tokenized as they were before bodies were
+sniffed and large JSON bodies were walked incrementally, and measures how
+much faster (and smaller) tokenizing them is now.
+
+The regression corpus is made of request bodies from crawl logs (--input,
+or a synthetic crawl if none are given), plus generated JSON documents
+(nested objects and arrays, duplicate keys, every kind of scalar, odd
+whitespace) and random mutations of them, most of which aren't valid JSON.
+Every body is tokenized both by decoding it in full and by walking it
+incrementally. Exits with an error if any result differs from the original
+tokenizer's.
+
+Timings are reported for the crawl's bodies, and for a single large
+analytics beacon (--beacon-events events), along with the peak memory used
+to tokenize the beacon.
+"""
+import argparse
+import json
+import pathlib
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.tokenizing  # noqa: E402
+from privacykpis.types import KeyValueList  # noqa: E402
+
+
+def original_kvs(body: str) -> Optional[KeyValueList]:
+    """kvs_from_json_str, as it was before bodies were sniffed."""
+    try:
+        json_data = json.loads(body)
+    except (json.JSONDecodeError, RecursionError):
+        return None
+    if json_data is None:
+        return None
+    if type(json_data) is list:
+        if len(json_data) == 0 or type(json_data[0]) is not dict:
+            return []
+        json_data = json_data[0]
+    try:
+        if len(json_data.keys()) == 0:
+            return None
+    except AttributeError:
+        return None
+    kvs = []
+    for key, value in json_data.items():
+        longest_child = privacykpis.tokenizing.longest_value_in_json(value)
+        if longest_child is not None:
+            kvs.append((key, longest_child))
+    return kvs
+
+
+def incremental_kvs(body: str) -> Optional[KeyValueList]:
+    """kvs_from_json_str, with every body walked incrementally."""
+    large_size = privacykpis.tokenizing.LARGE_JSON_BODY_SIZE
+    privacykpis.tokenizing.LARGE_JSON_BODY_SIZE = -1
+    try:
+        return privacykpis.tokenizing.kvs_from_json_str(body)
+    finally:
+        privacykpis.tokenizing.LARGE_JSON_BODY_SIZE = large_size
+
+
+def crawl_bodies(paths: List[pathlib.Path]) -> List[str]:
+    bodies = []
+    for path in paths:
+        with path.open() as handle:
+            for line in handle:
+                if line.strip():
+                    bodies += [request["body"]
+                               for request in json.loads(line)["requests"]]
+    return bodies
+
+
+def generated_bodies(rand: random.Random, count: int) -> List[str]:
+    keys = ["id", "uid", "ts", "a", "b", "", "é", "k\"ey"]
+
+    def scalar() -> Any:
+        return rand.choice([
+            None, True, False, 0, -1, rand.randrange(10 ** 25),
+            rand.random() * 10 ** rand.randrange(-5, 30), "",
+            "".join(rand.choices(string.ascii_letters + "é\n\"\\",
+                                 k=rand.randrange(30)))])
+
+    def value(depth: int) -> Any:
+        kind = rand.random()
+        if depth > 4 or kind < 0.5:
+            return scalar()
+        if kind < 0.75:
+            return [value(depth + 1) for _ in range(rand.randrange(5))]
+        return {rand.choice(keys): value(depth + 1)
+                for _ in range(rand.randrange(5))}
+
+    def encode(data: Any) -> str:
+        # Written out by hand, to add whitespace and duplicate keys.
+        space = rand.choice(["", " ", "\n\t", "\r\n "])
+        if isinstance(data, list):
+            return "[" + space + ("," + space).join(
+                encode(item) for item in data) + space + "]"
+        if isinstance(data, dict):
+            members = [json.dumps(key) + space + ":" + encode(item)
+                       for key, item in data.items()]
+            if members and rand.random() < 0.2:
+                members.append(members[0].split(":")[0] + ":" +
+                               encode(scalar()))
+            return "{" + space + ("," + space).join(members) + "}"
+        return json.dumps(data)
+
+    def mutate(body: str) -> str:
+        position = rand.randrange(len(body) + 1)
+        if rand.random() < 0.5:
+            return body[:position] + body[position + 1:]
+        return (body[:position] + rand.choice("{}[],:\" 0ae\x00") +
+                body[position:])
+
+    bodies = []
+    for _ in range(count):
+        top = rand.choice([dict, dict, list])
+        data: Any = (top() if rand.random() < 0.05 else
+                     {rand.choice(keys): value(1) for _ in range(5)}
+                     if top is dict else
+                     [value(1) for _ in range(rand.randrange(4))])
+        body = rand.choice(["", " ", "\n"]) + encode(data)
+        while rand.random() < 0.3:
+            body = mutate(body)
+        bodies.append(body)
+    bodies += ["[" * 100 + "]" * 100, "[" * 100000 + "]" * 100000, "{}",
+               "[]", "[{}]", "[{}, 1]", "[1, {\"a\": \"b\"}]",
+               "\ufeff{\"a\": \"b\"}", "NaN", "{\"a\": NaN, \"b\": -Infinity}",
+               "{\"a\": 1}x", "[1]  ]"]
+    return bodies
+
+
+def beacon(num_events: int) -> str:
+    events = [{"event": "scroll", "ts": 1600000000000 + event,
+               "props": {"depth": event % 100, "ids": [event, str(event)]}}
+              for event in range(num_events)]
+    return json.dumps({"session": "f3a1c2d4e5b6a7980112", "events": events})
+
+
+def check(bodies: List[str]) -> Dict[str, Any]:
+    mismatches = []
+    for body in bodies:
+        expected = original_kvs(body)
+        if (privacykpis.tokenizing.kvs_from_json_str(body) != expected or
+                incremental_kvs(body) != expected):
+            mismatches.append(body)
+    return {"bodies": len(bodies), "mismatches": mismatches}
+
+
+def timing(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def peak_memory_kb(func: Callable[[], Any]) -> float:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check and benchmark request body tokenization.")
+    PARSER.add_argument("--input", nargs="+", type=pathlib.Path,
+                        help="Crawl logs to take request bodies from. If "
+                             "not provided, a synthetic crawl is generated.")
+    PARSER.add_argument("--generated", type=int, default=20000,
+                        help="Number of JSON documents to generate.")
+    PARSER.add_argument("--beacon-events", type=int, default=5000,
+                        help="Number of events in the large beacon.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.input:
+        BODIES = crawl_bodies(ARGS.input)
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            CrawlGenerator(ARGS).write(pathlib.Path(WORK_DIR))
+            BODIES = crawl_bodies(list(pathlib.Path(WORK_DIR).iterdir()))
+    GENERATED = generated_bodies(random.Random(ARGS.seed), ARGS.generated)
+    BEACON = beacon(ARGS.beacon_events)
+
+    REPORT = {
+        "crawl": check(BODIES),
+        "generated": check(GENERATED),
+        "beacon": check([BEACON]),
+        "beacon_chars": len(BEACON),
+        "crawl_seconds": {
+            "original": timing(
+                lambda: [original_kvs(body) for body in BODIES]),
+            "sniffed": timing(
+                lambda: [privacykpis.tokenizing.kvs_from_json_str(body)
+                         for body in BODIES]),
+        },
+        "beacon_seconds": {
+            "original": timing(lambda: original_kvs(BEACON)),
+            "incremental": timing(lambda: incremental_kvs(BEACON)),
+        },
+        "beacon_peak_memory_kb": {
+            "original": peak_memory_kb(lambda: original_kvs(BEACON)),
+            "incremental": peak_memory_kb(lambda: incremental_kvs(BEACON)),
+        },
+    }
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if any(REPORT[name]["mismatches"]  # type: ignore
+           for name in ("crawl", "generated", "beacon")):
+        sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Checks TrackingInstances.difference and overlap against the original,
+token by token implementations, and compares their speed.
+
+The two collections compared are either read from measurement files written
+by serialize.py (--input and --control), or generated, with --third-parties
+third parties, --tokens tokens each, and --shared of the tokens also sent in
+the control collection. The collections have separate string tables, as
+they do when extract.py compares two artifacts. Exits with an error if any
+result differs from the original implementation's.
+"""
+import argparse
+import io
+import json
+import pathlib
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.serialize  # noqa: E402
+from privacykpis.serialize import TrackingInstances  # noqa: E402
+
+
+class OriginalEngine:
+    """difference() and overlap(), as they were before the set based
+    engine, along with the lookups they used."""
+    @staticmethod
+    def local_token(instances: TrackingInstances, strings: Any,
+                    token: Any) -> Any:
+        if strings is instances.strings:
+            return token
+        loc, key, value = token
+        local_key = instances.strings.id(strings.string(key))
+        local_value = instances.strings.id(strings.string(value))
+        if local_key is None or local_value is None:
+            return None
+        return (loc, local_key, local_value)
+
+    @staticmethod
+    def has_third_party(instances: TrackingInstances, origin: int) -> bool:
+        try:
+            instances.token_collection[origin]
+            return True
+        except KeyError:
+            return False
+
+    @staticmethod
+    def has_token(instances: TrackingInstances, origin: int,
+                  token: Any) -> bool:
+        try:
+            instances.token_collection[origin][token]
+            return True
+        except KeyError:
+            return False
+
+    @staticmethod
+    def add_ids_for_token(instances: TrackingInstances, origin: int,
+                          token: Any, identifications: Any) -> None:
+        if origin not in instances.token_collection:
+            instances.token_collection[origin] = {}
+        if token not in instances.token_collection[origin]:
+            instances.token_collection[origin][token] = identifications
+        else:
+            instances.token_collection[origin][token] = {
+                **instances.token_collection[origin][token],
+                **identifications}
+
+    @classmethod
+    def compare(cls, first: TrackingInstances, second: TrackingInstances,
+                overlap: bool) -> TrackingInstances:
+        result = TrackingInstances(first.strings)
+        for three_p, tokens_for_three_p in first.token_collection.items():
+            second_three_p = second.strings.id(
+                first.strings.string(three_p))
+            if (second_three_p is None or
+                    not cls.has_third_party(second, second_three_p)):
+                if not overlap:
+                    result.token_collection[three_p] = tokens_for_three_p
+                continue
+            for token, first_ps in tokens_for_three_p.items():
+                second_token = cls.local_token(second, first.strings, token)
+                seen = (second_token is not None and
+                        cls.has_token(second, second_three_p, second_token))
+                if seen == overlap:
+                    cls.add_ids_for_token(result, three_p, token, first_ps)
+        return result
+
+
+def generated(rand: random.Random, args: argparse.Namespace
+              ) -> Tuple[TrackingInstances, TrackingInstances]:
+    first, second = TrackingInstances(), TrackingInstances()
+    sites = [f"site{site}.com" for site in range(args.sites)]
+    for three_p in range(args.third_parties):
+        domain = f"tracker{three_p}.net"
+        for token in range(args.tokens):
+            value = f"{rand.getrandbits(64):x}"
+            token_strs = (rand.randrange(1, 5), f"k{token % 20}", value)
+            shared = rand.random() < args.shared
+            for instances in (first, second) if shared else (first,):
+                strings = instances.strings
+                interned = (token_strs[0], strings.intern(token_strs[1]),
+                            strings.intern(token_strs[2]))
+                for site in rand.sample(sites, rand.randrange(1, 4)):
+                    instances.add_request(strings.intern(site),
+                                          strings.intern(domain), [interned],
+                                          (f"https://{domain}/", 0))
+    return first, second
+
+
+def tracking_instances(path: str) -> TrackingInstances:
+    return privacykpis.serialize.load(path).get_tracking_instances()
+
+
+def as_json(instances: TrackingInstances) -> str:
+    handle = io.StringIO()
+    instances.to_json(handle)
+    return handle.getvalue()
+
+
+def timing(func: Callable[[], Any], repeat: int = 3) -> float:
+    """Returns the fastest of several runs of func."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check and benchmark difference and overlap.")
+    PARSER.add_argument("--input",
+                        help="Measurement file to compare. If not "
+                             "provided, collections are generated.")
+    PARSER.add_argument("--control",
+                        help="Measurement file to compare --input with.")
+    PARSER.add_argument("--third-parties", type=int, default=2000,
+                        help="Number of third parties to generate.")
+    PARSER.add_argument("--tokens", type=int, default=200,
+                        help="Number of tokens per generated third party.")
+    PARSER.add_argument("--sites", type=int, default=1000,
+                        help="Number of generated first parties.")
+    PARSER.add_argument("--shared", type=float, default=0.5,
+                        help="Fraction of tokens also in the control.")
+    PARSER.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random generator.")
+    ARGS = PARSER.parse_args()
+
+    if ARGS.input and ARGS.control:
+        FIRST = tracking_instances(ARGS.input)
+        SECOND = tracking_instances(ARGS.control)
+    else:
+        FIRST, SECOND = generated(random.Random(ARGS.seed), ARGS)
+
+    REPORT: Dict[str, Any] = {
+        "tokens": sum(len(tokens)
+                      for tokens in FIRST.token_collection.values()),
+        "control_tokens": sum(len(tokens)
+                              for tokens in SECOND.token_collection.values()),
+        "mismatches": [],
+        "seconds": {},
+    }
+    for NAME, OVERLAP, COMPARE in [
+            ("difference", False, TrackingInstances.difference),
+            ("overlap", True, TrackingInstances.overlap)]:
+        if (as_json(COMPARE(FIRST, SECOND)) !=
+                as_json(OriginalEngine.compare(FIRST, SECOND, OVERLAP))):
+            REPORT["mismatches"].append(NAME)
+        REPORT["seconds"][NAME] = {
+            "original": timing(lambda: OriginalEngine.compare(
+                FIRST, SECOND, OVERLAP)),
+            "sets": timing(lambda: COMPARE(FIRST, SECOND)),
+        }
+    REPORT["reidentified_sites"] = FIRST.reidentified_sites()
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["mismatches"]:
+        sys.exit(1)
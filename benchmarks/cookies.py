@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Checks the tolerant Cookie header splitter in privacykpis.tokenizing, and
+compares its speed with parsing every header with http.cookies.SimpleCookie.
+
+Checks that:
+
+- generated well-formed headers split into the same pairs SimpleCookie
+  finds in them, and
+- generated headers with malformed pairs mixed in (which SimpleCookie drops
+  whole, or stops reading at) keep every well-formed pair.
+
+Timings are for the Cookie headers of every request in the crawl logs
+(--input, or a synthetic crawl if none are given), in order, with the
+header cache starting out empty. Exits with an error if any check fails.
+"""
+import argparse
+import http.cookies
+import json
+import pathlib
+import random
+import string
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.tokenizing  # noqa: E402
+
+# Pairs SimpleCookie rejects, or can't read past.
+MALFORMED_PAIRS = ["bad cookie", "$Version=1", "path=/", "Secure", "a,b=c",
+                   "=x", "é=1", '"unterminated=1', "novalue"]
+
+
+def simple_cookie_kvs(header: str) -> List[Tuple[str, str]]:
+    """kvs_from_cookies, as it was before the tolerant splitter."""
+    try:
+        cookies: Any = http.cookies.SimpleCookie(header)
+        return [(k, v.value) for k, v in cookies.items()]
+    except http.cookies.CookieError:
+        return []
+
+
+def cookie_headers(paths: List[pathlib.Path]) -> List[str]:
+    headers = []
+    for path in paths:
+        with path.open() as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                for request in json.loads(line)["requests"]:
+                    headers += [value for name, value in request["headers"]
+                                if name.lower() == "cookie"]
+    return headers
+
+
+def generated_headers(rand: random.Random, count: int
+                      ) -> List[Tuple[str, Dict[str, str], bool]]:
+    """Returns headers, the pairs in them, and whether they're malformed."""
+    keys = ["_ga", "_uid", "sid", "a", "A-b.c", "x:y", "~!"]
+    alphabet = string.ascii_letters + string.digits + "-_.:/+=%!"
+
+    def value() -> Tuple[str, str]:
+        raw = "".join(rand.choices(alphabet, k=rand.randrange(30)))
+        if rand.random() < 0.2:
+            quoted = raw.replace("/", " ") + rand.choice(["", "\\054"])
+            return (f'"{quoted}"',
+                    quoted.replace("\\054", ","))
+        return raw, raw
+
+    headers = []
+    for _ in range(count):
+        pairs: Dict[str, str] = {}
+        parts = []
+        malformed = rand.random() < 0.5
+        for _ in range(rand.randrange(1, 8)):
+            if malformed and rand.random() < 0.3:
+                parts.append(rand.choice(MALFORMED_PAIRS))
+                continue
+            key = rand.choice(keys)
+            encoded, decoded = value()
+            parts.append(f"{key}={encoded}")
+            pairs[key] = decoded
+        headers.append((rand.choice(["; ", ";", " ; "]).join(parts), pairs,
+                        malformed))
+    return headers
+
+
+def check(headers: List[Tuple[str, Dict[str, str], bool]]) -> Dict[str, Any]:
+    mismatches = []
+    for header, pairs, malformed in headers:
+        kvs = privacykpis.tokenizing.kvs_from_cookies(header)
+        expected = (list(pairs.items()) if malformed
+                    else simple_cookie_kvs(header))
+        if kvs != expected:
+            mismatches.append(header)
+    return {"headers": len(headers), "mismatches": mismatches}
+
+
+def timing(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check and benchmark Cookie header splitting.")
+    PARSER.add_argument("--input", nargs="+", type=pathlib.Path,
+                        help="Crawl logs to take Cookie headers from. If not "
+                             "provided, a synthetic crawl is generated.")
+    PARSER.add_argument("--generated", type=int, default=50000,
+                        help="Number of headers to generate.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.input:
+        HEADERS = cookie_headers(ARGS.input)
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            CrawlGenerator(ARGS).write(pathlib.Path(WORK_DIR))
+            HEADERS = cookie_headers(list(pathlib.Path(WORK_DIR).iterdir()))
+
+    REPORT: Dict[str, Any] = {
+        "generated": check(generated_headers(random.Random(ARGS.seed),
+                                             ARGS.generated)),
+    }
+    privacykpis.tokenizing.COOKIES.entries.clear()
+    COOKIES_BEFORE = privacykpis.tokenizing.COOKIES.stats()
+    REPORT["crawl"] = {
+        "headers": len(HEADERS),
+        "distinct_headers": len(set(HEADERS)),
+        "simple_cookie_seconds": timing(
+            lambda: [simple_cookie_kvs(header) for header in HEADERS]),
+        "tolerant_seconds": timing(
+            lambda: [privacykpis.tokenizing.kvs_from_cookies(header)
+                     for header in HEADERS]),
+        "headers_simple_cookie_dropped": sum(
+            1 for header in HEADERS if not simple_cookie_kvs(header)),
+        "headers_now_tokenized": sum(
+            1 for header in HEADERS if not simple_cookie_kvs(header) and
+            privacykpis.tokenizing.kvs_from_cookies(header)),
+    }
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["generated"]["mismatches"]:
+        sys.exit(1)
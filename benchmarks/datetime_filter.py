@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Checks that filters.classify_datetime agrees with dateutil, and measures
+how much faster is_datetime is with it.
+
+The regression corpus is made of token values from crawl logs (--input, or a
+synthetic crawl if none are given), plus generated strings aimed at the
+edges of the classifier: identifiers, ISO, RFC and all-digit dates (valid
+and not), dateutil's own vocabulary mixed with digits and separators, and
+random mutations of all of these. Exits with an error if any verdict differs.
+"""
+import argparse
+import calendar
+import json
+import pathlib
+import random
+import string
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List
+
+import dateutil.parser
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.filters  # noqa: E402
+import privacykpis.tokenizing  # noqa: E402
+
+
+def dateutil_verdict(token: str) -> bool:
+    """is_datetime, as it was before classify_datetime was added."""
+    if len(token) < 10:
+        return False
+    try:
+        dateutil.parser.parse(token, ignoretz=True)
+        return True
+    except (dateutil.parser.ParserError, OverflowError,  # type: ignore
+            calendar.IllegalMonthError, TypeError):
+        return False
+
+
+def crawl_tokens(paths: Iterable[pathlib.Path]) -> List[str]:
+    tokens = []
+    for path in paths:
+        with path.open() as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                for request in json.loads(line)["requests"]:
+                    result = privacykpis.tokenizing.from_record(request)
+                    for kvs in (result.cookies, result.path, result.query,
+                                result.body):
+                        tokens += [value for _, value in kvs or []]
+    return tokens
+
+
+def generated_tokens(rand: random.Random, count: int) -> List[str]:
+    words = sorted(privacykpis.filters.DATEUTIL_WORDS)
+    words += ["GMT", "UTC", "EST", "BRST", "PDT", "Z", "T", "CEST", "Jun",
+              "JUNE", "Central", "Time", "x", "e", "of"]
+    separators = [" ", "-", "/", ":", ".", ",", "+", "T", "_", "(", ")", ""]
+
+    def number() -> str:
+        return str(rand.randrange(10 ** rand.randrange(1, 9))).zfill(
+            rand.choice((1, 2, 4)))
+
+    def iso() -> str:
+        value = (f"{rand.randrange(2100):04}-{rand.randrange(14):02}-"
+                 f"{rand.randrange(33):02}")
+        if rand.random() < 0.7:
+            value += (f"{rand.choice('T ')}{rand.randrange(26):02}:"
+                      f"{rand.randrange(62):02}")
+            if rand.random() < 0.7:
+                value += f":{rand.randrange(62):02}"
+                if rand.random() < 0.5:
+                    value += "." + str(rand.randrange(10 ** 7))
+            value += rand.choice(["", "Z", "+02:00", "-0530", "+25:00"])
+        return value
+
+    def rfc() -> str:
+        weekday = rand.choice(["", "Mon, ", "Sun, ", "Fri, "])
+        month = rand.choice(list(calendar.month_abbr)[1:] + ["Foo"])
+        zone = rand.choice(["GMT", "UTC", "+0000", "-0800", "+2500"])
+        return (f"{weekday}{rand.randrange(33):02} {month} "
+                f"{rand.randrange(1900, 2100)} {rand.randrange(25):02}:"
+                f"{rand.randrange(61):02}:{rand.randrange(61):02} {zone}")
+
+    def identifier() -> str:
+        alphabet = rand.choice([
+            string.hexdigits.lower(), string.hexdigits.upper(),
+            string.ascii_letters + string.digits + "+/=-_",
+            string.digits, string.ascii_uppercase + string.digits])
+        if rand.random() < 0.1:
+            return str(uuid.UUID(int=rand.getrandbits(128)))
+        return "".join(rand.choices(alphabet, k=rand.randrange(10, 40)))
+
+    def compact() -> str:
+        value = (f"{rand.randrange(10000):04}{rand.randrange(14):02}"
+                 f"{rand.randrange(33):02}{rand.randrange(26):02}"
+                 f"{rand.randrange(62):02}")
+        if rand.random() < 0.5:
+            value += f"{rand.randrange(62):02}"
+        return value
+
+    def vocabulary() -> str:
+        parts = []
+        for _ in range(rand.randrange(2, 8)):
+            parts.append(rand.choice(words) if rand.random() < 0.5
+                         else number())
+            parts.append(rand.choice(separators))
+        return "".join(parts)
+
+    def mutate(value: str) -> str:
+        position = rand.randrange(len(value) + 1)
+        char = rand.choice(string.printable + "\x00é²")
+        return value[:position] + char + value[position:]
+
+    makers: List[Callable[[], str]] = [iso, rfc, compact, identifier,
+                                       vocabulary]
+    tokens = []
+    for _ in range(count):
+        token = rand.choice(makers)()
+        while rand.random() < 0.3:
+            token = mutate(token)
+        tokens.append(token)
+    return tokens
+
+
+def check(tokens: List[str]) -> Dict[str, Any]:
+    mismatches = []
+    classified = 0
+    for token in tokens:
+        verdict = privacykpis.filters.classify_datetime(token)
+        if verdict is None:
+            continue
+        classified += 1
+        if len(token) >= 10 and verdict != dateutil_verdict(token):
+            mismatches.append(token)
+    return {"tokens": len(tokens), "classified": classified,
+            "mismatches": mismatches}
+
+
+def timing(tokens: List[str], func: Callable[[str], bool]) -> float:
+    start = time.perf_counter()
+    for token in tokens:
+        func(token)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check and benchmark the datetime pre-classifier.")
+    PARSER.add_argument("--input", nargs="+", type=pathlib.Path,
+                        help="Crawl logs to take token values from. If not "
+                             "provided, a synthetic crawl is generated.")
+    PARSER.add_argument("--generated", type=int, default=50000,
+                        help="Number of edge case strings to generate.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.input:
+        CRAWL_TOKENS = crawl_tokens(ARGS.input)
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            CrawlGenerator(ARGS).write(pathlib.Path(WORK_DIR))
+            CRAWL_TOKENS = crawl_tokens(pathlib.Path(WORK_DIR).iterdir())
+    GENERATED_TOKENS = generated_tokens(random.Random(ARGS.seed),
+                                        ARGS.generated)
+
+    REPORT = {
+        "crawl": check(CRAWL_TOKENS),
+        "generated": check(GENERATED_TOKENS),
+        "crawl_seconds": {
+            "dateutil": timing(CRAWL_TOKENS, dateutil_verdict),
+            "classified": timing(CRAWL_TOKENS,
+                                 privacykpis.filters.is_datetime),
+        },
+    }
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["crawl"]["mismatches"] or REPORT["generated"]["mismatches"]:
+        sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Compares the JSON codecs privacykpis.codec can use, on crawl logs.
+
+For each installed codec, times decoding every line of the logs (from bytes,
+as serialize.py does), decoding every request body (as
+tokenizing.kvs_from_json_str does), and encoding every record again (as
+log_headers.py does), and checks that every codec decodes to the same values
+as the standard library. Reports the results as JSON.
+
+Pass real crawl logs with --input; otherwise a synthetic crawl is generated.
+"""
+import argparse
+import gc
+import json
+import pathlib
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from privacykpis.codec import Codec, available_codecs  # noqa: E402
+from privacykpis.codec import get_codec  # noqa: E402
+
+
+def _best_of(repeat: int, func: Callable[[], Any]) -> float:
+    # As timeit does, keep garbage collection from skewing timings.
+    timings = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return min(timings)
+
+
+def _decode_bodies(codec: Codec, bodies: List[str]) -> List[Any]:
+    values = []
+    for body in bodies:
+        try:
+            values.append(codec.loads(body))
+        except json.JSONDecodeError:
+            values.append(None)
+    return values
+
+
+def benchmark(lines: List[bytes], repeat: int) -> Dict[str, Any]:
+    records = [json.loads(line) for line in lines]
+    bodies = [request["body"] for record in records
+              for request in record["requests"]]
+    expected_bodies = _decode_bodies(get_codec("json"), bodies)
+    num_bytes = sum(len(line) for line in lines)
+
+    results: Dict[str, Any] = {}
+    for name in available_codecs():
+        codec = get_codec(name)
+        decoded = [codec.loads(line, exact_integers=False)
+                   for line in lines]
+        decoded_bodies = _decode_bodies(codec, bodies)
+        decode_seconds = _best_of(
+            repeat, lambda: [codec.loads(line, exact_integers=False)
+                             for line in lines])
+        body_seconds = _best_of(
+            repeat, lambda: _decode_bodies(codec, bodies))
+        encode_seconds = _best_of(
+            repeat, lambda: [codec.dumps(record) for record in records])
+        results[name] = {
+            "matches_stdlib": (decoded == records and
+                               decoded_bodies == expected_bodies),
+            "decode_lines_seconds": decode_seconds,
+            "decode_lines_mb_per_second": (num_bytes / decode_seconds / 1e6
+                                           if decode_seconds else None),
+            "decode_bodies_seconds": body_seconds,
+            "encode_records_seconds": encode_seconds,
+        }
+
+    stdlib = results["json"]
+    for result in results.values():
+        for measure in ("decode_lines", "decode_bodies", "encode_records"):
+            seconds = result[f"{measure}_seconds"]
+            result[f"{measure}_speedup"] = (
+                stdlib[f"{measure}_seconds"] / seconds if seconds else None)
+    return {
+        "lines": len(lines),
+        "bodies": len(bodies),
+        "bytes": num_bytes,
+        "codecs": results,
+    }
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark the JSON codecs used for crawl logs.")
+    PARSER.add_argument("--input", nargs="+",
+                        help="Crawl logs (one JSON document per line) to "
+                             "benchmark on. If not provided, a synthetic "
+                             "crawl is generated.")
+    PARSER.add_argument("--repeat", type=int, default=5,
+                        help="Number of times to time each measure; the "
+                             "fastest time is reported.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    LINES: List[bytes] = []
+    if ARGS.input:
+        for INPUT_PATH in ARGS.input:
+            with open(INPUT_PATH, "rb") as HANDLE:
+                LINES += [LINE for LINE in HANDLE if LINE.strip()]
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            CrawlGenerator(ARGS).write(pathlib.Path(WORK_DIR))
+            for LOG_PATH in sorted(pathlib.Path(WORK_DIR).iterdir()):
+                LINES += LOG_PATH.read_bytes().splitlines()
+
+    json.dump(benchmark(LINES, ARGS.repeat), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Checks that serialize.py --jobs only extracts the --locations asked for,
+however its worker processes are started.
+
+Serializes a synthetic crawl (see synthetic_crawl.py) in a single process,
+and with --jobs processes started by each multiprocessing start method, and
+reports the locations each result records, the locations its tokens were
+found in, and the time taken, as JSON. Exits with an error if any result
+records, or holds tokens from, locations other than those asked for, or
+holds different tokens than the single process result.
+"""
+import argparse
+import json
+import multiprocessing
+import pathlib
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Set
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from privacykpis.types import TokenLocation  # noqa: E402
+
+
+CODE_PATH = pathlib.Path(__file__).resolve().parents[1]
+SERIALIZE_SCRIPT = CODE_PATH / "serialize.py"
+# Runs a script with the start method, and arguments, given as JSON.
+RUNNER = """
+import json, multiprocessing, runpy, sys
+script, (method, args) = sys.argv[1], json.loads(sys.argv[2])
+sys.argv = [script, *args]
+multiprocessing.set_start_method(method)
+runpy.run_path(script, run_name="__main__")
+"""
+
+
+def serialize(method: str, jobs: int, work_dir: pathlib.Path,
+              args: argparse.Namespace) -> Dict[str, Any]:
+    """Serializes the crawl in work_dir, and returns the result's locations
+    and tokens, and the time taken."""
+    output = work_dir / f"{method}-{jobs}.pickle"
+    # serialize.py won't overwrite results from an earlier check.
+    output.unlink(missing_ok=True)
+    serialize_args = [
+        "--multi", "--stream",
+        "--redirect-cache", str(work_dir / "redirects.pickle"),
+        "--input", *map(str, sorted((work_dir / "raw").iterdir())),
+        "--output", str(output), "--jobs", str(jobs),
+        "--locations", *args.locations]
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", RUNNER, str(SERIALIZE_SCRIPT),
+                    json.dumps([method, serialize_args])],
+                   check=True, cwd=CODE_PATH)
+    seconds = time.perf_counter() - start
+    with output.open("rb") as handle:
+        measurement = pickle.load(handle)
+    instances = measurement.get_tracking_instances()
+    string = instances.strings.string
+    tokens: Set[Any] = {
+        (string(three_p), loc, string(key), string(value))
+        for three_p, tokens_for_three_p in instances.token_collection.items()
+        for loc, key, value in tokens_for_three_p}
+    return {
+        "seconds": seconds,
+        "recorded": sorted(loc.name for loc in measurement.locations),
+        "extracted": sorted({TokenLocation.from_int(token[1]).name
+                             for token in tokens}),
+        "tokens": tokens,
+    }
+
+
+def check(args: argparse.Namespace,
+          work_dir: pathlib.Path) -> Dict[str, Any]:
+    (work_dir / "raw").mkdir(exist_ok=True)
+    generator = CrawlGenerator(args)
+    generator.write(work_dir / "raw")
+    with (work_dir / "redirects.pickle").open("wb") as handle:
+        pickle.dump(generator.redirect_cache(), handle)
+
+    wanted = sorted(args.locations)
+    serial = serialize("fork", 1, work_dir, args)
+    runs = {"serial": serial}
+    methods = [method for method in ("fork", "spawn", "forkserver")
+               if method in multiprocessing.get_all_start_methods()]
+    for method in methods:
+        runs[method] = serialize(method, args.jobs, work_dir, args)
+    errors: List[str] = []
+    for name, run in runs.items():
+        if run["recorded"] != wanted:
+            errors.append(f"{name} records {run['recorded']}")
+        unwanted = sorted(set(run["extracted"]) - set(wanted))
+        if unwanted:
+            errors.append(f"{name} holds tokens from {unwanted}")
+        if run["tokens"] != serial["tokens"]:
+            errors.append(f"{name} holds different tokens than serial")
+    for run in runs.values():
+        run["tokens"] = len(run["tokens"])
+    return {"locations": wanted, "jobs": args.jobs, "runs": runs,
+            "errors": errors}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check the locations serialize.py --jobs extracts.")
+    PARSER.add_argument("--jobs", type=int, default=2,
+                        help="Number of worker processes.")
+    PARSER.add_argument("--locations", nargs="+", default=["COOKIE"],
+                        choices=[loc.name for loc in TokenLocation],
+                        help="Token locations to extract.")
+    PARSER.add_argument("--work-dir",
+                        help="Directory to write the crawl and results to. "
+                             "Defaults to a temporary directory.")
+    add_arguments(PARSER)
+    PARSER.set_defaults(sites=50)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.work_dir is None:
+        with tempfile.TemporaryDirectory() as TEMP_DIR:
+            REPORT = check(ARGS, pathlib.Path(TEMP_DIR))
+    else:
+        WORK_DIR = pathlib.Path(ARGS.work_dir)
+        WORK_DIR.mkdir(parents=True, exist_ok=True)
+        REPORT = check(ARGS, WORK_DIR)
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["errors"]:
+        sys.exit(1)
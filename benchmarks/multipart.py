@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Checks the multipart bodies tokenizing.kvs_from_body reads against the
+standard library's email parser, and measures its speed and peak memory on
+large multipart beacons.
+
+The beacons have --fields text fields and --files file parts of
+--file-size characters each (so, by default, are far larger than
+tokenizing.MAX_BODY_SIZE, which only limits the size of text fields in
+multipart bodies). Peak memory is reported along with the size of the
+body, to show that file parts aren't copied. Exits with an error if any
+generated body is tokenized differently than the email parser reads it
+(other than the last part of a truncated body, which only the email parser
+reads, or a truncated closing delimiter, which the email parser reads as
+part of the last value).
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import string
+import pathlib
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.tokenizing  # noqa: E402
+
+
+def email_fields(body: str, boundary: str) -> List[Tuple[str, str]]:
+    """The text fields in body, as read by the email package."""
+    message = email.parser.Parser(policy=email.policy.HTTP).parsestr(
+        f'Content-Type: multipart/form-data; boundary="{boundary}"\r\n\r\n'
+        + body)
+    fields = []
+    for part in message.iter_parts():  # type: ignore
+        name = part.get_param("name", header="content-disposition")
+        if name is None or part.get_filename() is not None:
+            continue
+        fields.append((name, part.get_payload()))
+    return fields
+
+
+def beacon(rand: random.Random, boundary: str, num_fields: int,
+           num_files: int, file_size: int, newline: str = "\r\n") -> str:
+    parts = []
+    for field in range(num_fields):
+        value = "".join(rand.choices(string.ascii_letters + string.digits,
+                                     k=rand.randrange(40)))
+        parts.append(f'Content-Disposition: form-data; name="f{field}"'
+                     f"{newline}{newline}{value}")
+    for file in range(num_files):
+        parts.insert(rand.randrange(len(parts) + 1),
+                     f'Content-Disposition: form-data; name="file{file}"; '
+                     f'filename="blob{file}.bin"{newline}'
+                     f"Content-Type: application/octet-stream{newline}"
+                     f"{newline}{'x' * file_size}")
+    delimiter = f"{newline}--{boundary}{newline}"
+    return (f"--{boundary}{newline}" + delimiter.join(parts) +
+            f"{newline}--{boundary}--{newline}")
+
+
+def generated_bodies(rand: random.Random,
+                     count: int) -> List[Tuple[str, str, bool]]:
+    bodies = []
+    for _ in range(count):
+        boundary = rand.choice(["XyZ", "----WebKitFormBoundary7MA4YWxk",
+                                "a b"])
+        body = beacon(rand, boundary, rand.randrange(6), rand.randrange(3),
+                      rand.randrange(30), rand.choice(["\r\n", "\n"]))
+        truncated = rand.random() < 0.3
+        if truncated:
+            body = body[:rand.randrange(len(body))]
+        bodies.append((body, boundary, truncated))
+    return bodies
+
+
+def tokenize(body: str, boundary: str) -> Optional[List[Tuple[str, str]]]:
+    """The text fields in body, as read by the tokenizer."""
+    return privacykpis.tokenizing.kvs_from_body(
+        privacykpis.tokenizing.BodyDataEncoding.FORM_MULTIPART, body,
+        f'multipart/form-data; boundary="{boundary}"')
+
+
+def check(bodies: List[Tuple[str, str, bool]]) -> Dict[str, Any]:
+    mismatches = []
+    for body, boundary, truncated in bodies:
+        kvs = tokenize(body, boundary) or []
+        expected = email_fields(body, boundary)
+        # The email parser reads a truncated last part up to the end of the
+        # body, where the tokenizer drops it, and reads a truncated closing
+        # delimiter (e.g. "--XyZ-") into the last value, where the tokenizer
+        # ends the value at the delimiter.
+        if truncated and len(expected) == len(kvs) + 1:
+            expected.pop()
+        elif (truncated and kvs and len(expected) == len(kvs) and
+              expected[-1][0] == kvs[-1][0] and
+              expected[-1][1].startswith(kvs[-1][1])):
+            expected[-1] = kvs[-1]
+        if kvs != expected:
+            mismatches.append(body)
+    return {"bodies": len(bodies), "mismatches": mismatches}
+
+
+def measure(func: Callable[[], Any]) -> Dict[str, float]:
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        func()
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_memory_kb": peak_kb}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Check and benchmark the multipart tokenizer.")
+    PARSER.add_argument("--generated", type=int, default=5000,
+                        help="Number of small bodies to check.")
+    PARSER.add_argument("--fields", type=int, default=200,
+                        help="Number of text fields in the large beacon.")
+    PARSER.add_argument("--files", type=int, default=8,
+                        help="Number of file parts in the large beacon.")
+    PARSER.add_argument("--file-size", type=int, default=4 * 1024 * 1024,
+                        help="Size of each file part, in characters.")
+    PARSER.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random generator.")
+    ARGS = PARSER.parse_args()
+
+    RAND = random.Random(ARGS.seed)
+    BOUNDARY = "----WebKitFormBoundary7MA4YWxkTrZu0gW"
+    BEACON = beacon(RAND, BOUNDARY, ARGS.fields, ARGS.files, ARGS.file_size)
+    REPORT = {
+        "generated": check(generated_bodies(RAND, ARGS.generated)),
+        "beacon": check([(BEACON, BOUNDARY, False)]),
+        "beacon_kb": len(BEACON) / 1024,
+        "tokenizer": measure(lambda: tokenize(BEACON, BOUNDARY)),
+        "email_parser": measure(lambda: email_fields(BEACON, BOUNDARY)),
+    }
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["generated"]["mismatches"] or REPORT["beacon"]["mismatches"]:
+        sys.exit(1)
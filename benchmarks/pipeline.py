@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Runs the expand -> serialize -> extract -> flatten pipeline over a
+synthetic crawl, and reports wall time, CPU time, peak RSS and throughput for
+each stage, as JSON.
+
+Each stage runs the same scripts the process/*.fish scripts run, as child
+processes, so the numbers reflect what a real processing run sees. Reports
+from different commits can be compared directly, as long as the same scale
+arguments are used.
+"""
+import argparse
+import json
+import os
+import pathlib
+import pickle
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, IO, List, Optional
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from privacykpis.common import package_env  # noqa: E402
+
+
+THIS_SCRIPT_PATH = pathlib.Path(__file__).parent
+CODE_PATH = THIS_SCRIPT_PATH.parent.resolve()
+EXPAND_SCRIPT = CODE_PATH / "process" / "expand.py"
+SERIALIZE_SCRIPT = CODE_PATH / "serialize.py"
+EXTRACT_SCRIPT = CODE_PATH / "extract.py"
+FLATTEN_SCRIPT = CODE_PATH / "process" / "flatten.py"
+# process/expand.py imports the privacykpis package, as run by process.py.
+CHILD_ENV = package_env()
+
+Measurement = Dict[str, Any]
+
+
+def _run(args: List[str], stdout: Optional[IO[Any]] = None,
+         ok_codes: tuple = (0,)) -> Measurement:
+    """Runs a child process, and returns its wall time, CPU time and peak
+    resident set size."""
+    start = time.perf_counter()
+    child = subprocess.Popen(args, stdout=stdout, env=CHILD_ENV)
+    _, status, usage = os.wait4(child.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode not in ok_codes:
+        raise subprocess.CalledProcessError(child.returncode, args)
+    return {
+        "wall_seconds": wall_seconds,
+        "user_seconds": usage.ru_utime,
+        "system_seconds": usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+        "peak_rss_kb": (usage.ru_maxrss // 1024 if sys.platform == "darwin"
+                        else usage.ru_maxrss),
+    }
+
+
+class Stage:
+    """Accumulates measurements of every child process run for a stage."""
+    def __init__(self) -> None:
+        self.runs: List[Measurement] = []
+        self.input_bytes = 0
+        self.items = 0
+
+    def run(self, args: List[str], inputs: List[pathlib.Path],
+            stdout: Optional[IO[Any]] = None,
+            ok_codes: tuple = (0,)) -> None:
+        self.input_bytes += sum(path.stat().st_size for path in inputs)
+        self.runs.append(_run(args, stdout, ok_codes))
+
+    def report(self, item_name: str) -> Dict[str, Any]:
+        wall_seconds = sum(run["wall_seconds"] for run in self.runs)
+        return {
+            "processes": len(self.runs),
+            "wall_seconds": wall_seconds,
+            "user_seconds": sum(run["user_seconds"] for run in self.runs),
+            "system_seconds": sum(run["system_seconds"]
+                                  for run in self.runs),
+            "peak_rss_kb": max((run["peak_rss_kb"] for run in self.runs),
+                               default=0),
+            "input_bytes": self.input_bytes,
+            "input_bytes_per_second": (self.input_bytes / wall_seconds
+                                       if wall_seconds else None),
+            item_name: self.items,
+            f"{item_name}_per_second": (self.items / wall_seconds
+                                        if wall_seconds else None),
+        }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=CODE_PATH,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _group_expanded(expand_dir: pathlib.Path
+                    ) -> Dict[str, List[pathlib.Path]]:
+    """Groups expanded files by <browser>-<channel>-<profile>, across dates,
+    the same way process/serialize.fish does."""
+    groups: Dict[str, List[pathlib.Path]] = {}
+    for path in sorted(expand_dir.iterdir()):
+        browser, channel, profile = path.stem.split("-")[:3]
+        groups.setdefault(f"{browser}-{channel}-{profile}", []).append(path)
+    return groups
+
+
+def run_pipeline(args: argparse.Namespace,
+                 work_dir: pathlib.Path) -> Dict[str, Any]:
+    dirs = {}
+    for name in ("raw", "expand", "serialize", "extract", "flatten"):
+        dirs[name] = work_dir / name
+        dirs[name].mkdir(parents=True, exist_ok=True)
+        # serialize.py refuses to overwrite its outputs, and stale files
+        # would be read by later stages, so clear out any earlier run.
+        for stale in dirs[name].iterdir():
+            stale.unlink()
+
+    generator = CrawlGenerator(args)
+    num_records, num_requests = generator.write(dirs["raw"])
+    redirect_cache_path = work_dir / "redirects.pickle"
+    with redirect_cache_path.open("wb") as handle:
+        pickle.dump(generator.redirect_cache(), handle)
+
+    python = sys.executable
+    stages = {name: Stage() for name in
+              ("expand", "serialize", "extract", "flatten")}
+
+    expand = stages["expand"]
+    expand.items = num_records
+    expand.run([python, str(EXPAND_SCRIPT), str(dirs["raw"]),
+                str(dirs["expand"])], list(dirs["raw"].iterdir()))
+
+    serialize = stages["serialize"]
+    serialize.items = num_records
+    serialize_args = shlex.split(args.serialize_args)
+    for desc, inputs in _group_expanded(dirs["expand"]).items():
+        output = dirs["serialize"] / f"{desc}.pickle"
+        serialize.run([python, str(SERIALIZE_SCRIPT), "--multi",
+                       "--redirect-cache", str(redirect_cache_path),
+                       "--input", *map(str, inputs),
+                       "--output", str(output), *serialize_args], inputs)
+
+    extract = stages["extract"]
+    extract_args = shlex.split(args.extract_args)
+    for browser in args.browsers:
+        for channel in args.channels:
+            measure = dirs["serialize"] / f"{browser}-{channel}-1.pickle"
+            control = dirs["serialize"] / f"{browser}-{channel}-2.pickle"
+            if not control.is_file():
+                continue
+            output = dirs["extract"] / f"{browser}-{channel}.json"
+            # extract.py exits with 1, even on success.
+            extract.run([python, str(EXTRACT_SCRIPT), "--input", str(measure),
+                         "--control", str(control), "--output", str(output),
+                         *extract_args], [measure, control], ok_codes=(0, 1))
+            extract.items += 1
+
+    flatten = stages["flatten"]
+    for extracted in sorted(dirs["extract"].iterdir()):
+        output_path = dirs["flatten"] / extracted.name
+        with output_path.open("w") as output:
+            flatten.run([python, str(FLATTEN_SCRIPT), str(extracted)],
+                        [extracted], stdout=output)
+        flatten.items += 1
+
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "sites": args.sites,
+            "requests_per_site": args.requests_per_site,
+            "third_party_share": args.third_party_share,
+            "third_parties": args.third_parties,
+            "body_encodings": args.body_encodings,
+            "browsers": args.browsers,
+            "channels": args.channels,
+            "profiles": args.profiles,
+            "seed": args.seed,
+            "serialize_args": args.serialize_args,
+            "extract_args": args.extract_args,
+        },
+        "crawl": {
+            "records": num_records,
+            "requests": num_requests,
+            "bytes": sum(p.stat().st_size for p in dirs["raw"].iterdir()),
+        },
+        "stages": {
+            "expand": expand.report("records"),
+            "serialize": serialize.report("records"),
+            "extract": extract.report("comparisons"),
+            "flatten": flatten.report("files"),
+        },
+    }
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark the processing pipeline on a synthetic crawl.")
+    PARSER.add_argument("--output",
+                        help="Path to write the JSON report to. If not "
+                             "provided, the report is printed to stdout.")
+    PARSER.add_argument("--work-dir",
+                        help="Directory to write intermediate files to "
+                             "(created if missing, and replacing those of "
+                             "any earlier run). If not provided, a "
+                             "temporary directory is used, and deleted "
+                             "afterwards.")
+    PARSER.add_argument("--serialize-args", default="",
+                        help="Extra arguments to pass to serialize.py, e.g. "
+                             "--serialize-args=\"--stream --jobs 4\".")
+    PARSER.add_argument("--extract-args", default="",
+                        help="Extra arguments to pass to extract.py.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.work_dir:
+        REPORT = run_pipeline(ARGS, pathlib.Path(ARGS.work_dir))
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            REPORT = run_pipeline(ARGS, pathlib.Path(WORK_DIR))
+
+    if ARGS.output:
+        with open(ARGS.output, "w") as HANDLE:
+            json.dump(REPORT, HANDLE, indent=2)
+    else:
+        json.dump(REPORT, sys.stdout, indent=2)
+        print()
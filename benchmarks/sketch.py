@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Compares the memory used by TrackingInstances and
+SketchedTrackingInstances on a generated crawl, and checks the error of
+FirstPartySketch counts.
+
+The crawl has --sites first parties, each embedding --embeds of
+--third-parties third parties, and making --requests requests to each. For
+half the third parties, every request sends a token shared by every first
+party (a tracking id). Requests to every third party but half of those also
+send a token unique to the first and third party (a session id, never
+reported). Exits with an error if the sketched collection
+reports any token or first party that the exact one doesn't, or the other
+way around, for tokens sent from at least --threshold first parties (only
+the number of requests listed may differ), or if that isn't also true with a
+threshold above SPARSE_LIMIT, or if comparing either collection against a
+sketched control (see control_mismatches()) gives a different result than
+against an exact one.
+"""
+import argparse
+import json
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.sketch  # noqa: E402
+from privacykpis.serialize import SketchedTrackingInstances  # noqa: E402
+from privacykpis.serialize import TrackingInstances  # noqa: E402
+from privacykpis.timestamps import TimeWindow  # noqa: E402
+from privacykpis.types import InternedToken, RequestTimestamp  # noqa: E402
+
+
+Request = Tuple[str, str, List[Tuple[int, str, str]], RequestTimestamp]
+
+
+def requests(rand: random.Random,
+             args: argparse.Namespace) -> Iterable[Request]:
+    for site in range(args.sites):
+        first_p = f"site{site}.com"
+        for index in rand.sample(range(args.third_parties), args.embeds):
+            three_p = f"tracker{index}.net"
+            session = f"{rand.getrandbits(64):x}"
+            tokens = [] if index % 4 == 0 else [(1, "session", session)]
+            if index % 2 == 0:
+                tokens.append((3, "uid", f"uid-{three_p}"))
+            for request in range(args.requests):
+                yield (first_p, three_p, tokens,
+                       (f"https://{three_p}/p?r={request}", request))
+
+
+def add_requests(instances: TrackingInstances, args: argparse.Namespace,
+                 every: int = 1) -> None:
+    """Adds the generated requests from every every-th site to
+    instances."""
+    strings = instances.strings
+    for index, (first_p, three_p, tokens, ts) in enumerate(
+            requests(random.Random(args.seed), args)):
+        if index // (args.embeds * args.requests) % every:
+            continue
+        interned: List[InternedToken] = [
+            (loc, strings.intern(key), strings.intern(value))
+            for loc, key, value in tokens]
+        instances.add_request(strings.intern(first_p),
+                              strings.intern(three_p), interned, ts)
+
+
+def measure(instances: TrackingInstances,
+            args: argparse.Namespace) -> Dict[str, Any]:
+    """Adds the generated requests to instances, and returns the memory it
+    holds afterwards, and the time taken."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    add_requests(instances, args)
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"seconds": seconds, "mb": size / 1024 / 1024}
+
+
+def requests_listed(instances: TrackingInstances) -> int:
+    """The number of requests listed in the reports."""
+    return sum(len(timestamps)
+               for _, report in instances.reports()
+               for first_ps in report.values()
+               for timestamps in first_ps.values())
+
+
+def reported_from(instances: TrackingInstances,
+                  threshold: int) -> Set[Any]:
+    """The (third party, token, first party) triples reported, for tokens
+    sent from at least threshold first parties."""
+    return {(three_p, token, first_p)
+            for three_p, report in instances.reports()
+            for token, first_ps in report.items()
+            if len(first_ps) >= threshold
+            for first_p in first_ps}
+
+
+def identified(instances: TrackingInstances) -> Set[Any]:
+    """The (third party, token, first party) triples held, whether or not
+    they would be reported."""
+    string = instances.strings.string
+    return {(string(three_p), loc, string(key), string(value),
+             string(first_p))
+            for three_p, tokens in instances.token_collection.items()
+            for (loc, key, value), first_ps in tokens.items()
+            for first_p in first_ps}
+
+
+def control_mismatches(exact: TrackingInstances,
+                       sketched: TrackingInstances,
+                       args: argparse.Namespace) -> int:
+    """Compares the difference and overlap of exact and sketched with a
+    control holding every other site of the same crawl, sketched and not,
+    over the whole crawl and over a window holding only the first request
+    to each third party (which a sketched control keeps). Returns the
+    number of results that differ between the two controls."""
+    exact_control = TrackingInstances()
+    sketched_control = SketchedTrackingInstances(args.threshold)
+    add_requests(exact_control, args, 2)
+    add_requests(sketched_control, args, 2)
+    mismatches = 0
+    for window in (None, TimeWindow(0, 1)):
+        for compare in (TrackingInstances.difference,
+                        TrackingInstances.overlap):
+            for first in (exact, sketched):
+                expected = compare(first, exact_control, window)
+                actual = compare(first, sketched_control, window)
+                if identified(expected) != identified(actual):
+                    mismatches += 1
+    return mismatches
+
+
+def sparse_limit_mismatches(exact: TrackingInstances,
+                            args: argparse.Namespace) -> int:
+    """Compares the reports of exact with those of a collection sketched
+    with a threshold above SPARSE_LIMIT, whose pending tokens would have
+    dense sketches, for tokens sent from at least that many first parties.
+    Returns the number of triples only one of them reports."""
+    threshold = privacykpis.sketch.SPARSE_LIMIT + 1
+    sketched = SketchedTrackingInstances(threshold)
+    add_requests(sketched, args)
+    return len(reported_from(exact, threshold) ^
+               reported_from(sketched, threshold))
+
+
+def count_errors(rand: random.Random, sizes: List[int],
+                 trials: int) -> Dict[str, Any]:
+    """Returns the mean and largest relative error of sketch counts of
+    first parties, for each number of first parties."""
+    errors: Dict[str, Any] = {}
+    for size in sizes:
+        relative = []
+        for _ in range(trials):
+            sketch = privacykpis.sketch.FirstPartySketch()
+            domains: Dict[int, int] = {}
+            for first_p in range(size):
+                domains[first_p] = privacykpis.sketch.domain_hash(
+                    f"site{rand.getrandbits(64):x}.com")
+                sketch.add(first_p, ("", 0), domains.__getitem__)
+            relative.append(abs(sketch.count() - size) / size)
+        errors[str(size)] = {"mean": sum(relative) / trials,
+                             "max": max(relative)}
+    return errors
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark sketched tracking instances.")
+    PARSER.add_argument("--sites", type=int, default=20000,
+                        help="Number of generated first parties.")
+    PARSER.add_argument("--third-parties", type=int, default=200,
+                        help="Number of generated third parties.")
+    PARSER.add_argument("--embeds", type=int, default=10,
+                        help="Number of third parties each site embeds.")
+    PARSER.add_argument("--requests", type=int, default=3,
+                        help="Number of requests to each embedded third "
+                             "party.")
+    PARSER.add_argument("--threshold", type=int,
+                        default=privacykpis.sketch.DEFAULT_THRESHOLD,
+                        help="Sketch threshold.")
+    PARSER.add_argument("--count-sizes", type=int, nargs="*",
+                        default=[10, 100, 1000, 10000, 100000],
+                        help="Numbers of first parties to check sketch "
+                             "counts of.")
+    PARSER.add_argument("--count-trials", type=int, default=5,
+                        help="Number of sketches to check for each size.")
+    PARSER.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random generator.")
+    ARGS = PARSER.parse_args()
+
+    EXACT = TrackingInstances()
+    SKETCHED = SketchedTrackingInstances(ARGS.threshold)
+    REPORT: Dict[str, Any] = {
+        "exact": measure(EXACT, ARGS),
+        "sketched": measure(SKETCHED, ARGS),
+    }
+    REPORT["exact"]["requests_listed"] = requests_listed(EXACT)
+    REPORT["sketched"]["requests_listed"] = requests_listed(SKETCHED)
+    REPORT["mismatches"] = len(reported_from(EXACT, ARGS.threshold) ^
+                               reported_from(SKETCHED, ARGS.threshold))
+    REPORT["sparse_limit_mismatches"] = sparse_limit_mismatches(EXACT, ARGS)
+    REPORT["control_mismatches"] = control_mismatches(EXACT, SKETCHED, ARGS)
+    REPORT["standard_error"] = privacykpis.sketch.STANDARD_ERROR
+    REPORT["count_errors"] = count_errors(random.Random(ARGS.seed),
+                                          ARGS.count_sizes, ARGS.count_trials)
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if (REPORT["mismatches"] or REPORT["sparse_limit_mismatches"] or
+            REPORT["control_mismatches"]):
+        sys.exit(1)
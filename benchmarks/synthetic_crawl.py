@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Generates synthetic crawl logs, in the format written by record.py (i.e.
+resources/scripts/log_headers.py, plus the fields record.py adds), for
+benchmarking the processing pipeline at arbitrary scales.
+
+Each third party gets a per-profile identifier (so different profiles are
+distinguishable) and a per-browser identifier shared between profiles (so
+comparisons between profiles find overlapping tokens too).
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import pickle
+import random
+import string
+from typing import Any, Dict, List, Tuple
+
+
+BODY_ENCODINGS = ("json", "form", "multipart", "unknown", "none")
+CONTENT_TYPES = {
+    "json": "application/json",
+    "form": "application/x-www-form-urlencoded",
+    "multipart": "multipart/form-data; boundary=----synthetic",
+    "unknown": None,
+    "none": None,
+}
+TLDS = ("com", "org", "net", "co.uk", "de", "io")
+START_TIME = datetime.datetime(2020, 6, 1)
+
+Record = Dict[str, Any]
+
+
+def _random_id(rand: random.Random, length: int) -> str:
+    return "".join(rand.choices(string.ascii_letters + string.digits,
+                                k=length))
+
+
+class CrawlGenerator:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.third_parties = [
+            f"tracker{i}.{TLDS[i % len(TLDS)]}"
+            for i in range(args.third_parties)]
+        # A few third parties are embedded almost everywhere, most are rare.
+        self.popularity = [1.0 / (i + 1) for i in range(args.third_parties)]
+        self.shared_ids = {
+            (browser, tp): _random_id(self.rand, 24)
+            for browser in args.browsers for tp in self.third_parties}
+        self.profile_ids = {
+            (browser, profile, tp): _random_id(self.rand, 32)
+            for browser in args.browsers
+            for profile in range(1, args.profiles + 1)
+            for tp in self.third_parties}
+
+    def site_url(self, site_index: int) -> str:
+        return f"https://www.site{site_index}.{TLDS[site_index % len(TLDS)]}/"
+
+    def body(self, encoding: str, ids: Dict[str, str]) -> str:
+        if encoding == "json":
+            return json.dumps({
+                "uid": ids["profile"],
+                "fp": ids["shared"],
+                "ctx": {"screen": [1920, 1080], "ts": self.rand.random(),
+                        "page": {"title": _random_id(self.rand, 40)}},
+            })
+        if encoding == "form":
+            return (f"uid={ids['profile']}&fp={ids['shared']}"
+                    f"&r={self.rand.getrandbits(40)}")
+        if encoding == "multipart":
+            boundary = "------synthetic"
+            return (f"{boundary}\r\n"
+                    'Content-Disposition: form-data; name="uid"\r\n\r\n'
+                    f"{ids['profile']}\r\n{boundary}\r\n"
+                    'Content-Disposition: form-data; name="file"; '
+                    'filename="blob.bin"\r\n'
+                    "Content-Type: application/octet-stream\r\n\r\n"
+                    f"{_random_id(self.rand, 512)}\r\n{boundary}--\r\n")
+        if encoding == "unknown":
+            return _random_id(self.rand, 64)
+        return ""
+
+    def third_party_request(self, browser: str, profile: int, site_url: str,
+                            time: datetime.datetime) -> Record:
+        tp = self.rand.choices(self.third_parties, self.popularity)[0]
+        ids = {"profile": self.profile_ids[(browser, profile, tp)],
+               "shared": self.shared_ids[(browser, tp)]}
+        encoding = self.rand.choice(self.args.body_encodings)
+        headers = [
+            ["Cookie", f"_uid={ids['profile']}; _fp={ids['shared']}; "
+                       f"_s={self.rand.getrandbits(20)}"],
+            ["User-Agent", "Mozilla/5.0 (synthetic)"],
+        ]
+        content_type = CONTENT_TYPES[encoding]
+        if content_type is not None:
+            headers.append(["Content-Type", content_type])
+        url = (f"https://px.{tp}/collect/{ids['shared']}/p.gif?"
+               f"uid={ids['profile']}&ref={site_url}"
+               f"&cb={self.rand.getrandbits(48)}&t={int(time.timestamp())}")
+        return {"url": url, "headers": headers, "time": str(time),
+                "body": self.body(encoding, ids)}
+
+    def first_party_request(self, site_url: str,
+                            time: datetime.datetime) -> Record:
+        asset = self.rand.choice(("app.js", "style.css", "logo.png"))
+        version = self.rand.randrange(99)
+        session = _random_id(self.rand, 20)
+        return {"url": f"{site_url}static/{asset}?v={version}",
+                "headers": [["Cookie", f"session={session}"]],
+                "time": str(time), "body": ""}
+
+    def site_record(self, browser: str, channel: str, profile: int,
+                    site_index: int) -> Record:
+        site_url = self.site_url(site_index)
+        start = START_TIME + datetime.timedelta(minutes=site_index)
+        requests = []
+        for i in range(self.args.requests_per_site):
+            time = start + datetime.timedelta(milliseconds=50 * i)
+            if self.rand.random() < self.args.third_party_share:
+                requests.append(self.third_party_request(browser, profile,
+                                                         site_url, time))
+            else:
+                requests.append(self.first_party_request(site_url, time))
+        end = start + datetime.timedelta(seconds=30)
+        return {"start": str(start), "end": str(end), "url": site_url,
+                "requests": requests, "channel": channel, "browser": browser,
+                "date": self.args.date, "profile": profile}
+
+    def write(self, output_dir: pathlib.Path) -> Tuple[int, int]:
+        """Writes one log file per browser, and returns the number of site
+        records and requests written."""
+        num_records = 0
+        num_requests = 0
+        for browser in self.args.browsers:
+            log_path = output_dir / f"{browser}.json"
+            with log_path.open("w") as handle:
+                for channel in self.args.channels:
+                    for profile in range(1, self.args.profiles + 1):
+                        for site in range(self.args.sites):
+                            record = self.site_record(browser, channel,
+                                                      profile, site)
+                            handle.write(json.dumps(record) + "\n")
+                            num_records += 1
+                            num_requests += len(record["requests"])
+        return num_records, num_requests
+
+    def redirect_cache(self) -> Dict[str, bool]:
+        """Returns a redirect cache (see privacykpis.redirects) marking every
+        synthetic site as not redirecting, so that serializing doesn't try to
+        fetch them."""
+        return {f"www.site{i}.{TLDS[i % len(TLDS)]}": False
+                for i in range(self.args.sites)}
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--sites", type=int, default=200,
+                        help="Number of sites measured per profile.")
+    parser.add_argument("--requests-per-site", type=int, default=40,
+                        help="Number of requests made on each site.")
+    parser.add_argument("--third-party-share", type=float, default=0.6,
+                        help="Share of requests sent to third parties.")
+    parser.add_argument("--third-parties", type=int, default=50,
+                        help="Number of distinct third parties.")
+    parser.add_argument("--body-encodings", nargs="+",
+                        default=list(BODY_ENCODINGS), choices=BODY_ENCODINGS,
+                        help="Body encodings to pick from (uniformly) for "
+                             "third party requests.")
+    parser.add_argument("--browsers", nargs="+", default=["chrome"],
+                        help="Browsers to generate logs for.")
+    parser.add_argument("--channels", nargs="+", default=["alexa"],
+                        help="Channels (datasets) to generate logs for.")
+    parser.add_argument("--profiles", type=int, default=2,
+                        help="Number of profiles measured per browser.")
+    parser.add_argument("--date", default="2020-06-01",
+                        help="Crawl date to record in the logs.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed, for reproducible logs.")
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Generate synthetic crawl logs.")
+    PARSER.add_argument("--output", required=True,
+                        help="Directory to write log files to.")
+    PARSER.add_argument("--redirect-cache",
+                        help="If passed, write a redirect cache covering "
+                             "every generated site to this path.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    GENERATOR = CrawlGenerator(ARGS)
+    RECORDS, REQUESTS = GENERATOR.write(pathlib.Path(ARGS.output))
+    if ARGS.redirect_cache:
+        with open(ARGS.redirect_cache, "wb") as HANDLE:
+            pickle.dump(GENERATOR.redirect_cache(), HANDLE)
+    print(json.dumps({"records": RECORDS, "requests": REQUESTS}))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Measures how fast a measurement is restricted to a time window, and
+checks the result against filtering its report by timestamp.
+
+--input is a measurement file written by serialize.py, in either format.
+For each of --windows windows (evenly spread over the measurement, each
+covering --fraction of it), the window is cut out of the full tracking
+instances (TrackingInstances.in_window, as extract.py does with a sidecar),
+and applied while deriving the instances (the timestamp column mask, for
+columnar files). Exits with an error if either reports any token, first
+party or request differently than filtering the full report does.
+"""
+import argparse
+import io
+import json
+import pathlib
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.serialize  # noqa: E402
+from privacykpis.serialize import TrackingInstances  # noqa: E402
+from privacykpis.timestamps import TimeWindow, isoformat  # noqa: E402
+
+
+def report(instances: TrackingInstances) -> Any:
+    handle = io.StringIO()
+    instances.to_json(handle)
+    return json.loads(handle.getvalue())
+
+
+def filtered(full_report: Any, window: TimeWindow) -> Any:
+    """The report, with the requests made outside window removed, as
+    extract.py would report them."""
+    start, end = (isoformat(bound) for bound in window.bounds())
+    result: Dict[str, Any] = {}
+    for three_p, tokens in full_report.items():
+        for token, first_ps in tokens.items():
+            kept = {first_p: [request for request in requests
+                              if start <= request[1] < end]
+                    for first_p, requests in first_ps.items()}
+            kept = {first_p: requests for first_p, requests in kept.items()
+                    if requests}
+            if len(kept) > 1:
+                result.setdefault(three_p, {})[token] = kept
+    return result
+
+
+def windows(instances: TrackingInstances, count: int,
+            fraction: float) -> List[TimeWindow]:
+    timestamps = [timestamp
+                  for tokens in instances.token_collection.values()
+                  for first_ps in tokens.values()
+                  for requests in first_ps.values()
+                  for _, timestamp in requests]
+    first, last = min(timestamps), max(timestamps) + 1
+    length = int((last - first) * fraction)
+    step = (last - first - length) // max(count - 1, 1)
+    return [TimeWindow(first + i * step, first + i * step + length)
+            for i in range(count)]
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark time window restriction.")
+    PARSER.add_argument("--input", required=True,
+                        help="Measurement file to restrict.")
+    PARSER.add_argument("--windows", type=int, default=4,
+                        help="Number of windows to check.")
+    PARSER.add_argument("--fraction", type=float, default=0.25,
+                        help="Fraction of the measurement each window "
+                             "covers.")
+    ARGS = PARSER.parse_args()
+
+    MEASUREMENT = privacykpis.serialize.load(ARGS.input)
+    START = time.perf_counter()
+    FULL = MEASUREMENT.get_tracking_instances()
+    REPORT: Dict[str, Any] = {
+        "derive_seconds": time.perf_counter() - START,
+        "windows": [],
+    }
+    FULL_REPORT = report(FULL)
+    MISMATCHES = 0
+    for WINDOW in windows(FULL, ARGS.windows, ARGS.fraction):
+        START = time.perf_counter()
+        CUT = FULL.in_window(WINDOW)
+        CUT_SECONDS = time.perf_counter() - START
+        START = time.perf_counter()
+        DERIVED = MEASUREMENT.get_tracking_instances(None, WINDOW)
+        DERIVED_SECONDS = time.perf_counter() - START
+        EXPECTED = filtered(FULL_REPORT, WINDOW)
+        WRONG = [name for name, instances in (("in_window", CUT),
+                                              ("derived", DERIVED))
+                 if report(instances) != EXPECTED]
+        MISMATCHES += len(WRONG)
+        REPORT["windows"].append({
+            "start": isoformat(WINDOW.bounds()[0]),
+            "end": isoformat(WINDOW.bounds()[1]),
+            "tokens": sum(len(tokens) for tokens in EXPECTED.values()),
+            "in_window_seconds": CUT_SECONDS,
+            "derive_seconds": DERIVED_SECONDS,
+            "mismatches": WRONG,
+        })
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if MISMATCHES:
+        sys.exit(1)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Compares filtering token values one at a time with
+filters.should_ignore_tokens, which filters a whole batch at once.
+
+Token values are taken from crawl logs (--input, or a synthetic crawl if
+none are given), and repeated until there are --tokens of them, as values
+are repeated in real crawls. Three ways of filtering them are timed, each
+first with empty caches, and then again with the caches filled by the first
+run:
+
+- "original": the filters as they were before verdicts were cached, with
+  the (slow) datetime check first.
+- "per_token": should_ignore_token, called on each token.
+- "batch": should_ignore_tokens, called on batches of --batch-size tokens.
+
+Exits with an error if the three don't agree on every token.
+"""
+import argparse
+import calendar
+import json
+import mimetypes
+import pathlib
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import dateutil.parser
+
+from synthetic_crawl import CrawlGenerator, add_arguments
+from datetime_filter import crawl_tokens
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import privacykpis.filters  # noqa: E402
+
+
+def _original_is_datetime(token: str) -> bool:
+    if len(token) < 10:
+        return False
+    try:
+        dateutil.parser.parse(token, ignoretz=True)
+        return True
+    except (dateutil.parser.ParserError, OverflowError,  # type: ignore
+            calendar.IllegalMonthError, TypeError):
+        return False
+
+
+def original_verdict(token: str) -> bool:
+    """should_ignore_token, as it was before verdicts were cached."""
+    return (_original_is_datetime(token) or len(token) < 11 or
+            token.startswith("http://") or token.startswith("https://") or
+            mimetypes.guess_type(token)[0] is not None)
+
+
+def _clear_caches() -> None:
+    privacykpis.filters.VERDICTS.entries.clear()
+
+
+def per_token(tokens: List[str]) -> List[bool]:
+    return [privacykpis.filters.should_ignore_token(token)
+            for token in tokens]
+
+
+def batched(tokens: List[str], batch_size: int) -> List[bool]:
+    mask: List[bool] = []
+    for start in range(0, len(tokens), batch_size):
+        mask += privacykpis.filters.should_ignore_tokens(
+            tokens[start:start + batch_size])
+    return mask
+
+
+def timed(func: Callable[[], List[bool]]) -> Dict[str, Any]:
+    _clear_caches()
+    start = time.perf_counter()
+    mask = func()
+    seconds = time.perf_counter() - start
+    # Once more, with the caches filled by the first run.
+    start = time.perf_counter()
+    func()
+    warm_seconds = time.perf_counter() - start
+    return {"seconds": seconds, "warm_seconds": warm_seconds, "mask": mask}
+
+
+def benchmark(tokens: List[str], batch_size: int) -> Dict[str, Any]:
+    results = {
+        "original": timed(lambda: [original_verdict(token)
+                                   for token in tokens]),
+        "per_token": timed(lambda: per_token(tokens)),
+        "batch": timed(lambda: batched(tokens, batch_size)),
+    }
+    expected = results["original"]["mask"]
+    report: Dict[str, Any] = {
+        "tokens": len(tokens),
+        "distinct_tokens": len(set(tokens)),
+        "ignored": sum(expected),
+        "mismatches": sorted({
+            token for name in ("per_token", "batch")
+            for token, verdict, expected_verdict in zip(
+                tokens, results[name]["mask"], expected)
+            if verdict != expected_verdict}),
+    }
+    original_seconds = results["original"]["seconds"]
+    for name, result in results.items():
+        seconds = result["seconds"]
+        warm_seconds = result["warm_seconds"]
+        report[name] = {
+            "seconds": seconds,
+            "tokens_per_second": len(tokens) / seconds if seconds else None,
+            "speedup": original_seconds / seconds if seconds else None,
+            "warm_seconds": warm_seconds,
+            "warm_speedup": (original_seconds / warm_seconds
+                             if warm_seconds else None),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark batched token filtering.")
+    PARSER.add_argument("--input", nargs="+", type=pathlib.Path,
+                        help="Crawl logs to take token values from. If not "
+                             "provided, a synthetic crawl is generated.")
+    PARSER.add_argument("--tokens", type=int, default=1000000,
+                        help="Number of tokens to filter.")
+    PARSER.add_argument("--batch-size", type=int, default=10000,
+                        help="Number of tokens per should_ignore_tokens "
+                             "call.")
+    add_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
+    if ARGS.input:
+        CRAWL_TOKENS = crawl_tokens(ARGS.input)
+    else:
+        with tempfile.TemporaryDirectory() as WORK_DIR:
+            CrawlGenerator(ARGS).write(pathlib.Path(WORK_DIR))
+            CRAWL_TOKENS = crawl_tokens(pathlib.Path(WORK_DIR).iterdir())
+    if not CRAWL_TOKENS:
+        sys.exit("No tokens found in the crawl logs.")
+    TOKENS = (CRAWL_TOKENS * (ARGS.tokens // len(CRAWL_TOKENS) + 1))
+    REPORT = benchmark(TOKENS[:ARGS.tokens], ARGS.batch_size)
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["mismatches"]:
+        sys.exit(1)
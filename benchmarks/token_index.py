@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Measures how fast runs are added to a token index
+(privacykpis.tokenindex), and how fast it answers lookups once it holds
+many runs.
+
+--runs runs are generated (e.g. one per browser and profile, for every day of
+a few months), each with --third-parties third parties, --tokens tokens per
+third party, and a few first parties and timestamps per token. Half of each
+run's tokens are shared by every run (long lived identifiers, like cookies),
+and the rest are unique to the run. Exits with an error if a lookup doesn't
+return every posting of the looked up token.
+"""
+import argparse
+import json
+import pathlib
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from privacykpis.serialize import TrackingInstances  # noqa: E402
+import privacykpis.timestamps  # noqa: E402
+from privacykpis.tokenindex import TokenIndex  # noqa: E402
+
+
+def generated_run(rand: random.Random, run: int,
+                  args: argparse.Namespace) -> TrackingInstances:
+    instances = TrackingInstances()
+    strings = instances.strings
+    for three_p in range(args.third_parties):
+        domain = strings.intern(f"tracker{three_p}.net")
+        for token in range(args.tokens):
+            shared = token % 2 == 0
+            value = (f"shared-{three_p}-{token:08x}" if shared else
+                     f"{rand.getrandbits(64):016x}")
+            interned = (1 + token % 4, strings.intern(f"k{token % 20}"),
+                        strings.intern(value))
+            for site in rand.sample(range(1000), 2):
+                instances.add_request(
+                    strings.intern(f"site{site}.com"), domain, [interned],
+                    (f"https://tracker{three_p}.net/",
+                     privacykpis.timestamps.parse(
+                         f"2020-06-{1 + run % 28:02}T12:00:00")))
+    return instances
+
+
+def timings_ms(func: Callable[[str], Any], keys: List[str]) -> Dict[str, Any]:
+    seconds = []
+    for key in keys:
+        start = time.perf_counter()
+        func(key)
+        seconds.append(time.perf_counter() - start)
+    return {"median_ms": statistics.median(seconds) * 1000,
+            "max_ms": max(seconds) * 1000}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark the token index.")
+    PARSER.add_argument("--runs", type=int, default=100,
+                        help="Number of runs to index.")
+    PARSER.add_argument("--third-parties", type=int, default=100,
+                        help="Number of third parties in each run.")
+    PARSER.add_argument("--tokens", type=int, default=100,
+                        help="Number of tokens per third party.")
+    PARSER.add_argument("--lookups", type=int, default=200,
+                        help="Number of lookups of each kind to time.")
+    PARSER.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random generator.")
+    ARGS = PARSER.parse_args()
+
+    RAND = random.Random(ARGS.seed)
+    with tempfile.TemporaryDirectory() as WORK_DIR:
+        INDEX = TokenIndex(pathlib.Path(WORK_DIR) / "index.db")
+        START = time.perf_counter()
+        POSTINGS = 0
+        for RUN in range(ARGS.runs):
+            POSTINGS += INDEX.add_run(f"run{RUN}",
+                                      generated_run(RAND, RUN, ARGS))
+        INDEX_SECONDS = time.perf_counter() - START
+
+        SHARED = [f"shared-{RAND.randrange(ARGS.third_parties)}-"
+                  f"{RAND.randrange(0, ARGS.tokens, 2):08x}"
+                  for _ in range(ARGS.lookups)]
+        # Every shared token is sent from two first parties in every run.
+        MISSING = [value for value in SHARED
+                   if len(INDEX.lookup(value)) != 2 * ARGS.runs]
+        REPORT = {
+            "postings": POSTINGS,
+            "index_mb": (pathlib.Path(WORK_DIR) / "index.db").stat().st_size
+            / 1024 / 1024,
+            "postings_per_second": POSTINGS / INDEX_SECONDS,
+            "exact_value": timings_ms(INDEX.lookup, SHARED),
+            "prefix_value": timings_ms(
+                lambda value: INDEX.lookup(value[:-2], prefix=True), SHARED),
+            "unknown_value": timings_ms(
+                INDEX.lookup, [f"{RAND.getrandbits(64):016x}x"
+                               for _ in range(ARGS.lookups)]),
+            "mismatches": MISSING,
+        }
+        INDEX.close()
+    json.dump(REPORT, sys.stdout, indent=2)
+    print()
+    if REPORT["mismatches"]:
+        sys.exit(1)
@@ -2,5 +2,5 @@
 
 # Simple helper script to do some static checking of the code.
 
-mypy --strict extract.py environment.py record.py serialize.py
+mypy --strict extract.py environment.py lookup.py record.py serialize.py
 pycodestyle --exclude measurements-scripts/,source.py,sink.py .
@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 import argparse
-import pickle
+import itertools
+import pathlib
 import sys
+from typing import Any, FrozenSet, List, Optional
 
-from privacykpis.argparse.types import writeable_path
+from privacykpis.argparse.types import timestamp, token_location
+from privacykpis.argparse.types import updateable_path, writeable_path
+from privacykpis.common import err
+import privacykpis.filters
+from privacykpis.matrix import ComparisonMatrix
 import privacykpis.serialize
 from privacykpis.serialize import TrackingInstances
+from privacykpis.sidecar import DerivedMeasurement
+from privacykpis.tokenindex import TokenIndex, run_name
+from privacykpis.stats import STATS
+from privacykpis.timestamps import TimeWindow
+from privacykpis.types import TokenLocation
 
 
 PARSER = argparse.ArgumentParser(description="Serialize tracking tokens.")
-PARSER.add_argument("--input", required=True,
-                    help="Path to a pickled BrowserMeasurement file.")
+INPUTS = PARSER.add_mutually_exclusive_group(required=True)
+INPUTS.add_argument("--input",
+                    help="Path to a measurement file written by "
+                         "serialize.py, in either format.")
+INPUTS.add_argument("--matrix", nargs="+", metavar="MEASUREMENT",
+                    help="Paths to measurement files to compare with each "
+                         "other, instead of --input with --control. Each "
+                         "file is loaded once, and the runs (named after "
+                         "the files), the number of tokens in the "
+                         "difference and overlap of every pair of runs, and "
+                         "which runs saw each token, are written to "
+                         "--output, as JSON.")
 PARSER.add_argument("--control", required=False,
-                    help="Path to another pickled BrowserMeasurement file, "
+                    help="Path to another measurement file, "
                          "used to determine which tokens are unique to a "
                          "session.")
 PARSER.add_argument("--overlap", action="store_true", default=False,
@@ -22,38 +43,208 @@ PARSER.add_argument("--overlap", action="store_true", default=False,
 PARSER.add_argument("--output", required=True, type=writeable_path,
                     help="Path to write the serialized TrackingInstances data "
                          "to, in pickle format.")
+PARSER.add_argument("--pairs", type=pathlib.Path,
+                    help="With --matrix, also write the difference and "
+                         "overlap of every pair of runs to this directory, "
+                         "as <input>--<control>.json and "
+                         "<input>--<control>.overlap.json (or .jsonl, with "
+                         "--format jsonl). Each is the same as extract.py's "
+                         "output for that pair.")
 PARSER.add_argument("--debug", action="store_true",
                     help="Print debugging information.")
 PARSER.add_argument("--format", default="json",
-                    choices=["json", "pickle"],
-                    help="Version to serialize results to.")
+                    choices=["json", "jsonl", "pickle"],
+                    help="Version to serialize results to. jsonl writes "
+                         "one line per token, holding the third party, the "
+                         "token and the first parties it was sent from.")
+PARSER.add_argument("--filter-cache", type=updateable_path,
+                    help="If passed, use the passed file as a cache of "
+                         "token filter verdicts, shared across runs (and "
+                         "with serialize.py).")
+PARSER.add_argument("--filter-cache-size", type=int,
+                    default=privacykpis.filters.FILTER_CACHE_SIZE,
+                    help="Maximum number of token filter verdicts to cache. "
+                         "Check the hit rate in the --stats report when "
+                         "sizing this.")
+PARSER.add_argument("--locations", nargs="+", type=token_location,
+                    help="Only extract tokens from these locations (any of "
+                         "COOKIE, PATH, QUERY_PARAM and BODY). Every "
+                         "location must have been extracted by "
+                         "serialize.py, for both --input and --control. "
+                         "Defaults to the locations extracted for --input.")
+PARSER.add_argument("--start", type=timestamp,
+                    help="Only extract tokens sent in requests made at or "
+                         "after this time (an ISO 8601 timestamp, e.g. "
+                         "2020-06-01T12:00:00, in the same timezone as the "
+                         "crawl), in every measurement file. Requests are "
+                         "cut out of the cached tracking instances (or, "
+                         "with --no-sidecar, skipped while reading the "
+                         "measurement), so nothing needs to be "
+                         "re-serialized. Either way the same tokens are "
+                         "reported, though not always in the same order.")
+PARSER.add_argument("--end", type=timestamp,
+                    help="Only extract tokens sent in requests made before "
+                         "this time (see --start).")
+PARSER.add_argument("--no-sidecar", action="store_true", default=False,
+                    help="Don't read or write the sidecar files that cache "
+                         "the tracking instances derived from each "
+                         "measurement file (written next to it, as "
+                         "<file>.tracking).")
+PARSER.add_argument("--index", type=updateable_path,
+                    help="If passed, add the tokens of every measurement "
+                         "file read to the token index at this path "
+                         "(created if needed), which can be searched with "
+                         "lookup.py.")
+PARSER.add_argument("--stats", type=updateable_path,
+                    help="If passed, write the time spent in, and calls to, "
+                         "each processing stage, along with other counters, "
+                         "to this path, as JSON.")
 ARGS = PARSER.parse_args()
 
-INPUT = open(ARGS.input, 'rb')
-
 
 def write_output(data: TrackingInstances) -> None:
-    if ARGS.format == "json":
-        data.to_json(open(ARGS.output, 'w'))
-    elif ARGS.format == "pickle":
-        data.to_pickle(open(ARGS.output, 'wb'))
+    with STATS.timer("write"):
+        if ARGS.format == "json":
+            data.to_json(open(ARGS.output, 'w'))
+        elif ARGS.format == "jsonl":
+            data.to_jsonl(open(ARGS.output, 'w'))
+        elif ARGS.format == "pickle":
+            data.to_pickle(open(ARGS.output, 'wb'))
+    privacykpis.filters.write_cache(ARGS.filter_cache)
+    if ARGS.debug:
+        print(f"Filter cache: {privacykpis.filters.cache_stats()}")
+        print(f"Sites reidentified: {data.reidentified_sites()}")
+    STATS.write(ARGS.stats, "extract")
+
+
+if ARGS.filter_cache_size < 0:
+    err("--filter-cache-size must not be negative, got "
+        f"{ARGS.filter_cache_size}")
+    sys.exit(-1)
+if (ARGS.start is not None and ARGS.end is not None and
+        ARGS.start >= ARGS.end):
+    err("--start must be before --end.")
+    sys.exit(-1)
+privacykpis.filters.set_cache_size(ARGS.filter_cache_size)
+privacykpis.filters.load_cache(ARGS.filter_cache)
+
+
+def check_locations(path: str, measurement: Any) -> None:
+    """Exits if tokens in any of the requested locations weren't extracted
+    when the measurement was serialized, since they'd look like they were
+    never sent."""
+    missing = LOCATIONS - measurement.locations
+    if missing:
+        names = privacykpis.serialize.location_names(missing)
+        err(f"{path} has no tokens from {', '.join(names)}, which were not "
+            "extracted when it was serialized.")
+        sys.exit(-1)
+
+
+INDEX = None if ARGS.index is None else TokenIndex(ARGS.index)
+
+
+WINDOW = (None if ARGS.start is None and ARGS.end is None else
+          TimeWindow(ARGS.start, ARGS.end))
+
+
+def tracking_instances(path: str,
+                       measurement: DerivedMeasurement) -> TrackingInstances:
+    # Runs are always indexed in full, whatever the window.
+    window = WINDOW if INDEX is None else None
+    with STATS.timer("tracking_instances"):
+        tracking = measurement.get_tracking_instances(LOCATIONS, window)
+    if INDEX is not None:
+        INDEX.add_run(run_name(path), tracking)
+        if WINDOW is not None:
+            with STATS.timer("window"):
+                tracking = tracking.in_window(WINDOW)
+    return tracking
+
+
+def write_matrix(paths: List[str]) -> None:
+    global LOCATIONS
+    names = [pathlib.Path(path).stem for path in paths]
+    if len(set(names)) != len(names):
+        err("--matrix files must have different names.")
+        sys.exit(-1)
+    if ARGS.pairs is not None and not ARGS.pairs.is_dir():
+        err(f"--pairs must be a directory, got {ARGS.pairs}")
+        sys.exit(-1)
+
+    matrix = ComparisonMatrix()
+    for path, name in zip(paths, names):
+        measurement = DerivedMeasurement(path, not ARGS.no_sidecar,
+                                         ARGS.debug)
+        # By default, every location the first run holds is extracted.
+        if LOCATIONS is None:
+            LOCATIONS = measurement.locations
+        check_locations(path, measurement)
+        tracking = tracking_instances(path, measurement)
+        with STATS.timer("matrix"):
+            matrix.add_run(name, tracking)
+    with STATS.timer("write"):
+        with open(ARGS.output, "w") as handle:
+            matrix.to_json(handle)
+
+    pairs = (itertools.permutations(range(len(names)), 2)
+             if ARGS.pairs is not None else [])
+    for first, second in pairs:
+        prefix = ARGS.pairs / f"{names[first]}--{names[second]}"
+        for suffix, compare in (("", matrix.difference),
+                                (".overlap", matrix.overlap)):
+            with STATS.timer("compare"):
+                result = compare(first, second)
+            with STATS.timer("write"):
+                with open(f"{prefix}{suffix}.{ARGS.format}", "w") as handle:
+                    if ARGS.format == "jsonl":
+                        result.to_jsonl(handle)
+                    else:
+                        result.to_json(handle)
+
+    privacykpis.filters.write_cache(ARGS.filter_cache)
+    if ARGS.debug:
+        print(f"Filter cache: {privacykpis.filters.cache_stats()}")
+    STATS.write(ARGS.stats, "extract")
+
 
+LOCATIONS: Optional[FrozenSet[TokenLocation]] = (
+    None if ARGS.locations is None else frozenset(ARGS.locations))
+if ARGS.matrix is not None:
+    if ARGS.control is not None or ARGS.overlap or ARGS.format == "pickle":
+        err("--control, --overlap and --format pickle can't be used with "
+            "--matrix.")
+        sys.exit(-1)
+    write_matrix(ARGS.matrix)
+    sys.exit(0)
+if ARGS.pairs is not None:
+    err("--pairs can only be used with --matrix.")
+    sys.exit(-1)
 
-MEASURE_GRAPH = pickle.load(INPUT)
-MEASURE_TRACKING = MEASURE_GRAPH.get_tracking_instances()
+MEASURE_GRAPH = DerivedMeasurement(ARGS.input, not ARGS.no_sidecar,
+                                   ARGS.debug)
+# By default, every location the input holds is extracted.
+if LOCATIONS is None:
+    LOCATIONS = MEASURE_GRAPH.locations
+check_locations(ARGS.input, MEASURE_GRAPH)
+MEASURE_TRACKING = tracking_instances(ARGS.input, MEASURE_GRAPH)
 if not ARGS.control:
-    write_output(MEASURE_GRAPH)
+    write_output(MEASURE_TRACKING)
     sys.exit(1)
 
-CONTROL = open(ARGS.control, 'rb')
-CONTROL_GRAPH = pickle.load(CONTROL)
-CONTROL_TRACKING = CONTROL_GRAPH.get_tracking_instances()
+CONTROL_GRAPH = DerivedMeasurement(ARGS.control, not ARGS.no_sidecar,
+                                   ARGS.debug)
+check_locations(ARGS.control, CONTROL_GRAPH)
+CONTROL_TRACKING = tracking_instances(ARGS.control, CONTROL_GRAPH)
 
 RESULT = None
-if ARGS.overlap:
-    RESULT = TrackingInstances.overlap(MEASURE_TRACKING, CONTROL_TRACKING)
-else:
-    RESULT = TrackingInstances.difference(MEASURE_TRACKING, CONTROL_TRACKING)
+with STATS.timer("compare"):
+    if ARGS.overlap:
+        RESULT = TrackingInstances.overlap(MEASURE_TRACKING,
+                                           CONTROL_TRACKING)
+    else:
+        RESULT = TrackingInstances.difference(MEASURE_TRACKING,
+                                              CONTROL_TRACKING)
 
 write_output(RESULT)
 sys.exit(1)
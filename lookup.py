@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+import pathlib
+import sys
+
+import privacykpis.codec
+from privacykpis.common import err
+from privacykpis.tokenindex import TokenIndex
+
+
+PARSER = argparse.ArgumentParser(
+    description="Look up where a token was sent, in a token index written "
+                "by extract.py --index.")
+PARSER.add_argument("--index", required=True, type=pathlib.Path,
+                    help="Path to the token index.")
+PARSER.add_argument("--key", action="store_true", default=False,
+                    help="Look up tokens by key, instead of by value.")
+PARSER.add_argument("--prefix", action="store_true", default=False,
+                    help="Also return tokens whose value (or key, with "
+                         "--key) starts with the given string.")
+PARSER.add_argument("token",
+                    help="The token value (or key) to look up.")
+ARGS = PARSER.parse_args()
+
+if not ARGS.index.is_file():
+    err(f"{ARGS.index} is not a token index.")
+    sys.exit(-1)
+
+INDEX = TokenIndex(ARGS.index)
+privacykpis.codec.dump(INDEX.lookup(ARGS.token, ARGS.prefix, ARGS.key),
+                       sys.stdout)
+INDEX.close()
@@ -3,6 +3,9 @@ import pathlib
 import sys
 from typing import Optional
 
+import privacykpis.timestamps
+from privacykpis.types import EpochMicros, TokenLocation
+
 
 def updateable_path(possible_path: Optional[str]) -> Optional[pathlib.Path]:
     if possible_path is None:
@@ -47,3 +50,20 @@ def writeable_path(possible_path: Optional[str]) -> Optional[pathlib.Path]:
         raise argparse.ArgumentTypeError(e)
 
     return tested_path
+
+
+def token_location(name: str) -> TokenLocation:
+    try:
+        return TokenLocation[name.upper()]
+    except KeyError:
+        names = ", ".join(loc.name for loc in TokenLocation)
+        msg = f"Unknown token location {name}, must be one of {names}"
+        raise argparse.ArgumentTypeError(msg)
+
+
+def timestamp(text: str) -> EpochMicros:
+    try:
+        return privacykpis.timestamps.parse(text)
+    except ValueError:
+        msg = f"Invalid timestamp {text}, expected an ISO 8601 timestamp"
+        raise argparse.ArgumentTypeError(msg)
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import pathlib
+import pickle
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A memoization cache that holds at most max_size entries, evicting the
+    least recently used entry first.
+
+    Hits and misses are counted, so callers can check whether the cache is
+    sized well for their workload, and the cache can be written to (and read
+    back from) disk, so that later runs start warm.
+    """
+    max_size: int
+    entries: "OrderedDict[K, V]"
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: K, compute: Callable[[K], V]) -> V:
+        """Returns the cached value for key, calling compute(key) to fill
+        the cache on a miss."""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            self.put(key, value)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def resize(self, max_size: int) -> None:
+        self.max_size = max_size
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def load(self, path: Optional[pathlib.Path],
+             version: Optional[int] = None) -> bool:
+        """Adds the entries written to path by write() to the cache. If a
+        version is given, the entries are only used if they were written
+        with the same version, so that callers can invalidate caches written
+        by older code."""
+        if path is None or not path.is_file():
+            return False
+        with path.open("rb") as handle:
+            data: Any = pickle.load(handle)
+        if isinstance(data, dict):
+            if data["version"] != version:
+                return False
+            data = data["entries"]
+        elif version is not None:
+            return False
+        for key, value in data:
+            self.put(key, value)
+        return True
+
+    def write(self, path: Optional[pathlib.Path],
+              version: Optional[int] = None) -> bool:
+        if path is None:
+            return False
+        entries = list(self.entries.items())
+        with path.open("wb") as handle:
+            if version is None:
+                pickle.dump(entries, handle)
+            else:
+                pickle.dump({"version": version, "entries": entries}, handle)
+        return True
@@ -0,0 +1,183 @@
+"""JSON encoding and decoding for crawl logs and request bodies.
+
+Uses orjson or ujson when one is installed, since they are several times
+faster than the standard library, and falls back to the standard library's
+json module otherwise. The PRIVACYKPIS_JSON_CODEC environment variable
+("orjson", "ujson" or "json") forces a particular codec.
+
+Every codec decodes a document to the same value the standard library would.
+The faster codecs are stricter in a few places (NaN and Infinity literals,
+lone surrogates, out of range numbers, byte order marks), so documents they
+reject for those reasons are decoded with the standard library instead.
+orjson also decodes integers wider than 64 bits as floats, so unless the
+caller knows the values it reads can't be numbers that large (and passes
+exact_integers=False), documents holding floats that large are decoded again
+with the standard library.
+Decoding errors are always json.JSONDecodeError (or a subclass of it).
+Encoded output is valid JSON whichever codec is used, but whitespace and
+escaping vary.
+"""
+import codecs
+import json
+import os
+import re
+from typing import Any, Callable, Dict, IO, List, Union
+
+
+JSONInput = Union[str, bytes]
+CODEC_ENV_VAR = "PRIVACYKPIS_JSON_CODEC"
+# Smallest float orjson returns for an integer literal it can't fit in 64
+# bits.
+WIDE_INTEGER_MIN = 2.0 ** 63
+
+
+def _has_wide_float(value: Any) -> bool:
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        value_type = type(value)
+        if value_type is dict:
+            stack.extend(value.values())
+        elif value_type is list:
+            stack.extend(value)
+        elif value_type is float and abs(value) >= WIDE_INTEGER_MIN:
+            return True
+    return False
+
+
+# Parts of documents the standard library accepts, but the faster codecs
+# may reject: NaN and Infinity literals, escaped surrogates (which may be
+# lone), and numbers too wide or too large for them. Strings holding these
+# only cost a second decode.
+STDLIB_ONLY = re.compile(
+    r"NaN|Infinity|\\u[dD][89a-fA-F]|[0-9]{19}|[eE][+-]?[0-9]{3}")
+# Given bytes, the standard library also decodes UTF-16 and UTF-32, skips
+# byte order marks, and accepts surrogates encoded as UTF-8.
+STDLIB_ONLY_BYTES = re.compile(
+    STDLIB_ONLY.pattern.encode("ascii") + rb"|\xed[\xa0-\xbf]")
+
+
+def _stdlib_may_accept(data: JSONInput) -> bool:
+    if isinstance(data, bytes):
+        if data.startswith(codecs.BOM_UTF8) or b"\x00" in data[:4]:
+            return True
+        return STDLIB_ONLY_BYTES.search(data) is not None
+    if STDLIB_ONLY.search(data) is not None:
+        return True
+    # Strings with lone surrogates can't be encoded as UTF-8, which orjson
+    # requires.
+    try:
+        data.encode("utf-8")
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+class Codec:
+    name: str
+
+    def __init__(self, name: str, loads: Callable[[JSONInput], Any],
+                 dumps: Callable[[Any], str],
+                 wide_integers_as_floats: bool = False) -> None:
+        self.name = name
+        self._loads = loads
+        self._dumps = dumps
+        self.wide_integers_as_floats = wide_integers_as_floats
+
+    def loads(self, data: JSONInput, exact_integers: bool = True) -> Any:
+        if self._loads is json.loads:
+            return json.loads(data)
+        try:
+            value = self._loads(data)
+        except ValueError:
+            if _stdlib_may_accept(data):
+                return json.loads(data)
+            raise
+        if (exact_integers and self.wide_integers_as_floats and
+                _has_wide_float(value)):
+            return json.loads(data)
+        return value
+
+    def dumps(self, data: Any) -> str:
+        try:
+            return self._dumps(data)
+        except (TypeError, ValueError, OverflowError):
+            return json.dumps(data)
+
+
+def _stdlib_codec() -> Codec:
+    return Codec("json", json.loads, json.dumps)
+
+
+def _orjson_codec() -> Codec:
+    import orjson
+    return Codec("orjson", orjson.loads,
+                 lambda data: orjson.dumps(data).decode("utf-8"),
+                 wide_integers_as_floats=True)
+
+
+def _ujson_codec() -> Codec:
+    import ujson  # type: ignore
+
+    def loads(data: JSONInput) -> Any:
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            # Older versions of ujson raise plain ValueErrors.
+            if isinstance(e, json.JSONDecodeError):
+                raise
+            raise json.JSONDecodeError(str(e), "", 0) from e
+
+    return Codec("ujson", loads,
+                 lambda data: ujson.dumps(data, escape_forward_slashes=False))
+
+
+# In order of preference.
+CODECS: Dict[str, Callable[[], Codec]] = {
+    "orjson": _orjson_codec,
+    "ujson": _ujson_codec,
+    "json": _stdlib_codec,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """Returns the named codec. Raises ImportError if the library it uses
+    isn't installed."""
+    return CODECS[name]()
+
+
+def available_codecs() -> List[str]:
+    names = []
+    for name in CODECS:
+        try:
+            get_codec(name)
+            names.append(name)
+        except ImportError:
+            continue
+    return names
+
+
+def _default_codec() -> Codec:
+    forced_name = os.environ.get(CODEC_ENV_VAR)
+    if forced_name:
+        return get_codec(forced_name)
+    return get_codec(available_codecs()[0])
+
+
+CODEC = _default_codec()
+
+
+def loads(data: JSONInput, exact_integers: bool = True) -> Any:
+    return CODEC.loads(data, exact_integers)
+
+
+def load(handle: IO[Any], exact_integers: bool = True) -> Any:
+    return CODEC.loads(handle.read(), exact_integers)
+
+
+def dumps(data: Any) -> str:
+    return CODEC.dumps(data)
+
+
+def dump(data: Any, handle: IO[str]) -> None:
+    handle.write(CODEC.dumps(data))
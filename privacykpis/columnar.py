@@ -0,0 +1,217 @@
+"""Columnar, memory-mappable storage for the tokens in a measurement.
+
+Every token sent in a request is stored as one row, with the columns in
+COLUMN_TABLES. String valued columns are stored as blocks of integer codes,
+which index into string tables shared by related columns (e.g. both the 1p
+and 3p columns index into the "domains" table). Timestamps are stored as
+int64 epoch microseconds (see privacykpis.timestamps), so that rows can be
+restricted to a time window without decoding anything.
+
+The file starts with MAGIC, followed by the size of a JSON header and the
+header itself, which records where each block lives in the file. Readers
+memory-map the file, so only the pages of the columns (and strings) actually
+used are ever read from disk.
+"""
+import array
+import json
+import mmap
+import pathlib
+import struct
+import sys
+from typing import cast, Any, Dict, List, Literal, Optional, Sequence, Tuple
+from typing import Union
+
+import privacykpis.timestamps
+from privacykpis.types import Domain, EpochMicros, TokenKey, TokenValue, Url
+
+
+MAGIC = b"PKPICOL1"
+# Version 1 files stored timestamps as ISO strings, in a "timestamps" table.
+VERSION = 2
+READABLE_VERSIONS = (1, 2)
+HEADER_SIZE = struct.Struct("<Q")
+ALIGNMENT = 8
+
+COLUMN_TABLES: Dict[str, Optional[str]] = {
+    "1p": "domains",
+    "3p": "domains",
+    "url": "urls",
+    "timestamp": None,
+    "location": None,
+    "key": "tokens",
+    "value": "tokens",
+}
+# The array type codes used, which memoryview.cast() must be given as
+# literals.
+TypeCode = Literal["b", "i", "q"]
+CODE_TYPE: TypeCode = "i"
+# Type codes of the columns that aren't string codes.
+COLUMN_TYPES: Dict[str, TypeCode] = {"location": "b", "timestamp": "q"}
+OFFSET_TYPE: TypeCode = "q"
+STRING_ENCODING = "utf-8"
+STRING_ERRORS = "surrogatepass"
+
+Row = Tuple[Domain, Domain, Url, EpochMicros, int, TokenKey, TokenValue]
+Block = Union["array.array[int]", bytes]
+
+
+def is_columnar(path: Union[str, pathlib.Path]) -> bool:
+    with open(path, "rb") as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+class ColumnarWriter:
+    """Accumulates rows in memory, and writes them out in columnar form.
+
+    metadata is stored as is in the header, and must be JSON serializable.
+    """
+    tables: Dict[str, Dict[str, int]]
+    columns: Dict[str, "array.array[int]"]
+    metadata: Dict[str, Any]
+
+    def __init__(self, metadata: Optional[Dict[str, Any]] = None) -> None:
+        self.tables = {}
+        self.columns = {}
+        self.metadata = {} if metadata is None else metadata
+        for name, table in COLUMN_TABLES.items():
+            type_code = CODE_TYPE if table else COLUMN_TYPES[name]
+            self.columns[name] = array.array(type_code)
+            if table is not None:
+                self.tables[table] = {}
+
+    def _code(self, table: str, value: str) -> int:
+        codes = self.tables[table]
+        try:
+            return codes[value]
+        except KeyError:
+            code = len(codes)
+            codes[value] = code
+            return code
+
+    def add_row(self, row: Row) -> None:
+        for (name, table), value in zip(COLUMN_TABLES.items(), row):
+            if table is None:
+                self.columns[name].append(cast(int, value))
+            else:
+                self.columns[name].append(self._code(table, str(value)))
+
+    def write(self, path: Union[str, pathlib.Path]) -> None:
+        blocks: List[Tuple[str, Block]] = []
+        for name, column in self.columns.items():
+            blocks.append((f"column:{name}", column))
+        for table, codes in self.tables.items():
+            offsets = array.array(OFFSET_TYPE, [0])
+            data = bytearray()
+            for string in codes:
+                data += string.encode(STRING_ENCODING, STRING_ERRORS)
+                offsets.append(len(data))
+            blocks.append((f"offsets:{table}", offsets))
+            blocks.append((f"strings:{table}", bytes(data)))
+
+        header: Dict[str, Any] = {
+            "version": VERSION,
+            "byteorder": sys.byteorder,
+            "rows": len(self.columns["1p"]),
+            "blocks": {},
+            "metadata": self.metadata,
+        }
+        # Block offsets are relative to the end of the header, so that the
+        # header doesn't need to know its own size.
+        position = 0
+        for name, block in blocks:
+            size = len(block) * getattr(block, "itemsize", 1)
+            header["blocks"][name] = [position, size]
+            position += size + (-size % ALIGNMENT)
+
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_bytes += b" " * (-len(header_bytes) % ALIGNMENT)
+        with open(path, "wb") as handle:
+            handle.write(MAGIC)
+            handle.write(HEADER_SIZE.pack(len(header_bytes)))
+            handle.write(header_bytes)
+            for name, block in blocks:
+                raw = block if isinstance(block, bytes) else block.tobytes()
+                handle.write(raw)
+                handle.write(b"\0" * (-len(raw) % ALIGNMENT))
+
+
+class MappedStrings:
+    """A read only string table, decoded lazily out of a memory map.
+
+    Each string is decoded at most once, so that every use of the same
+    code shares a single string object."""
+    offsets: memoryview
+    data: memoryview
+    decoded: List[Optional[str]]
+
+    def __init__(self, offsets: memoryview, data: memoryview) -> None:
+        self.offsets = offsets
+        self.data = data
+        self.decoded = [None] * (len(offsets) - 1)
+
+    def __len__(self) -> int:
+        return len(self.decoded)
+
+    def __getitem__(self, code: int) -> str:
+        string = self.decoded[code]
+        if string is None:
+            start, end = self.offsets[code], self.offsets[code + 1]
+            string = str(self.data[start:end], STRING_ENCODING, STRING_ERRORS)
+            self.decoded[code] = string
+        return string
+
+
+class ColumnarReader:
+    """Memory-maps a file written by ColumnarWriter.
+
+    Nothing is read from the file (beyond its header) until the columns and
+    string tables returned by column() and strings() are indexed into."""
+    header: Dict[str, Any]
+    metadata: Dict[str, Any]
+    num_rows: int
+
+    def __init__(self, path: Union[str, pathlib.Path]) -> None:
+        with open(path, "rb") as handle:
+            self.buffer = mmap.mmap(handle.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a columnar measurement file.")
+        header_start = len(MAGIC) + HEADER_SIZE.size
+        header_size, = HEADER_SIZE.unpack(view[len(MAGIC):header_start])
+        self.data_start = header_start + header_size
+        header_bytes = view[header_start:self.data_start]
+        self.header = json.loads(str(header_bytes, "utf-8"))
+        if self.header["version"] not in READABLE_VERSIONS:
+            raise ValueError(f"Unsupported columnar file version: "
+                             f"{self.header['version']}.")
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a machine with a "
+                             "different byte order.")
+        self.num_rows = self.header["rows"]
+        self.metadata = self.header.get("metadata", {})
+        self.view = view
+
+    def _block(self, name: str) -> memoryview:
+        position, size = self.header["blocks"][name]
+        start = self.data_start + position
+        return self.view[start:start + size]
+
+    def column(self, name: str) -> memoryview:
+        type_code = CODE_TYPE if COLUMN_TABLES[name] else COLUMN_TYPES[name]
+        return self._block(f"column:{name}").cast(type_code)
+
+    def timestamps(self) -> Sequence[EpochMicros]:
+        """Returns the timestamp column. Timestamps in version 1 files are
+        parsed (each distinct one once), and returned as a list."""
+        if self.header["version"] > 1:
+            return self.column("timestamp")
+        codes = self._block("column:timestamp").cast(CODE_TYPE)
+        strings = self.strings("timestamps")
+        parsed = [privacykpis.timestamps.parse(strings[code])
+                  for code in range(len(strings))]
+        return [parsed[code] for code in codes]
+
+    def strings(self, table: str) -> MappedStrings:
+        offsets = self._block(f"offsets:{table}").cast(OFFSET_TYPE)
+        return MappedStrings(offsets, self._block(f"strings:{table}"))
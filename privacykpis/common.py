@@ -2,7 +2,9 @@ import os
 import pathlib
 import platform
 import sys
-from typing import Optional, TYPE_CHECKING
+from typing import Dict, Optional, TYPE_CHECKING
+
+from privacykpis.consts import CODE_PATH
 
 
 def err(msg: str) -> None:
@@ -15,3 +17,14 @@ def get_real_user() -> str:
 
 def is_root() -> bool:
     return os.geteuid() == 0
+
+
+def package_env() -> Dict[str, str]:
+    """Returns a copy of the environment, with the privacykpis package added
+    to PYTHONPATH, for scripts run as child processes (e.g. by mitmdump)."""
+    env = dict(os.environ)
+    paths = [str(CODE_PATH)]
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    return env
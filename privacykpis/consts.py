@@ -6,6 +6,8 @@ THIS_PATH = os.path.realpath(__file__)
 SUPPORTED_BROWSERS = ("safari", "chrome", "firefox")
 # sub-versions of chrome differentiated by profiles and/or profile extensions
 SUPPORTED_SUBCASES = ("ubo", "brave")
+# The repository root, which holds the privacykpis package.
+CODE_PATH = Path(THIS_PATH, "..", "..").resolve()
 RESOURCES_PATH = Path(THIS_PATH, "..", "..", "resources").resolve()
 CERT_PATH = RESOURCES_PATH / Path("certs")
 CHROME_LEAF_CERT = CERT_PATH / Path("mitmproxy-ca.pem")
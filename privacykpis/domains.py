@@ -0,0 +1,45 @@
+"""Shared, cached mapping of hosts to their eTLD+1.
+
+The same hosts show up in nearly every site measured, so eTLD+1 lookups are
+memoized in a single, module-level cache, used by both serialization and
+redirect detection. The cache can be written to disk at the end of a run, and
+loaded again by the next one.
+"""
+import pathlib
+from typing import Dict, Optional
+
+from publicsuffixlist import PublicSuffixList  # type: ignore
+
+from privacykpis.cache import LRUCache
+from privacykpis.stats import STATS
+from privacykpis.types import Domain
+
+
+PSL = PublicSuffixList()
+ETLD_PONE_CACHE_SIZE = 100000
+ETLD_PONES: LRUCache[Optional[str], Optional[Domain]] = LRUCache(
+    ETLD_PONE_CACHE_SIZE)
+STATS.add_cache("etld_pone", ETLD_PONES.stats)
+# Only cache misses reach the public suffix list, so only they're timed.
+PSL_TIMER = STATS.timer("psl_lookup")
+
+
+def _lookup_etld_pone(host: Optional[str]) -> Optional[Domain]:
+    with PSL_TIMER:
+        return PSL.privatesuffix(host)  # type: ignore
+
+
+def etld_pone(host: Optional[str]) -> Optional[Domain]:
+    return ETLD_PONES.get(host, _lookup_etld_pone)
+
+
+def load_cache(path: Optional[pathlib.Path]) -> bool:
+    return ETLD_PONES.load(path)
+
+
+def write_cache(path: Optional[pathlib.Path]) -> bool:
+    return ETLD_PONES.write(path)
+
+
+def cache_stats() -> Dict[str, int]:
+    return ETLD_PONES.stats()
@@ -1,16 +1,134 @@
 import datetime
 import mimetypes
-from typing import Union
+import pathlib
+import posixpath
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set
+from typing import Tuple, Union
 
 import calendar
 import dateutil.parser
 
+from privacykpis.cache import LRUCache
+from privacykpis.stats import STATS
+
+
+FILTER_CACHE_SIZE = 500000
+# Bump this whenever a change to the filters could change a verdict, so that
+# verdicts cached (and written to disk) by older versions are discarded.
+FILTERS_VERSION = 1
+# Maps token values to whether they should be ignored. The same values are
+# sent over and over (e.g. the same cookie, on every page of every site), so
+# most verdicts are cache hits.
+VERDICTS: LRUCache[str, bool] = LRUCache(FILTER_CACHE_SIZE)
+STATS.add_cache("filter_verdicts", VERDICTS.stats)
+
+
+def _dateutil_words(word_lists: Iterable[Sequence[Union[str, Tuple[str, ...]]]]
+                    ) -> FrozenSet[str]:
+    words: Set[str] = set()
+    for word_list in word_lists:
+        for entry in word_list:
+            if isinstance(entry, tuple):
+                words.update(word.lower() for word in entry)
+            else:
+                words.add(entry.lower())
+    return frozenset(words)
+
+
+# dateutil splits strings into runs of letters, runs of digits, and single
+# other characters, and fails to parse any string with a run of letters that
+# isn't one of these words (compared case-insensitively), doesn't parse as a
+# float ("inf", "nan", etc.), and couldn't be a timezone name (five or fewer
+# upper case letters).
+#
+# The only exception is "<month> of <anything>", so strings with "of" in
+# them always go to dateutil.
+_PARSER_INFO = dateutil.parser.parserinfo
+DATEUTIL_WORDS = _dateutil_words([
+    _PARSER_INFO.JUMP, _PARSER_INFO.WEEKDAYS, _PARSER_INFO.MONTHS,
+    _PARSER_INFO.HMS, _PARSER_INFO.AMPM, _PARSER_INFO.UTCZONE,
+    _PARSER_INFO.PERTAIN, ["inf", "infinity", "nan"]])
+DATEUTIL_PERTAIN_WORDS = _dateutil_words([_PARSER_INFO.PERTAIN])
+MAX_TIMEZONE_NAME_LENGTH = 5
+LETTER_RUNS = re.compile("[A-Za-z]+")
+
+# Common formats that dateutil always accepts, as long as the fields make a
+# valid date (checked by building a datetime from them).
+ISO_DATETIME = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})"
+    r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d{1,6})?)?"
+    r"(?:Z|[+-](?:[01]\d|2[0-3]):?[0-5]\d)?)?")
+RFC_DATETIME = re.compile(
+    r"(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), )?(\d{1,2}) "
+    r"(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) (\d{4}) "
+    r"(\d{2}):(\d{2}):(\d{2}) (?:GMT|UTC|[+-](?:[01]\d|2[0-3])[0-5]\d)")
+RFC_MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+              "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+# dateutil reads runs of 12 or 14 digits as YYYYMMDDhhmm[ss], and other runs
+# of MIN_DIGIT_RUN or more digits as no date at all.
+MIN_DIGIT_RUN = 11
+COMPACT_DATETIME_LENGTHS = (12, 14)
+
+
+def _is_valid_datetime(year: str, month: Union[str, int], day: str,
+                       hour: Optional[str], minute: Optional[str],
+                       second: Optional[str]) -> bool:
+    try:
+        datetime.datetime(int(year), int(month), int(day), int(hour or 0),
+                          int(minute or 0), int(second or 0))
+        return True
+    except ValueError:
+        return False
+
+
+def classify_datetime(token: str) -> Optional[bool]:
+    """Returns whether dateutil would parse token as a date, if that can be
+    told without calling dateutil, and None otherwise."""
+    if not token.isascii():
+        return None
+
+    match = ISO_DATETIME.fullmatch(token)
+    if match is not None:
+        return _is_valid_datetime(*match.groups()) or None
+    match = RFC_DATETIME.fullmatch(token)
+    if match is not None:
+        day, month, year, hour, minute, second = match.groups()
+        return _is_valid_datetime(year, RFC_MONTHS[month], day, hour, minute,
+                                  second) or None
+    if len(token) >= MIN_DIGIT_RUN and token.isdigit():
+        if len(token) not in COMPACT_DATETIME_LENGTHS:
+            return False
+        return _is_valid_datetime(token[:4], token[4:6], token[6:8],
+                                  token[8:10], token[10:12],
+                                  token[12:14] or None)
+
+    # dateutil skips over NUL characters.
+    if "\x00" in token:
+        token = token.replace("\x00", "")
+    runs = LETTER_RUNS.findall(token)
+    if not runs:
+        return None
+    lowered_runs = [run.lower() for run in runs]
+    if not DATEUTIL_PERTAIN_WORDS.isdisjoint(lowered_runs):
+        return None
+    for run, lowered_run in zip(runs, lowered_runs):
+        if lowered_run in DATEUTIL_WORDS:
+            continue
+        if len(run) <= MAX_TIMEZONE_NAME_LENGTH and run.isupper():
+            continue
+        return False
+    return None
+
 
 def is_datetime(token: str) -> bool:
     if len(token) < 10:
         return False
 
     if isinstance(token, str):
+        verdict = classify_datetime(token)
+        if verdict is not None:
+            return verdict
         try:
             dateutil.parser.parse(token, ignoretz=True)
             return True
@@ -44,27 +162,81 @@ def is_datetime(token: str) -> bool:
     return False
 
 
-def is_short(token: str, min_length: int = 11) -> bool:
+MIN_TOKEN_LENGTH = 11
+URL_PREFIXES = ("http://", "https://")
+# The (lower case) file extensions mimetypes knows a type for. guess_type()
+# also reads the system's type files, so they're read up front too.
+mimetypes.init()
+FILE_EXTENSIONS = frozenset(mimetypes.types_map)
+
+
+def is_short(token: str, min_length: int = MIN_TOKEN_LENGTH) -> bool:
     token_str = token if isinstance(token, str) else str(token)
     return len(token_str) < min_length
 
 
 def is_url(token: str) -> bool:
-    return token.startswith("http://") or token.startswith("https://")
+    return token.startswith(URL_PREFIXES)
 
 
 def is_filename(token: str) -> bool:
-    (mimetype, _) = mimetypes.guess_type(token)
-    return mimetype is not None
+    # mimetypes.guess_type treats anything before a colon as a URL scheme,
+    # and some extensions (".tgz", ".gz", etc.) as aliases or encodings, so
+    # only other extensions are looked up in FILE_EXTENSIONS.
+    if ":" in token:
+        return mimetypes.guess_type(token)[0] is not None
+    extension = posixpath.splitext(token)[1]
+    lowered = extension.lower()
+    if (lowered in mimetypes.suffix_map or
+            extension in mimetypes.encodings_map):
+        return mimetypes.guess_type(token)[0] is not None
+    return lowered in FILE_EXTENSIONS
 
 
 def should_ignore_token(token: str) -> bool:
-    if is_datetime(token):
+    if len(token) < MIN_TOKEN_LENGTH or token.startswith(URL_PREFIXES):
         return True
+    return VERDICTS.get(token, _should_ignore_token)
+
+
+def should_ignore_tokens(tokens: Sequence[str]) -> List[bool]:
+    """Returns, for each token, whether it should be ignored (see
+    should_ignore_token).
+
+    Each distinct token is only checked once, and the mask is then built
+    with a single dict lookup per token."""
+    verdicts = dict.fromkeys(tokens, True)
+    for token in verdicts:
+        if len(token) < MIN_TOKEN_LENGTH or token.startswith(URL_PREFIXES):
+            continue
+        verdicts[token] = VERDICTS.get(token, _should_ignore_token)
+    return list(map(verdicts.__getitem__, tokens))
+
+
+def _should_ignore_token(token: str) -> bool:
+    # The cheapest checks come first.
     if is_short(token):
         return True
     if is_url(token):
         return True
     if is_filename(token):
         return True
+    if is_datetime(token):
+        return True
     return False
+
+
+def set_cache_size(max_size: int) -> None:
+    VERDICTS.resize(max_size)
+
+
+def load_cache(path: Optional[pathlib.Path]) -> bool:
+    return VERDICTS.load(path, FILTERS_VERSION)
+
+
+def write_cache(path: Optional[pathlib.Path]) -> bool:
+    return VERDICTS.write(path, FILTERS_VERSION)
+
+
+def cache_stats() -> Dict[str, int]:
+    return VERDICTS.stats()
@@ -0,0 +1,61 @@
+from typing import Dict, List, Optional
+
+from privacykpis.types import InternedKeyValueList, KeyValueList, StringId
+
+
+class StringTable:
+    """Maps strings (token keys and values, domains, etc.) to dense integer
+    ids, so that each distinct string is only held in memory once, and
+    everything else can refer to it by id.
+
+    Ids are only meaningful for the table that handed them out; use merge()
+    or id() to translate ids between tables.
+    """
+    ids: Dict[str, StringId]
+    strings: List[str]
+
+    def __init__(self) -> None:
+        self.ids = {}
+        self.strings = []
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+    def __getstate__(self) -> List[str]:
+        # The id lookup table is rebuilt on load, which keeps pickles small.
+        return self.strings
+
+    def __setstate__(self, strings: List[str]) -> None:
+        self.strings = strings
+        self.ids = {string: i for i, string in enumerate(strings)}
+
+    def intern(self, string: str) -> StringId:
+        try:
+            return self.ids[string]
+        except KeyError:
+            string_id = len(self.strings)
+            self.ids[string] = string_id
+            self.strings.append(string)
+            return string_id
+
+    def id(self, string: str) -> Optional[StringId]:
+        """Returns the id of the given string, without adding it to the table
+        if it's not already present."""
+        return self.ids.get(string)
+
+    def string(self, string_id: StringId) -> str:
+        return self.strings[string_id]
+
+    def intern_pairs(self, kvs: Optional[KeyValueList]
+                     ) -> Optional[InternedKeyValueList]:
+        if kvs is None:
+            return None
+        return [(self.intern(key), self.intern(value)) for key, value in kvs]
+
+    def merge(self, other: "StringTable") -> List[StringId]:
+        """Adds every string in other to this table, and returns a list
+        mapping each id in other to the id of the same string in this
+        table."""
+        if other is self:
+            return list(range(len(self.strings)))
+        return [self.intern(string) for string in other.strings]
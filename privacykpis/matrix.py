@@ -0,0 +1,106 @@
+"""Compares every pair of a set of measurements in a single pass.
+
+Each measurement's tracking instances are folded into one shared string
+table, so that ids mean the same thing in every run. Any pairwise difference
+or overlap is then a set operation on the two runs' token dicts, with no id
+translation, and each token's presence across all runs is a bitmask (an int
+with bit i set if run i saw the token sent to the third party).
+"""
+import collections
+import json
+from typing import Any, Dict, List
+
+from privacykpis.interning import StringTable
+from privacykpis.serialize import SketchedTrackingInstances, TrackingInstances
+from privacykpis.types import InternedToken, StringId, TokenLocation
+
+
+class ComparisonMatrix:
+    names: List[str]
+    strings: StringTable
+    runs: List[TrackingInstances]
+    # Maps each third party, and token sent to it, to the runs that saw it.
+    presence: Dict[StringId, Dict[InternedToken, int]]
+
+    def __init__(self) -> None:
+        self.names = []
+        self.strings = StringTable()
+        self.runs = []
+        self.presence = {}
+
+    def add_run(self, name: str, instances: TrackingInstances) -> None:
+        """Adds a run to the matrix. instances is not modified, and can be
+        discarded once added."""
+        bit = 1 << len(self.runs)
+        run: TrackingInstances
+        if isinstance(instances, SketchedTrackingInstances):
+            # Tokens that haven't passed the sketch threshold are never
+            # reported, but were still seen, so comparisons against the run
+            # must see them too.
+            run = SketchedTrackingInstances(instances.threshold, self.strings)
+        else:
+            run = TrackingInstances(self.strings)
+        run.merge(instances)
+        for three_p, tokens_for_three_p in run.token_sets(
+                self.strings).items():
+            presence = self.presence.setdefault(three_p, {})
+            for token in tokens_for_three_p:
+                presence[token] = presence.get(token, 0) | bit
+        self.names.append(name)
+        self.runs.append(run)
+
+    def difference(self, first: int, second: int) -> TrackingInstances:
+        """Same as TrackingInstances.difference, for the runs at the given
+        indexes."""
+        return TrackingInstances.difference(self.runs[first],
+                                            self.runs[second])
+
+    def overlap(self, first: int, second: int) -> TrackingInstances:
+        """Same as TrackingInstances.overlap, for the runs at the given
+        indexes."""
+        return TrackingInstances.overlap(self.runs[first], self.runs[second])
+
+    def counts(self) -> Dict[str, List[List[int]]]:
+        """Returns the number of tokens in the JSON report of the difference
+        and overlap of each pair of runs (those sent to a third party from
+        more than one first party, in the first run of the pair)."""
+        num_runs = len(self.runs)
+        difference = [[0] * num_runs for _ in range(num_runs)]
+        overlap = [[0] * num_runs for _ in range(num_runs)]
+        for first, run in enumerate(self.runs):
+            # Tokens seen by the same runs are counted together.
+            masks: Dict[int, int] = collections.Counter(
+                self.presence[three_p][token]
+                for three_p, tokens_for_three_p in run.token_collection.items()
+                for token, first_ps in tokens_for_three_p.items()
+                if len(first_ps) > 1)
+            for mask, count in masks.items():
+                for second in range(num_runs):
+                    if first == second:
+                        continue
+                    if mask >> second & 1:
+                        overlap[first][second] += count
+                    else:
+                        difference[first][second] += count
+        return {"difference": difference, "overlap": overlap}
+
+    def to_json(self, handle: Any) -> None:
+        """Writes the runs compared, the counts() matrices, and the runs
+        each token was seen in, for every token reported for at least one
+        run."""
+        string = self.strings.string
+        tokens: Dict[str, Dict[str, List[int]]] = {}
+        for run in self.runs:
+            for three_p, tokens_for_three_p in run.token_collection.items():
+                presence = self.presence[three_p]
+                for token, first_ps in tokens_for_three_p.items():
+                    if len(first_ps) < 2:
+                        continue
+                    loc, key, value = token
+                    loc_name = TokenLocation.from_int(loc).name
+                    token_str = f"{loc_name}::{string(key)}::{string(value)}"
+                    mask = presence[token]
+                    tokens.setdefault(string(three_p), {})[token_str] = [
+                        mask >> index & 1 for index in range(len(self.runs))]
+        json.dump({"runs": self.names, **self.counts(), "tokens": tokens},
+                  handle)
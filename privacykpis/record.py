@@ -148,8 +148,9 @@ def _setup_proxy_for_url(args: Args) -> Optional[SubProc]:
     if args.debug:
         print("starting proxy: " + " ".join(mitmdump_args))
 
-    proxy_handle = subprocess.Popen(mitmdump_args, stderr=None,
-                                    universal_newlines=True)
+    proxy_handle = subprocess.Popen(
+        mitmdump_args, stderr=None, universal_newlines=True,
+        env=privacykpis.common.package_env())
     if args.debug:
         print("Waiting 5 sec for mitmproxy to spin up...")
     time.sleep(5)
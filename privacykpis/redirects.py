@@ -1,14 +1,14 @@
 import pathlib
 import pickle
 from typing import Dict, Optional
-from urllib.parse import urlparse
+from urllib.parse import urlparse, ParseResult
 
-from publicsuffixlist import PublicSuffixList  # type: ignore
 import requests
 import requests.exceptions
 
+from privacykpis.domains import etld_pone
+
 
-PSL = PublicSuffixList()
 CHROME_UA = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) "
              "AppleWebKit/537.36 (KHTML, like Gecko) "
              "Chrome/84.0.4147.85 "
@@ -22,34 +22,41 @@ class RedirectCache:
 
     def __init__(self, path: Optional[pathlib.Path]) -> None:
         self.cache = {}
+        self.path = path
 
-        if path is None:
+        if self.path is None:
             return
 
-        self.path = path
         if self.path.is_file():
             with self.path.open('rb') as handle:
                 self.cache = pickle.load(handle)
 
-    def is_redirect(self, url: str) -> bool:
-        netloc = urlparse(url).netloc
+    def is_redirect(self, url: str,
+                    parsed_url: Optional[ParseResult] = None) -> bool:
+        if parsed_url is None:
+            parsed_url = urlparse(url)
+        netloc = parsed_url.netloc
 
         try:
             return self.cache[netloc]
         except KeyError:
             pass
 
-        all_same_etldp1 = self.is_all_same_etldp1_in_request_chain(url)
+        all_same_etldp1 = self.is_all_same_etldp1_in_request_chain(
+            url, parsed_url)
         was_redirected = not all_same_etldp1
         self.cache[netloc] = was_redirected
         return was_redirected
 
-    def is_all_same_etldp1_in_request_chain(self, url: str) -> bool:
+    def is_all_same_etldp1_in_request_chain(
+            self, url: str, parsed_url: Optional[ParseResult] = None) -> bool:
+        if parsed_url is None:
+            parsed_url = urlparse(url)
         try:
-            etldp1 = PSL.privatesuffix(urlparse(url).netloc)
+            etldp1 = etld_pone(parsed_url.netloc)
             rs = requests.get(url, headers=CHROME_HEADERS, timeout=5)
             for r in rs.history:
-                request_etldp1 = PSL.privatesuffix(urlparse(r.url).netloc)
+                request_etldp1 = etld_pone(urlparse(r.url).netloc)
                 if request_etldp1 != etldp1:
                     return False
             return True
@@ -58,6 +65,9 @@ class RedirectCache:
             # a redirection chain, assume it is.
             return False
 
+    def update(self, other: "RedirectCache") -> None:
+        self.cache.update(other.cache)
+
     def write(self) -> bool:
         if self.path:
             with self.path.open('wb') as handle:
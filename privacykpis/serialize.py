@@ -1,30 +1,66 @@
 import argparse
 import datetime
+import itertools
 import json
+import multiprocessing
+import os
 import pathlib
 import pickle
 import sys
-from typing import cast, Any, Dict, Iterable, List, Optional, Tuple
+from typing import cast, AbstractSet, Any, Dict, FrozenSet, Iterable, List
+from typing import Optional, Tuple, Union
 from urllib.parse import urlparse
 
 import networkx  # type: ignore
 from networkx import MultiDiGraph
-from publicsuffixlist import PublicSuffixList  # type: ignore
 
 import privacykpis.args
+import privacykpis.codec
+from privacykpis.codec import JSONInput
+from privacykpis.columnar import ColumnarReader, ColumnarWriter, Row
+from privacykpis.columnar import is_columnar
+from privacykpis.common import err
 from privacykpis.consts import TIMESTAMP, URL, REQUESTED_ETLD1, SITE
+import privacykpis.domains
+from privacykpis.interning import StringTable
 from privacykpis.redirects import RedirectCache
+from privacykpis.stats import STATS, Snapshot, token_counter
+import privacykpis.filters
+from privacykpis.sketch import FirstPartySketch, SPARSE_LIMIT, domain_hash
+from privacykpis.timestamps import TimeWindow, epoch_micros, isoformat
+import privacykpis.timestamps
+import privacykpis.tokencache
 import privacykpis.tokenizing
 from privacykpis.types import Domain, ThirdPartyDomain, FirstPartyDomain, Token
 from privacykpis.types import TokenLocation, ISOTimestamp, RequestTimestamp
+from privacykpis.types import InternedToken, StringId
 
 
-PSL = PublicSuffixList()
-
+# Every field of a record that's read is a string, so records can be
+# decoded without checking for wide integers (see privacykpis.codec).
 RawRecord = Dict[str, Any]
-FirstPartyIdentifications = Dict[FirstPartyDomain, List[RequestTimestamp]]
-TokenIdentifications = Dict[Token, FirstPartyIdentifications]
-TrackingTokenCollection = Dict[ThirdPartyDomain, TokenIdentifications]
+# Domains and tokens are stored as ids in the StringTable of the
+# TrackingInstances that holds them.
+FirstPartyIdentifications = Dict[StringId, List[RequestTimestamp]]
+TokenIdentifications = Dict[InternedToken, FirstPartyIdentifications]
+TrackingTokenCollection = Dict[StringId, TokenIdentifications]
+
+Locations = FrozenSet[TokenLocation]
+# A token that hasn't been sent from enough first parties to be kept in full
+# yet (see SketchedTrackingInstances). Tokens sent from a single first party
+# so far are only held as the first request they were sent in from it.
+FirstRequest = Tuple[StringId, RequestTimestamp]
+PendingToken = Union[FirstRequest, FirstPartySketch]
+
+# Number of input documents handed to a worker process at a time, when
+# serializing with more than one job.
+PARALLEL_CHUNK_SIZE = 64
+
+DECODE_TIMER = STATS.timer("decode")
+REDIRECT_TIMER = STATS.timer("redirect_check")
+GRAPH_TIMER = STATS.timer("graph_insert")
+TRACKING_TIMER = STATS.timer("tracking_insert")
+FILTER_TIMER = STATS.timer("filter")
 
 
 class Args(privacykpis.args.Args):
@@ -36,6 +72,49 @@ class Args(privacykpis.args.Args):
         self.output = args.output
         self.debug = args.debug
         self.redirect_cache_path = args.redirect_cache
+        self.stream = args.stream
+        self.format = args.format
+        self.jobs = args.jobs
+        self.etld_cache_path = args.etld_cache
+        self.resume = args.resume
+        self.checkpoint_every = args.checkpoint_every
+        self.stats_path = args.stats
+        self.filter_cache_path = args.filter_cache
+        self.filter_cache_size = args.filter_cache_size
+        self.max_body_size = args.max_body_size
+        self.token_cache_path = args.token_cache
+        self.token_cache_size = args.token_cache_size
+        self.locations = frozenset(args.locations)
+        self.sketch_threshold = args.sketch_threshold if args.sketch else None
+        if self.output.exists() and not self.resume:
+            err(f"cannot write to {self.output}, file already exists")
+            self.is_valid = False
+        if self.resume and self.format != "pickle":
+            err("--resume can only be used with the pickle format")
+            self.is_valid = False
+        if self.jobs < 1:
+            err(f"--jobs must be at least 1, got {self.jobs}")
+            self.is_valid = False
+        if self.filter_cache_size < 0:
+            err("--filter-cache-size must not be negative, got "
+                f"{self.filter_cache_size}")
+            self.is_valid = False
+        if self.max_body_size < 0:
+            err("--max-body-size must not be negative, got "
+                f"{self.max_body_size}")
+            self.is_valid = False
+        if self.token_cache_size < 0:
+            err("--token-cache-size must not be negative, got "
+                f"{self.token_cache_size}")
+            self.is_valid = False
+        if args.sketch and not (self.stream and self.format == "pickle"):
+            err("--sketch can only be used with --stream, and the pickle "
+                "format")
+            self.is_valid = False
+        if args.sketch_threshold < 2:
+            err("--sketch-threshold must be at least 2, got "
+                f"{args.sketch_threshold}")
+            self.is_valid = False
 
 
 class SiteMeasurement:
@@ -47,103 +126,263 @@ class SiteMeasurement:
         self.end_timestamp = datetime.datetime.fromisoformat(record["end"])
         self.url = record[URL]
         self.parsed_url = urlparse(record[URL])
-        self.etld_pone = PSL.privatesuffix(self.parsed_url.hostname)
-        self.records = [Request(r) for r in record["requests"]]
+        self.etld_pone = privacykpis.domains.etld_pone(
+            self.parsed_url.hostname)
+        self.records = [Request(r, self.etld_pone) for r in record["requests"]]
         self.debug = debug
         self.redirect_cache = redirect_cache
+        STATS.count("documents")
+        STATS.count("requests", len(self.records))
 
-    def add_to_graph(self, graph: MultiDiGraph) -> None:
-        if self.redirect_cache.is_redirect(self.url):
+    def is_redirect(self) -> bool:
+        with REDIRECT_TIMER:
+            is_redirect = self.redirect_cache.is_redirect(self.url,
+                                                          self.parsed_url)
+        if is_redirect:
+            STATS.count("documents.redirected")
             if self.debug:
                 print(f"Skipping {self.url}, looks like it redirects.")
+            return True
+        return False
+
+    def add_to_graph(self, graph: MultiDiGraph, strings: StringTable) -> None:
+        if self.is_redirect():
+            return
+        with GRAPH_TIMER:
+            graph.add_node(strings.intern(self.url), type=SITE)
+        for record in self.records:
+            record.add_to_graph(self, graph, strings)
+
+    def add_to_tracking_instances(self,
+                                  instances: "TrackingInstances") -> None:
+        if self.is_redirect():
             return
-        graph.add_node(self.url, type=SITE)
         for record in self.records:
-            record.add_to_graph(self, graph)
+            record.add_to_tracking_instances(self, instances)
 
 
 class Request:
     """Represents a single request made by the browser.
 
+    Requests are only tokenized once they're known to be sent to a
+    different eTLD+1 than the site's (same party requests are never checked
+    for identifiers). Same party requests have no tokens at all.
+
     Args:
     record -- a request, as recorded by record.py
+    site_etld_pone -- the eTLD+1 of the site the request was made from
     """
-    def __init__(self, record: RawRecord) -> None:
-        tokens = privacykpis.tokenizing.from_record(record)
-        self.cookie_tokens = tokens.cookies
-        self.path_tokens = tokens.path
-        self.query_tokens = tokens.query
-        self.body_tokens = tokens.body
-        self.body_encoding = tokens.body_encoding
+    record: Optional[RawRecord]
+    tokens: Optional[privacykpis.tokenizing.RecordParseResult]
+
+    def __init__(self, record: RawRecord,
+                 site_etld_pone: Optional[Domain] = None) -> None:
         self.parsed_url = urlparse(record[URL])
         self.url = record[URL]
-        self.etld_pone = PSL.privatesuffix(self.parsed_url.hostname)
-        self.timestamp = datetime.datetime.fromisoformat(record["time"])
+        self.etld_pone = privacykpis.domains.etld_pone(
+            self.parsed_url.hostname)
+        self.timestamp = privacykpis.timestamps.parse(record["time"])
+        self.is_same_party = self.etld_pone == site_etld_pone
+        self.record = record
+        self.tokens = None
 
-    def add_to_graph(self, site: SiteMeasurement, graph: MultiDiGraph) -> None:
-        graph.add_node(self.etld_pone, type=REQUESTED_ETLD1)
-        graph.add_edge(site.etld_pone, self.etld_pone, **{
+    def tokenize(self) -> privacykpis.tokenizing.RecordParseResult:
+        if self.tokens is not None:
+            return self.tokens
+        if self.is_same_party or self.record is None:
+            self.tokens = privacykpis.tokenizing.RecordParseResult()
+        else:
+            self.tokens = privacykpis.tokencache.from_record(self.record,
+                                                             self.parsed_url)
+        # Nothing else is needed from the raw record.
+        self.record = None
+        return self.tokens
+
+    def edge_data(self, strings: Optional[StringTable] = None
+                  ) -> Dict[str, Any]:
+        """Returns the request as graph edge data. If strings is given, token
+        keys and values are replaced with their ids in that table."""
+        intern = (lambda kvs: kvs) if strings is None else strings.intern_pairs
+        tokens = self.tokenize()
+        return {
             URL: self.url,
-            TIMESTAMP: self.timestamp.isoformat(),
-            TokenLocation.COOKIE.name: self.cookie_tokens,
-            TokenLocation.PATH.name: self.path_tokens,
-            TokenLocation.QUERY_PARAM.name: self.query_tokens,
-            TokenLocation.BODY.name: self.body_tokens,
-        })
+            TIMESTAMP: self.timestamp,
+            TokenLocation.COOKIE.name: intern(tokens.cookies),
+            TokenLocation.PATH.name: intern(tokens.path),
+            TokenLocation.QUERY_PARAM.name: intern(tokens.query),
+            TokenLocation.BODY.name: intern(tokens.body),
+        }
+
+    def add_to_graph(self, site: SiteMeasurement, graph: MultiDiGraph,
+                     strings: StringTable) -> None:
+        # Requests to or from hosts with no eTLD+1 (like localhost) can't be
+        # attributed to a party.
+        if self.etld_pone is None or site.etld_pone is None:
+            STATS.count("requests.no_etld_pone")
+            return
+        edge_data = self.edge_data(strings)
+        with GRAPH_TIMER:
+            etld_pone = strings.intern(self.etld_pone)
+            graph.add_node(etld_pone, type=REQUESTED_ETLD1)
+            graph.add_edge(strings.intern(site.etld_pone), etld_pone,
+                           **edge_data)
+
+    def add_to_tracking_instances(self, site: SiteMeasurement,
+                                  instances: "TrackingInstances") -> None:
+        # Ignore same party requests.
+        if site.etld_pone == self.etld_pone:
+            return
+        if self.etld_pone is None or site.etld_pone is None:
+            STATS.count("requests.no_etld_pone")
+            return
+        STATS.count("requests.cross_party")
+
+        # Only intern the tokens that make it through the filters, so that
+        # one-off values (cache busters, etc.) aren't kept around.
+        data = self.edge_data()
+        tokens = privacykpis.tokenizing.flaten_identifiers(data)
+        if len(tokens) == 0:
+            return
+
+        with TRACKING_TIMER:
+            strings = instances.strings
+            interned_tokens = [
+                (loc, strings.intern(key), strings.intern(value))
+                for loc, key, value in tokens]
+            request_ts = (data[URL], self.timestamp)
+            instances.add_request(strings.intern(site.etld_pone),
+                                  strings.intern(self.etld_pone),
+                                  interned_tokens, request_ts)
+
+
+def _subset(tokens: TokenIdentifications,
+            subset: AbstractSet[InternedToken]) -> TokenIdentifications:
+    """Returns the identifications of the tokens in subset, in the same
+    order as in tokens."""
+    if len(subset) == len(tokens):
+        return tokens
+    return dict(itertools.compress(tokens.items(),
+                                   map(subset.__contains__, tokens)))
 
 
 class TrackingInstances:
+    """Which tokens were sent to each third party, from which first parties.
+
+    Domains, token keys and token values are stored as ids in the strings
+    table, and only turned back into strings when written out as JSON.
+    """
     token_collection: TrackingTokenCollection = {}
+    strings: StringTable
 
     @staticmethod
-    def difference(first: "TrackingInstances",
-                   second: "TrackingInstances") -> "TrackingInstances":
-        unique = TrackingInstances()
+    def difference(first: "TrackingInstances", second: "TrackingInstances",
+                   window: Optional[TimeWindow] = None
+                   ) -> "TrackingInstances":
+        """Returns the tokens first saw sent to each third party, that
+        second never saw sent to the same third party (in requests made in
+        window, if given)."""
+        if window is not None:
+            first, second = first.in_window(window), second.in_window(window)
+        unique = TrackingInstances(first.strings)
+        second_tokens = second.token_sets(first.strings)
         for three_p, tokens_for_three_p in first.token_collection.items():
-            if not second.has_third_party(three_p):
-                unique.add_third_party_ids(three_p, tokens_for_three_p)
+            if three_p not in second_tokens:
+                unique.token_collection[three_p] = tokens_for_three_p
                 continue
-
-            for token, first_ps, in tokens_for_three_p.items():
-                if second.has_token(three_p, token) is True:
-                    continue
-                unique.add_ids_for_token(three_p, token, first_ps)
+            unseen = tokens_for_three_p.keys() - second_tokens[three_p]
+            if unseen:
+                unique.token_collection[three_p] = _subset(tokens_for_three_p,
+                                                           unseen)
         return unique
 
     @staticmethod
-    def overlap(first: "TrackingInstances",
-                second: "TrackingInstances") -> "TrackingInstances":
-        overlap = TrackingInstances()
+    def overlap(first: "TrackingInstances", second: "TrackingInstances",
+                window: Optional[TimeWindow] = None) -> "TrackingInstances":
+        """Returns the tokens first saw sent to each third party, that
+        second also saw sent to the same third party (in requests made in
+        window, if given)."""
+        if window is not None:
+            first, second = first.in_window(window), second.in_window(window)
+        overlap = TrackingInstances(first.strings)
+        second_tokens = second.token_sets(first.strings)
         for three_p, tokens_for_three_p in first.token_collection.items():
-            if not second.has_third_party(three_p):
+            if three_p not in second_tokens:
                 continue
-            for token, first_ps, in tokens_for_three_p.items():
-                if not second.has_token(three_p, token):
-                    continue
-                overlap.add_ids_for_token(three_p, token, first_ps)
+            seen = tokens_for_three_p.keys() & second_tokens[three_p]
+            if seen:
+                overlap.token_collection[three_p] = _subset(
+                    tokens_for_three_p, seen)
         return overlap
 
-    def __init__(self) -> None:
+    def __init__(self, strings: Optional[StringTable] = None) -> None:
         self.token_collection = {}
+        self.strings = StringTable() if strings is None else strings
 
-    def to_json(self, handle: Any) -> None:
-        report: Dict[Any, Any] = {}
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # Collections pickled before timestamps were integers hold them as
+        # ISO strings.
+        timestamps = (timestamp for tokens in self.token_collection.values()
+                      for first_ps in tokens.values()
+                      for requests in first_ps.values()
+                      for _, timestamp in requests)
+        if isinstance(next(timestamps, None), str):
+            self._parse_timestamps()
+
+    def _parse_timestamps(self) -> None:
+        for tokens_for_three_p in self.token_collection.values():
+            for first_ps in tokens_for_three_p.values():
+                for first_p, requests in first_ps.items():
+                    first_ps[first_p] = [(url, epoch_micros(timestamp))
+                                         for url, timestamp in requests]
+
+    def reports(self) -> Iterable[Tuple[str, Dict[str, Any]]]:
+        """Yields each third party, and the report of the tokens sent to it
+        from more than one first party, one third party at a time.
+
+        Third parties with no such tokens are skipped."""
+        string = self.strings.string
         for three_p, tokens_for_three_p in self.token_collection.items():
+            report: Dict[str, Any] = {}
             for token, first_ps, in tokens_for_three_p.items():
                 if len(first_ps) < 2:
                     continue
-                if three_p not in report:
-                    report[three_p] = {}
                 loc, key, value = token
-                loc_name = TokenLocation.from_int(cast(int, loc)).name
-                report[three_p][f"{loc_name}::{key}::{value}"] = first_ps
-        json.dump(report, handle)
+                loc_name = TokenLocation.from_int(loc).name
+                token_str = f"{loc_name}::{string(key)}::{string(value)}"
+                report[token_str] = {
+                    string(first_p): [(url, isoformat(timestamp))
+                                      for url, timestamp in requests]
+                    for first_p, requests in first_ps.items()}
+            if report:
+                yield string(three_p), report
+
+    def to_json(self, handle: Any) -> None:
+        """Writes the report of every third party, as a single JSON object
+        mapping third parties to their reports.
+
+        The object is written one third party at a time, so the full report
+        is never held in memory."""
+        separator = "{"
+        for three_p, report in self.reports():
+            handle.write(f"{separator}{json.dumps(three_p)}: "
+                         f"{json.dumps(report)}")
+            separator = ", "
+        handle.write("{}" if separator == "{" else "}")
+
+    def to_jsonl(self, handle: Any) -> None:
+        """Writes each token in the report as a line of JSON, holding the
+        third party, the token, and the first parties it was sent from."""
+        for three_p, report in self.reports():
+            for token_str, first_ps in report.items():
+                handle.write(json.dumps([three_p, token_str, first_ps]))
+                handle.write("\n")
 
     def to_pickle(self, handle: Any) -> None:
         pickle.dump(self, handle)
 
-    def add_request(self, origin_1p: FirstPartyDomain,
-                    origin_3p: ThirdPartyDomain, sent_tokens: List[Token],
+    def add_request(self, origin_1p: StringId, origin_3p: StringId,
+                    sent_tokens: List[InternedToken],
                     ts: RequestTimestamp) -> None:
         if origin_3p not in self.token_collection:
             self.token_collection[origin_3p] = {}
@@ -154,43 +393,95 @@ class TrackingInstances:
                 self.token_collection[origin_3p][token][origin_1p] = []
             self.token_collection[origin_3p][token][origin_1p].append(ts)
 
-    def has_third_party(self, origin: ThirdPartyDomain) -> bool:
-        try:
-            self.token_collection[origin]
-            return True
-        except KeyError:
-            return False
+    def merge(self, other: "TrackingInstances") -> None:
+        """Folds the identifications in other into this collection, as if
+        other's requests had been added after this collection's requests."""
+        remap = self.strings.merge(other.strings)
+        for three_p_id, tokens_for_three_p in other.token_collection.items():
+            three_p = remap[three_p_id]
+            if three_p not in self.token_collection:
+                self.token_collection[three_p] = {}
+            own_tokens = self.token_collection[three_p]
+            for (loc, key, value), first_ps in tokens_for_three_p.items():
+                token = (loc, remap[key], remap[value])
+                if token not in own_tokens:
+                    own_tokens[token] = {}
+                own_first_ps = own_tokens[token]
+                for first_p_id, timestamps in first_ps.items():
+                    first_p = remap[first_p_id]
+                    if first_p not in own_first_ps:
+                        own_first_ps[first_p] = []
+                    own_first_ps[first_p] += timestamps
 
-    def add_third_party_ids(self, origin: ThirdPartyDomain,
-                            tokens: TokenIdentifications) -> None:
-        if not self.has_third_party(origin):
-            self.token_collection[origin] = tokens
-        else:
-            self.token_collection[origin] = {
-                **self.token_collection[origin],
-                **tokens}
+    def in_window(self, window: TimeWindow) -> "TrackingInstances":
+        """Returns the identifications made by requests in window, in a new
+        collection sharing this collection's string table."""
+        if window.is_unbounded():
+            return self
+        start, end = window.bounds()
+        subset = TrackingInstances(self.strings)
+        for three_p, tokens_for_three_p in self.token_collection.items():
+            tokens: TokenIdentifications = {}
+            for token, first_ps in tokens_for_three_p.items():
+                first_ps_in_window: FirstPartyIdentifications = {}
+                for first_p, requests in first_ps.items():
+                    in_window = [request for request in requests
+                                 if start <= request[1] < end]
+                    if in_window:
+                        first_ps_in_window[first_p] = in_window
+                if first_ps_in_window:
+                    tokens[token] = first_ps_in_window
+            if tokens:
+                subset.token_collection[three_p] = tokens
+        return subset
 
-    def has_token(self, origin: ThirdPartyDomain, token: Token) -> bool:
-        try:
-            self.token_collection[origin][token]
-            return True
-        except KeyError:
-            return False
+    def in_locations(self, locations: Locations) -> "TrackingInstances":
+        """Returns the identifications of tokens in the given locations, in
+        a new collection sharing this collection's string table."""
+        wanted = {loc.value for loc in locations}
+        subset = TrackingInstances(self.strings)
+        for three_p, tokens_for_three_p in self.token_collection.items():
+            tokens = {token: first_ps
+                      for token, first_ps in tokens_for_three_p.items()
+                      if token[0] in wanted}
+            if tokens:
+                subset.token_collection[three_p] = tokens
+        return subset
 
-    def add_ids_for_token(self, origin: ThirdPartyDomain, token: Token,
-                          identifications: FirstPartyIdentifications) -> None:
-        if origin not in self.token_collection:
-            self.token_collection[origin] = {}
+    def token_sets(self, strings: StringTable
+                   ) -> Dict[StringId, AbstractSet[InternedToken]]:
+        """Returns the set of tokens sent to each third party, with ids
+        translated into ids in strings.
 
-        if token not in self.token_collection[origin]:
-            self.token_collection[origin][token] = identifications
-        else:
-            self.token_collection[origin][token] = {
-                **self.token_collection[origin][token],
-                **identifications
-            }
+        Every string is translated once, up front, so that whole sets of
+        tokens can then be compared with a single set operation. Strings
+        that aren't in strings are translated to None, so that tokens
+        holding them never match a token from that table."""
+        if strings is self.strings:
+            return {three_p: tokens_for_three_p.keys() for three_p,
+                    tokens_for_three_p in self.token_collection.items()}
+        remap = list(map(strings.ids.get, self.strings.strings)).__getitem__
+        token_sets: Dict[StringId, AbstractSet[InternedToken]] = {}
+        for three_p, tokens_for_three_p in self.token_collection.items():
+            local_three_p = remap(three_p)
+            if local_three_p is None or not tokens_for_three_p:
+                continue
+            locs, keys, values = zip(*tokens_for_three_p)
+            token_sets[local_three_p] = set(zip(
+                locs, map(remap, keys), map(remap, values)))  # type: ignore
+        return token_sets
+
+    def reidentified_sites(self) -> int:
+        """Returns the number of first parties that were linked to another
+        first party, by a token sent from both to the same third party."""
+        linked = set().union(*(
+            first_ps.keys()
+            for tokens_for_three_p in self.token_collection.values()
+            for first_ps in tokens_for_three_p.values()
+            if len(first_ps) > 1))
+        return len(linked)
 
-    def includes_token(self, origin: ThirdPartyDomain, token: Token) -> bool:
+    def includes_token(self, origin: StringId, token: InternedToken) -> bool:
         if origin not in self.token_collection:
             return False
         if token not in self.token_collection[origin]:
@@ -198,65 +489,947 @@ class TrackingInstances:
         return True
 
 
+def _as_sketch(entry: Optional[PendingToken]) -> FirstPartySketch:
+    """Returns the sketch of a pending token (or a new one, if None)."""
+    if isinstance(entry, FirstPartySketch):
+        return entry
+    sketch = FirstPartySketch()
+    if entry is not None:
+        first_p, ts = entry
+        sketch.first_requests = {first_p: ts}
+    return sketch
+
+
+def _in_window(entry: PendingToken,
+               window: TimeWindow) -> Optional[PendingToken]:
+    """Returns the part of a pending token made in window, if any."""
+    if isinstance(entry, tuple):
+        return entry if window.contains(entry[1][1]) else None
+    if entry.first_requests is None:
+        return entry
+    sketch = FirstPartySketch()
+    sketch.first_requests = {
+        first_p: request for first_p, request in entry.first_requests.items()
+        if window.contains(request[1])}
+    return sketch if sketch.first_requests else None
+
+
+class SketchedTrackingInstances(TrackingInstances):
+    """TrackingInstances that only keeps every request a token is sent in
+    once it has been sent from threshold first parties.
+
+    Until then, the first parties the token was sent from are tracked by a
+    FirstPartySketch (see privacykpis.sketch), which keeps only the first
+    request from each first party (or, until the token is sent from a
+    second first party, just that request), so tokens that never pass the
+    threshold (most of them, on large crawls) take little memory. Those
+    tokens are held in pending, and only tokens that passed the threshold
+    are in token_collection, so only they are reported.
+
+    A token's first request from each first party it was sent from before
+    passing the threshold is kept, so every first party it was sent from is
+    listed. Pending sketches stay sparse until the threshold, even above
+    SPARSE_LIMIT, since a dense sketch can't say which first parties to
+    list. Dense sketches only come from merging collections that hold them,
+    and the number of first parties their tokens were sent from is an
+    estimate (see first_party_count()).
+    """
+    threshold: int
+    pending: Dict[StringId, Dict[InternedToken, PendingToken]]
+    # The sketches of tokens that passed the threshold once their sketch was
+    # dense, which still count their first parties.
+    dense_sketches: Dict[Tuple[StringId, InternedToken], FirstPartySketch]
+
+    def __init__(self, threshold: int,
+                 strings: Optional[StringTable] = None) -> None:
+        super().__init__(strings)
+        self.threshold = threshold
+        self.pending = {}
+        self.dense_sketches = {}
+        self._hashes: Dict[StringId, int] = {}
+
+    def _hash(self, first_p: StringId) -> int:
+        first_p_hash = self._hashes.get(first_p)
+        if first_p_hash is None:
+            first_p_hash = domain_hash(self.strings.string(first_p))
+            self._hashes[first_p] = first_p_hash
+        return first_p_hash
+
+    def _promote(self, three_p: StringId, token: InternedToken,
+                 sketch: FirstPartySketch) -> FirstPartyIdentifications:
+        """Moves a pending token to token_collection, once it has passed the
+        threshold, and returns its (new) identifications."""
+        if three_p not in self.token_collection:
+            self.token_collection[three_p] = {}
+        first_ps: FirstPartyIdentifications = {}
+        if sketch.first_requests is None:
+            self.dense_sketches[(three_p, token)] = sketch
+            STATS.count("sketch.dense_promotions")
+        else:
+            for first_p, first_ts in sketch.first_requests.items():
+                first_ps[first_p] = [first_ts]
+        self.token_collection[three_p][token] = first_ps
+        STATS.count("sketch.promotions")
+        return first_ps
+
+    def add_request(self, origin_1p: StringId, origin_3p: StringId,
+                    sent_tokens: List[InternedToken],
+                    ts: RequestTimestamp) -> None:
+        promoted = self.token_collection.get(origin_3p, {})
+        if origin_3p not in self.pending:
+            self.pending[origin_3p] = {}
+        pending = self.pending[origin_3p]
+        sparse_limit = max(SPARSE_LIMIT, self.threshold)
+        for token in sent_tokens:
+            if token in promoted:
+                first_ps = promoted[token]
+                if self.dense_sketches:
+                    sketch = self.dense_sketches.get((origin_3p, token))
+                    if sketch is not None:
+                        sketch.add(origin_1p, ts, self._hash)
+            else:
+                entry = pending.get(token)
+                if entry is None:
+                    pending[token] = (origin_1p, ts)
+                    continue
+                if isinstance(entry, tuple):
+                    if entry[0] == origin_1p:
+                        continue
+                    entry = _as_sketch(entry)
+                    pending[token] = entry
+                if (not entry.add(origin_1p, ts, self._hash,
+                                  sparse_limit) or
+                        entry.count() < self.threshold):
+                    continue
+                del pending[token]
+                first_ps = self._promote(origin_3p, token, entry)
+                promoted = self.token_collection[origin_3p]
+                if origin_1p in first_ps:
+                    # The request is the one the sketch kept.
+                    continue
+            if origin_1p not in first_ps:
+                first_ps[origin_1p] = []
+            first_ps[origin_1p].append(ts)
+        if not pending:
+            del self.pending[origin_3p]
+
+    def _merge_sketch(self, three_p: StringId, token: InternedToken,
+                      other: FirstPartySketch) -> None:
+        """Folds a dense sketch into the sketch of a promoted token."""
+        key = (three_p, token)
+        if key not in self.dense_sketches:
+            sketch = FirstPartySketch()
+            sketch.densify(self._hash)
+            for first_p in self.token_collection[three_p][token]:
+                sketch.add_hash(self._hash(first_p))
+            self.dense_sketches[key] = sketch
+        self.dense_sketches[key].merge_registers(other)
+
+    def merge(self, other: "TrackingInstances") -> None:
+        """Folds the identifications in other (which must also be sketched,
+        with the same threshold) into this collection.
+
+        Requests other saw a token in before it passed the threshold in
+        other are only the first requests from each first party, so the
+        result can list fewer requests than sketching every request in a
+        single collection would have."""
+        assert isinstance(other, SketchedTrackingInstances)
+        assert other.threshold == self.threshold
+        remap = self.strings.merge(other.strings)
+        for three_p_id, tokens_for_three_p in other.token_collection.items():
+            three_p = remap[three_p_id]
+            own_tokens = self.token_collection.get(three_p, {})
+            own_pending = self.pending.get(three_p, {})
+            for other_token, first_ps in tokens_for_three_p.items():
+                loc, key, value = other_token
+                token = (loc, remap[key], remap[value])
+                if token in own_tokens:
+                    own_first_ps = own_tokens[token]
+                else:
+                    own_first_ps = self._promote(
+                        three_p, token,
+                        _as_sketch(own_pending.pop(token, None)))
+                    own_tokens = self.token_collection[three_p]
+                own_sketch = self.dense_sketches.get((three_p, token))
+                for first_p_id, timestamps in first_ps.items():
+                    first_p = remap[first_p_id]
+                    if first_p not in own_first_ps:
+                        own_first_ps[first_p] = []
+                        if own_sketch is not None:
+                            own_sketch.add_hash(self._hash(first_p))
+                    own_first_ps[first_p] += timestamps
+                sketch = other.dense_sketches.get((three_p_id, other_token))
+                if sketch is not None:
+                    self._merge_sketch(three_p, token, sketch)
+            if three_p in self.pending and not own_pending:
+                del self.pending[three_p]
+        for three_p_id, entries in other.pending.items():
+            three_p = remap[three_p_id]
+            for (loc, key, value), entry in entries.items():
+                token = (loc, remap[key], remap[value])
+                if isinstance(entry, tuple):
+                    first_p_id, ts = entry
+                    self.add_request(remap[first_p_id], three_p, [token], ts)
+                    continue
+                sketch = entry
+                if sketch.first_requests is not None:
+                    for first_p_id, ts in sketch.first_requests.items():
+                        self.add_request(remap[first_p_id], three_p, [token],
+                                         ts)
+                    continue
+                if token in self.token_collection.get(three_p, {}):
+                    self._merge_sketch(three_p, token, sketch)
+                    continue
+                if three_p not in self.pending:
+                    self.pending[three_p] = {}
+                own_sketch = _as_sketch(self.pending[three_p].get(token))
+                self.pending[three_p][token] = own_sketch
+                own_sketch.densify(self._hash)
+                own_sketch.merge_registers(sketch)
+                if own_sketch.count() >= self.threshold:
+                    del self.pending[three_p][token]
+                    if not self.pending[three_p]:
+                        del self.pending[three_p]
+                    self._promote(three_p, token, own_sketch)
+
+    def first_party_count(self, three_p: StringId,
+                          token: InternedToken) -> int:
+        """Returns the number of first parties the token was sent to three_p
+        from. The count is exact, unless the token's sketch is dense, in
+        which case it is an estimate (see privacykpis.sketch for its error
+        bounds)."""
+        sketch = self.dense_sketches.get((three_p, token))
+        if sketch is not None:
+            return sketch.count()
+        entry = self.pending.get(three_p, {}).get(token)
+        if isinstance(entry, tuple):
+            return 1
+        if entry is not None:
+            return entry.count()
+        return len(self.token_collection.get(three_p, {}).get(token, {}))
+
+    def in_locations(self, locations: Locations) -> "TrackingInstances":
+        wanted = {loc.value for loc in locations}
+        subset = SketchedTrackingInstances(self.threshold, self.strings)
+        subset.token_collection = super().in_locations(
+            locations).token_collection
+        for three_p, entries in self.pending.items():
+            pending = {token: entry for token, entry in entries.items()
+                       if token[0] in wanted}
+            if pending:
+                subset.pending[three_p] = pending
+        subset.dense_sketches = {
+            key: sketch for key, sketch in self.dense_sketches.items()
+            if key[1][0] in wanted}
+        return subset
+
+    def in_window(self, window: TimeWindow) -> "TrackingInstances":
+        """Same as TrackingInstances.in_window(). Pending tokens are kept if
+        the first request from any of their first parties was made in
+        window, and tokens with dense sketches are kept as they are, since
+        their sketches don't record when requests were made."""
+        if window.is_unbounded():
+            return self
+        subset = SketchedTrackingInstances(self.threshold, self.strings)
+        subset.token_collection = super().in_window(window).token_collection
+        for three_p, entries in self.pending.items():
+            pending: Dict[InternedToken, PendingToken] = {}
+            for token, entry in entries.items():
+                in_window = _in_window(entry, window)
+                if in_window is not None:
+                    pending[token] = in_window
+            if pending:
+                subset.pending[three_p] = pending
+        subset.dense_sketches = {
+            key: sketch for key, sketch in self.dense_sketches.items()
+            if key[1] in subset.token_collection.get(key[0], {})}
+        return subset
+
+    def _parse_timestamps(self) -> None:
+        super()._parse_timestamps()
+        for entries in self.pending.values():
+            for token, entry in entries.items():
+                if isinstance(entry, tuple):
+                    first_p, (url, timestamp) = entry
+                    entries[token] = (first_p, (url, epoch_micros(timestamp)))
+                elif entry.first_requests is not None:
+                    entry.first_requests = {
+                        first_p: (url, epoch_micros(timestamp))
+                        for first_p, (url, timestamp)
+                        in entry.first_requests.items()}
+
+    def token_sets(self, strings: StringTable
+                   ) -> Dict[StringId, AbstractSet[InternedToken]]:
+        """Same as TrackingInstances.token_sets(), including the tokens that
+        haven't passed the threshold."""
+        token_sets = super().token_sets(strings)
+        pending = TrackingInstances(self.strings)
+        pending.token_collection = self.pending  # type: ignore
+        for three_p, tokens in pending.token_sets(strings).items():
+            if three_p in token_sets:
+                token_sets[three_p] = token_sets[three_p] | tokens
+            else:
+                token_sets[three_p] = tokens
+        return token_sets
+
+    def includes_token(self, origin: StringId, token: InternedToken) -> bool:
+        if token in self.pending.get(origin, {}):
+            return True
+        return super().includes_token(origin, token)
+
+
 class BrowserMeasurement:
+    """The requests made while measuring a browser, as a graph.
+
+    Graph nodes, and the token keys and values on edges, are ids in the
+    strings table.
+    """
     graph: MultiDiGraph
+    strings: StringTable
     debug: bool
     redirect_cache: RedirectCache
+    # Maps each input file read to the byte offset it has been read up to.
+    ingested: Dict[str, int]
+    # The locations tokens were extracted from. Edges hold None for every
+    # other location, since they were never parsed.
+    locations: Locations = privacykpis.tokenizing.ALL_LOCATIONS
 
     def __init__(self, cache_path: Optional[pathlib.Path]) -> None:
         self.graph = MultiDiGraph()
+        self.strings = StringTable()
         self.redirect_cache = RedirectCache(cache_path)
         self.debug = False
+        self.ingested = {}
+        self.locations = privacykpis.tokenizing.LOCATIONS
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # Measurements pickled before graphs were interned hold the strings
+        # themselves, in place of ids.
+        if "strings" not in state:
+            self._intern_graph()
+
+    def _intern_graph(self) -> None:
+        self.strings = StringTable()
+        intern = self.strings.intern
+        graph = MultiDiGraph()
+        graph.add_nodes_from((intern(node), data) for node, data
+                             in self.graph.nodes(data=True))
+        for u, v, data in self.graph.edges(data=True):
+            edge_data = dict(data)
+            for loc in TokenLocation:
+                edge_data[loc.name] = self.strings.intern_pairs(
+                    data.get(loc.name))
+            graph.add_edge(intern(u), intern(v), **edge_data)
+        self.graph = graph
 
-    def add_input_line(self, line: str) -> None:
-        measurement = SiteMeasurement(json.loads(line), self.redirect_cache)
+    def add_input_line(self, line: JSONInput) -> None:
+        with DECODE_TIMER:
+            record = privacykpis.codec.loads(line, exact_integers=False)
+        measurement = SiteMeasurement(record, self.redirect_cache)
         measurement.debug = self.debug
-        measurement.add_to_graph(self.graph)
+        measurement.add_to_graph(self.graph, self.strings)
 
     def add_input_file(self, file: Any) -> None:
-        measurement = SiteMeasurement(json.load(file), self.redirect_cache)
+        with DECODE_TIMER:
+            record = privacykpis.codec.load(file, exact_integers=False)
+        measurement = SiteMeasurement(record, self.redirect_cache)
         measurement.debug = self.debug
-        measurement.add_to_graph(self.graph)
+        measurement.add_to_graph(self.graph, self.strings)
 
-    def get_tracking_instances(self) -> TrackingInstances:
-        track_instances = TrackingInstances()
+    def get_tracking_instances(self, locations: Optional[Locations] = None,
+                               window: Optional[TimeWindow] = None
+                               ) -> TrackingInstances:
+        """Returns the identifying tokens sent to third parties, from the
+        given locations (or every location, if None), in requests made in
+        window (or at any time, if None)."""
+        if locations is None:
+            locations = privacykpis.tokenizing.ALL_LOCATIONS
+        track_instances = TrackingInstances(self.strings)
+        for u, v, data in self.graph.edges(data=True):
+            add_edge_to_tracking_instances(track_instances, u, v, data,
+                                           locations, window)
+        return track_instances
+
+    def rows(self) -> Iterable[Row]:
+        string = self.strings.string
         for u, v, data in self.graph.edges(data=True):
+            for loc in TokenLocation:
+                if data[loc.name] is None:
+                    continue
+                for key, value in data[loc.name]:
+                    yield (string(u), string(v), data[URL],
+                           epoch_micros(data[TIMESTAMP]), loc.value,
+                           string(key), string(value))
+
+    def merge(self, other: "BrowserMeasurement") -> None:
+        remap = self.strings.merge(other.strings)
+        self.graph.add_nodes_from((remap[node], data) for node, data
+                                  in other.graph.nodes(data=True))
+        for u, v, data in other.graph.edges(data=True):
+            edge_data = dict(data)
+            for loc in TokenLocation:
+                if data[loc.name] is None:
+                    continue
+                edge_data[loc.name] = [(remap[key], remap[value])
+                                       for key, value in data[loc.name]]
+            self.graph.add_edge(remap[u], remap[v], **edge_data)
+        self.redirect_cache.update(other.redirect_cache)
+        self.ingested.update(other.ingested)
+
+    def close(self) -> None:
+        self.redirect_cache.write()
+
+
+class StreamingMeasurement:
+    """Folds each site measurement straight into a TrackingInstances
+    collection, without building the intermediate request graph.
+
+    Only the identifying tokens of cross-party requests are kept, so memory
+    grows with the number of distinct tokens seen, instead of with the
+    number of requests recorded.
+    """
+    tracking_instances: TrackingInstances
+    debug: bool
+    redirect_cache: RedirectCache
+    # Maps each input file read to the byte offset it has been read up to.
+    ingested: Dict[str, int]
+    # The locations tokens were extracted from.
+    locations: Locations = privacykpis.tokenizing.ALL_LOCATIONS
+
+    def __init__(self, cache_path: Optional[pathlib.Path],
+                 sketch_threshold: Optional[int] = None) -> None:
+        if sketch_threshold is None:
+            self.tracking_instances = TrackingInstances()
+        else:
+            self.tracking_instances = SketchedTrackingInstances(
+                sketch_threshold)
+        self.redirect_cache = RedirectCache(cache_path)
+        self.debug = False
+        self.ingested = {}
+        self.locations = privacykpis.tokenizing.LOCATIONS
+
+    @property
+    def sketch_threshold(self) -> Optional[int]:
+        """The threshold tokens are sketched until, if they are."""
+        instances = self.tracking_instances
+        if isinstance(instances, SketchedTrackingInstances):
+            return instances.threshold
+        return None
+
+    def add_input_line(self, line: JSONInput) -> None:
+        with DECODE_TIMER:
+            record = privacykpis.codec.loads(line, exact_integers=False)
+        measurement = SiteMeasurement(record, self.redirect_cache)
+        measurement.debug = self.debug
+        measurement.add_to_tracking_instances(self.tracking_instances)
+
+    def add_input_file(self, file: Any) -> None:
+        with DECODE_TIMER:
+            record = privacykpis.codec.load(file, exact_integers=False)
+        measurement = SiteMeasurement(record, self.redirect_cache)
+        measurement.debug = self.debug
+        measurement.add_to_tracking_instances(self.tracking_instances)
+
+    def get_tracking_instances(self, locations: Optional[Locations] = None,
+                               window: Optional[TimeWindow] = None
+                               ) -> TrackingInstances:
+        """Returns the identifying tokens sent to third parties, from the
+        given locations (or every location, if None), in requests made in
+        window (or at any time, if None)."""
+        instances = self.tracking_instances
+        if locations is not None and not self.locations <= locations:
+            instances = instances.in_locations(locations)
+        if window is not None:
+            instances = instances.in_window(window)
+        return instances
+
+    def rows(self) -> Iterable[Row]:
+        string = self.tracking_instances.strings.string
+        token_collection = self.tracking_instances.token_collection
+        for three_p, tokens_for_three_p in token_collection.items():
+            for token, first_ps in tokens_for_three_p.items():
+                loc, key, value = token
+                for first_p, timestamps in first_ps.items():
+                    for url, timestamp in timestamps:
+                        yield (string(first_p), string(three_p), url,
+                               timestamp, loc, string(key), string(value))
+
+    def merge(self, other: "StreamingMeasurement") -> None:
+        self.tracking_instances.merge(other.tracking_instances)
+        self.redirect_cache.update(other.redirect_cache)
+        self.ingested.update(other.ingested)
+
+    def close(self) -> None:
+        self.redirect_cache.write()
+
+
+class ColumnarMeasurement:
+    """A measurement read back from a columnar artifact (see
+    privacykpis.columnar).
+
+    The artifact is memory-mapped, and rows are skipped based on the cheapest
+    columns first (same party requests, then filtered values), so most of the
+    file is never decoded into Python objects.
+    """
+    reader: ColumnarReader
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.reader = ColumnarReader(path)
+
+    @property
+    def locations(self) -> Locations:
+        """The locations tokens were extracted from."""
+        names = self.reader.metadata.get("locations")
+        if names is None:
+            return privacykpis.tokenizing.ALL_LOCATIONS
+        return location_set(names)
+
+    def get_tracking_instances(self, locations: Optional[Locations] = None,
+                               window: Optional[TimeWindow] = None
+                               ) -> TrackingInstances:
+        """Returns the identifying tokens sent to third parties, from the
+        given locations (or every location, if None), in requests made in
+        window (or at any time, if None)."""
+        if locations is None:
+            locations = privacykpis.tokenizing.ALL_LOCATIONS
+        wanted = {loc.value for loc in locations}
+        track_instances = TrackingInstances()
+        reader = self.reader
+        first_ps, third_ps = reader.column("1p"), reader.column("3p")
+        row_locations = reader.column("location")
+        keys, values = reader.column("key"), reader.column("value")
+        urls, timestamps = reader.column("url"), reader.timestamps()
+        domain_strs = reader.strings("domains")
+        token_strs = reader.strings("tokens")
+        url_strs = reader.strings("urls")
+
+        # Rows outside the window are masked out up front, from the
+        # timestamp column alone.
+        rows: Iterable[int] = range(reader.num_rows)
+        if window is not None and not window.is_unbounded():
+            start, end = window.bounds()
+            rows = list(itertools.compress(rows, [
+                start <= timestamp < end for timestamp in timestamps]))
+
+        # The same value is usually sent many times, so the distinct
+        # values sent to third parties are checked against the filters
+        # once, in a single batch.
+        value_codes = list({values[row] for row in rows
+                            if first_ps[row] != third_ps[row] and
+                            row_locations[row] in wanted})
+        with FILTER_TIMER:
+            is_ignored = dict(zip(
+                value_codes, privacykpis.filters.should_ignore_tokens(
+                    [token_strs[code] for code in value_codes])))
+        # Number of tokens kept, and filtered out, per location.
+        kept_counts = {loc.value: [0, 0] for loc in TokenLocation}
+        # Maps codes in the artifact's string tables to ids in the
+        # tracking instances' string table.
+        domain_ids: Dict[int, StringId] = {}
+        token_ids: Dict[int, StringId] = {}
+        strings = track_instances.strings
+
+        def domain_id(code: int) -> StringId:
+            try:
+                return domain_ids[code]
+            except KeyError:
+                domain_ids[code] = strings.intern(domain_strs[code])
+                return domain_ids[code]
+
+        def token_id(code: int) -> StringId:
+            try:
+                return token_ids[code]
+            except KeyError:
+                token_ids[code] = strings.intern(token_strs[code])
+                return token_ids[code]
+
+        for row in rows:
+            from_code, to_code = first_ps[row], third_ps[row]
             # Ignore same party requests.
-            if u == v:
+            if from_code == to_code:
                 continue
-
-            tokens = privacykpis.tokenizing.flaten_identifiers(data)
-            # Ignore cases where there are no identifying tokens.
-            if len(tokens) == 0:
+            location = row_locations[row]
+            if location not in wanted:
                 continue
+            value_code = values[row]
+            if is_ignored[value_code]:
+                kept_counts[location][1] += 1
+                continue
+            kept_counts[location][0] += 1
 
-            from_domain = cast(FirstPartyDomain, u)
-            to_domain = cast(ThirdPartyDomain, v)
-            node_data = cast(Dict[Any, Any], data)
-            request_ts = cast(RequestTimestamp, (data[URL], data[TIMESTAMP]))
-            track_instances.add_request(from_domain, to_domain, tokens,
+            token = (location, token_id(keys[row]),
+                     token_id(value_code))
+            request_ts = (url_strs[urls[row]], timestamps[row])
+            track_instances.add_request(domain_id(from_code),
+                                        domain_id(to_code), [token],
                                         request_ts)
+
+        for loc in TokenLocation:
+            kept, filtered = kept_counts[loc.value]
+            STATS.count(token_counter("kept", loc.name), kept)
+            STATS.count(token_counter("filtered", loc.name), filtered)
         return track_instances
 
-    def close(self) -> None:
-        self.redirect_cache.write()
 
+Measurement = Union[BrowserMeasurement, StreamingMeasurement]
 
-def write(data: BrowserMeasurement, output_path: str) -> None:
-    with open(output_path, "wb") as handle:
-        pickle.dump(data, handle)
 
+def add_edge_to_tracking_instances(instances: TrackingInstances, u: StringId,
+                                   v: StringId, data: Dict[str, Any],
+                                   locations: Locations =
+                                   privacykpis.tokenizing.ALL_LOCATIONS,
+                                   window: Optional[TimeWindow] = None
+                                   ) -> None:
+    """Adds the tokens in the given locations of an edge from a
+    BrowserMeasurement graph, whose ids are in the same string table as
+    instances, if the request was made in window (or window is None)."""
+    STATS.count("requests")
+    # Ignore same party requests.
+    if u == v:
+        return
+    timestamp = epoch_micros(data[TIMESTAMP])
+    if window is not None and not window.contains(timestamp):
+        return
 
-def graph_from_args(args: Args, debug: bool = False) -> BrowserMeasurement:
-    measurement = BrowserMeasurement(args.redirect_cache_path)
-    measurement.debug = debug
-    for input_file in args.input:
-        if args.multi:
-            for line in input_file:
-                if line.strip() == "":
-                    continue
-                measurement.add_input_line(line,)
+    tokens = privacykpis.tokenizing.flaten_identifiers(
+        data, instances.strings, locations)
+    # Ignore cases where there are no identifying tokens.
+    if len(tokens) == 0:
+        return
+
+    with TRACKING_TIMER:
+        instances.add_request(u, v, tokens, (data[URL], timestamp))
+
+
+def write(data: Measurement, output_path: str,
+          output_format: str = "pickle") -> None:
+    # Write to a temporary file first, so that an interrupted write never
+    # replaces a complete artifact with a partial one.
+    temp_path = f"{output_path}.tmp"
+    with STATS.timer("write"):
+        if output_format == "columnar":
+            writer = ColumnarWriter({
+                "locations": location_names(data.locations)})
+            for row in data.rows():
+                writer.add_row(row)
+            writer.write(temp_path)
         else:
-            measurement.add_input_file(input_file)
+            with open(temp_path, "wb") as handle:
+                pickle.dump(data, handle)
+        os.replace(temp_path, output_path)
+
+
+def load(input_path: str) -> Union[Measurement, ColumnarMeasurement]:
+    """Reads a measurement written by write(), in either format."""
+    with STATS.timer("load"):
+        if is_columnar(input_path):
+            return ColumnarMeasurement(pathlib.Path(input_path))
+        with open(input_path, "rb") as handle:
+            return cast(Measurement, pickle.load(handle))
+
+
+def location_names(locations: Locations) -> List[str]:
+    return [loc.name for loc in TokenLocation if loc in locations]
+
+
+def location_set(names: Iterable[str]) -> Locations:
+    return frozenset(TokenLocation[name] for name in names)
+
+
+def manifest_path(output_path: pathlib.Path) -> pathlib.Path:
+    return output_path.with_name(output_path.name + ".manifest")
+
+
+def _sketch_threshold(data: Measurement) -> Optional[int]:
+    if isinstance(data, StreamingMeasurement):
+        return data.sketch_threshold
+    return None
+
+
+def write_manifest(data: Measurement, output_path: pathlib.Path) -> None:
+    """Records which inputs have been ingested into the artifact at
+    output_path, so that later runs can tell whether there is anything new
+    to read without loading the artifact.
+
+    The artifact itself holds the same offsets (and is the source of truth
+    when resuming); the manifest only needs to be fast to check."""
+    stat = output_path.stat()
+    manifest = {
+        "artifact": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        "inputs": data.ingested,
+        "locations": location_names(data.locations),
+        "sketch_threshold": _sketch_threshold(data),
+    }
+    temp_path = output_path.with_name(output_path.name + ".manifest.tmp")
+    temp_path.write_text(json.dumps(manifest))
+    os.replace(temp_path, manifest_path(output_path))
+
+
+def _input_name(input_file: Any) -> str:
+    return os.path.abspath(str(input_file.name))
+
+
+def is_up_to_date(args: Args) -> bool:
+    """Returns True if every input has already been fully ingested into the
+    artifact at args.output, according to its manifest."""
+    if not args.output.is_file():
+        return False
+    try:
+        manifest = json.loads(manifest_path(args.output).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    all_names = location_names(privacykpis.tokenizing.ALL_LOCATIONS)
+    if (manifest.get("locations", all_names) !=
+            location_names(args.locations)):
+        return False
+    if manifest.get("sketch_threshold") != args.sketch_threshold:
+        return False
+
+    stat = args.output.stat()
+    artifact = manifest["artifact"]
+    if (artifact["size"] != stat.st_size or
+            artifact["mtime_ns"] != stat.st_mtime_ns):
+        return False
+
+    for input_file in args.input:
+        name = _input_name(input_file)
+        if name not in manifest["inputs"]:
+            return False
+        if args.multi and manifest["inputs"][name] != os.path.getsize(name):
+            return False
+    return True
+
+
+def _new_measurement(stream: bool, cache_path: Optional[pathlib.Path],
+                     sketch_threshold: Optional[int] = None) -> Measurement:
+    if stream:
+        return StreamingMeasurement(cache_path, sketch_threshold)
+    return BrowserMeasurement(cache_path)
+
+
+def _resumed_measurement(args: Args) -> Measurement:
+    """Returns the measurement to add the inputs to, either a new one, or,
+    when resuming, the one previously written to args.output."""
+    if not args.resume or not args.output.is_file():
+        return _new_measurement(args.stream, args.redirect_cache_path,
+                                args.sketch_threshold)
+
+    measurement = load(str(args.output))
+    if not hasattr(measurement, "ingested"):
+        # Measurements written before they recorded their inputs can't be
+        # added to without reading some inputs twice, so they're rebuilt.
+        if args.debug:
+            print(f"{args.output} doesn't record which inputs it holds, "
+                  "rebuilding it.")
+        return _new_measurement(args.stream, args.redirect_cache_path,
+                                args.sketch_threshold)
+    expected_type = StreamingMeasurement if args.stream else BrowserMeasurement
+    if not isinstance(measurement, expected_type):
+        raise ValueError(f"Cannot resume {args.output}, it does not hold a "
+                         f"{expected_type.__name__}.")
+    if measurement.locations != args.locations:
+        raise ValueError(f"Cannot resume {args.output}, it holds tokens from "
+                         f"{location_names(measurement.locations)}, not "
+                         f"{location_names(args.locations)}.")
+    if _sketch_threshold(measurement) != args.sketch_threshold:
+        raise ValueError(f"Cannot resume {args.output}, it was not sketched "
+                         "with the same --sketch-threshold (or was not "
+                         "sketched at all).")
+    redirect_cache = RedirectCache(args.redirect_cache_path)
+    redirect_cache.update(measurement.redirect_cache)
+    measurement.redirect_cache = redirect_cache
+    return measurement
+
+
+InputDocument = Tuple[str, int, bytes]
+
+
+def _input_documents(args: Args,
+                     ingested: Dict[str, int]) -> Iterable[InputDocument]:
+    """Yields each input document that hasn't been ingested yet, along with
+    the name of the file it was read from, and the byte offset of the end of
+    the document in that file."""
+    for input_file in args.input:
+        name = _input_name(input_file)
+        offset = ingested.get(name, 0)
+        handle = input_file.buffer
+        if not args.multi:
+            # Files holding a single document are ingested all at once.
+            if offset > 0:
+                continue
+            data = handle.read()
+            yield name, len(data), data
+            continue
+
+        if offset > 0:
+            if offset > os.path.getsize(name):
+                raise ValueError(f"{name} is shorter than when it was last "
+                                 "ingested, refusing to resume from it.")
+            handle.seek(offset)
+        for line in handle:
+            offset += len(line)
+            if line.strip() == b"":
+                continue
+            yield name, offset, line
+
+
+# The settings _apply_settings takes, as built by _settings.
+_Settings = Tuple[Optional[pathlib.Path], int, Optional[pathlib.Path], int,
+                  Locations, Optional[pathlib.Path], int]
+
+
+def _settings(args: Args) -> _Settings:
+    return (args.etld_cache_path, args.filter_cache_size,
+            args.filter_cache_path, args.max_body_size, args.locations,
+            args.token_cache_path, args.token_cache_size)
+
+
+def _apply_settings(etld_cache_path: Optional[pathlib.Path],
+                    filter_cache_size: int,
+                    filter_cache_path: Optional[pathlib.Path],
+                    max_body_size: int, locations: Locations,
+                    token_cache_path: Optional[pathlib.Path],
+                    token_cache_size: int) -> None:
+    """Sets the module level settings (and loads the caches) that requests
+    are processed with, in this process."""
+    privacykpis.domains.load_cache(etld_cache_path)
+    privacykpis.filters.set_cache_size(filter_cache_size)
+    privacykpis.filters.load_cache(filter_cache_path)
+    privacykpis.tokenizing.set_max_body_size(max_body_size)
+    privacykpis.tokenizing.set_locations(locations)
+    privacykpis.tokencache.open_cache(token_cache_path, token_cache_size)
+
+
+# State for worker processes, set once per process by _init_worker.
+_WORKER_STREAM = False
+_WORKER_DEBUG = False
+_WORKER_REDIRECTS: Dict[str, bool] = {}
+_WORKER_SKETCH_THRESHOLD: Optional[int] = None
+
+
+def _init_worker(stream: bool, debug: bool, redirects: Dict[str, bool],
+                 sketch_threshold: Optional[int],
+                 settings: _Settings) -> None:
+    global _WORKER_STREAM, _WORKER_DEBUG, _WORKER_REDIRECTS
+    global _WORKER_SKETCH_THRESHOLD
+    _WORKER_STREAM = stream
+    _WORKER_DEBUG = debug
+    _WORKER_REDIRECTS = redirects
+    _WORKER_SKETCH_THRESHOLD = sketch_threshold
+    # Workers that aren't forked (the default on macOS) start with every
+    # module's defaults, rather than a copy of the parent's settings.
+    _apply_settings(*settings)
+
+
+def _measure_documents(documents: List[InputDocument]
+                       ) -> Tuple[Measurement, Snapshot, int]:
+    """Builds a partial measurement for a chunk of input documents, and
+    returns it along with the stats for building it, and the number of
+    documents in the chunk.
+
+    Redirect lookups are shared by every chunk handled by this process, but
+    only the lookups first made for this chunk are returned to the parent
+    process, which merges them into the main redirect cache."""
+    STATS.reset()
+    measurement = _new_measurement(_WORKER_STREAM, None,
+                                   _WORKER_SKETCH_THRESHOLD)
+    measurement.debug = _WORKER_DEBUG
+    measurement.redirect_cache.cache = _WORKER_REDIRECTS
+    num_known_redirects = len(_WORKER_REDIRECTS)
+    for name, offset, document in documents:
+        measurement.add_input_line(document)
+        measurement.ingested[name] = offset
+    privacykpis.tokencache.flush_cache()
+    new_redirects = itertools.islice(_WORKER_REDIRECTS.items(),
+                                     num_known_redirects, None)
+    measurement.redirect_cache = RedirectCache(None)
+    measurement.redirect_cache.cache = dict(new_redirects)
+    return measurement, STATS.snapshot(), len(documents)
+
+
+def _chunks(documents: Iterable[InputDocument],
+            size: int) -> Iterable[List[InputDocument]]:
+    iterator = iter(documents)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class _Checkpointer:
+    """Periodically writes a measurement to args.output while it's being
+    built (if args.resume is set), so that an interrupted run can resume
+    from the last checkpoint."""
+    def __init__(self, args: Args, measurement: Measurement) -> None:
+        self.args = args
+        self.measurement = measurement
+        self.pending = 0
+
+    def documents_added(self, count: int) -> None:
+        if not self.args.resume:
+            return
+        self.pending += count
+        if self.pending < self.args.checkpoint_every:
+            return
+        self.pending = 0
+        self.measurement.redirect_cache.write()
+        write(self.measurement, str(self.args.output))
+        write_manifest(self.measurement, self.args.output)
+
+
+def _parallel_graph_from_args(args: Args, debug: bool) -> Measurement:
+    """Splits the input documents across args.jobs worker processes.
+
+    Partial measurements are merged in input order, so the result is the
+    same as reading the inputs serially (except when sketching, see
+    SketchedTrackingInstances.merge())."""
+    measurement = _resumed_measurement(args)
+    measurement.debug = debug
+    checkpointer = _Checkpointer(args, measurement)
+    init_args = (args.stream, debug, measurement.redirect_cache.cache,
+                 args.sketch_threshold, _settings(args))
+    with multiprocessing.Pool(args.jobs, _init_worker, init_args) as pool:
+        documents = _input_documents(args, measurement.ingested)
+        chunks = _chunks(documents, PARALLEL_CHUNK_SIZE)
+        for partial, stats, count in pool.imap(_measure_documents, chunks):
+            with STATS.timer("merge"):
+                measurement.merge(partial)  # type: ignore
+            STATS.merge(stats)
+            checkpointer.documents_added(count)
     measurement.close()
     return measurement
+
+
+def _serial_graph_from_args(args: Args, debug: bool) -> Measurement:
+    measurement = _resumed_measurement(args)
+    measurement.debug = debug
+    checkpointer = _Checkpointer(args, measurement)
+    for name, offset, document in _input_documents(args,
+                                                   measurement.ingested):
+        measurement.add_input_line(document)
+        measurement.ingested[name] = offset
+        checkpointer.documents_added(1)
+    measurement.close()
+    return measurement
+
+
+def graph_from_args(args: Args, debug: bool = False) -> Measurement:
+    # Load the caches before any worker processes are started, so that they
+    # start with warm caches too.
+    _apply_settings(*_settings(args))
+    if args.jobs > 1:
+        measurement = _parallel_graph_from_args(args, debug)
+    else:
+        measurement = _serial_graph_from_args(args, debug)
+    privacykpis.domains.write_cache(args.etld_cache_path)
+    privacykpis.filters.write_cache(args.filter_cache_path)
+    token_cache_stats = privacykpis.tokencache.close_cache()
+    if debug:
+        print(f"eTLD+1 cache: {privacykpis.domains.cache_stats()}")
+        print(f"Filter cache: {privacykpis.filters.cache_stats()}")
+        if token_cache_stats:
+            print(f"Token cache: {token_cache_stats}")
+    return measurement
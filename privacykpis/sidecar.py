@@ -0,0 +1,160 @@
+"""Sidecar files caching the tracking instances derived from a measurement.
+
+Deriving tracking instances means flattening every request in a measurement
+and running every token through the filters, which extract.py would
+otherwise redo every time the same measurement is compared (e.g. a control
+shared by many comparisons). The result is written next to the artifact, at
+sidecar_path(), keyed by a hash of the artifact's contents and of the filter
+settings, and is rebuilt whenever either changes.
+"""
+import hashlib
+import os
+import pathlib
+import pickle
+from typing import Any, Dict, List, Optional
+
+import privacykpis.filters
+import privacykpis.serialize
+from privacykpis.serialize import Locations, TrackingInstances
+from privacykpis.stats import STATS
+from privacykpis.timestamps import TimeWindow
+
+
+# Bump this whenever a change could change the tracking instances derived
+# from a measurement, other than a change to the filters (which have their
+# own version).
+SIDECAR_VERSION = 2
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def sidecar_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(path.name + ".tracking")
+
+
+def artifact_key(path: pathlib.Path) -> str:
+    """Returns a hash of the artifact's contents, and of everything else
+    that the tracking instances derived from it depend on."""
+    digest = hashlib.sha256()
+    digest.update(repr([
+        SIDECAR_VERSION,
+        privacykpis.filters.FILTERS_VERSION,
+        privacykpis.filters.MIN_TOKEN_LENGTH,
+        privacykpis.filters.URL_PREFIXES,
+    ]).encode("utf-8"))
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _names(locations: Locations) -> List[str]:
+    return privacykpis.serialize.location_names(locations)
+
+
+def _in_window(instances: TrackingInstances,
+               window: Optional[TimeWindow]) -> TrackingInstances:
+    if window is None:
+        return instances
+    with STATS.timer("window"):
+        return instances.in_window(window)
+
+
+class DerivedMeasurement:
+    """The tracking instances derived from a measurement, loaded from its
+    sidecar file if it's up to date, or from the measurement itself if not.
+
+    The measurement is only loaded if the sidecar can't be used, so checking
+    which locations it holds, and getting the tracking instances of those
+    locations, is cheap once the sidecar has been written.
+    """
+    path: pathlib.Path
+    key: str
+    locations: Locations
+    debug: bool
+
+    def __init__(self, path: str, use_sidecar: bool = True,
+                 debug: bool = False) -> None:
+        self.path = pathlib.Path(path)
+        self.use_sidecar = use_sidecar
+        self.debug = debug
+        self._measurement: Any = None
+        self._sidecar: Optional[Dict[str, Any]] = None
+        if use_sidecar:
+            with STATS.timer("sidecar"):
+                self.key = artifact_key(self.path)
+                self._sidecar = self._read_sidecar()
+        if self._sidecar is not None:
+            self.locations = privacykpis.serialize.location_set(
+                self._sidecar["artifact_locations"])
+        else:
+            self.locations = self._load().locations
+
+    def _load(self) -> Any:
+        if self._measurement is None:
+            self._measurement = privacykpis.serialize.load(str(self.path))
+        return self._measurement
+
+    def _read_sidecar(self) -> Optional[Dict[str, Any]]:
+        try:
+            with sidecar_path(self.path).open("rb") as handle:
+                sidecar: Dict[str, Any] = pickle.load(handle)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if sidecar.get("key") != self.key:
+            if self.debug:
+                print(f"{sidecar_path(self.path)} is stale, rebuilding it.")
+            return None
+        return sidecar
+
+    def _write_sidecar(self, locations: Locations,
+                       instances: TrackingInstances) -> None:
+        path = sidecar_path(self.path)
+        temp_path = path.with_name(path.name + ".tmp")
+        sidecar = {
+            "key": self.key,
+            "artifact_locations": _names(self.locations),
+            "locations": _names(locations),
+            "instances": instances,
+        }
+        try:
+            with temp_path.open("wb") as handle:
+                pickle.dump(sidecar, handle, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError as e:
+            # The artifact may be in a read-only directory, in which case
+            # the instances just aren't cached.
+            if self.debug:
+                print(f"Could not write {path}: {e}")
+            return
+        self._sidecar = sidecar
+
+    def get_tracking_instances(self, locations: Optional[Locations] = None,
+                               window: Optional[TimeWindow] = None
+                               ) -> TrackingInstances:
+        """Returns the tracking instances of the given locations (or every
+        location the measurement holds, if None), in requests made in window
+        (or at any time, if None).
+
+        The sidecar always holds every request, so that any window can be
+        cut out of it."""
+        if locations is None:
+            locations = self.locations
+        sidecar = self._sidecar
+        if (sidecar is not None and
+                sidecar["locations"] == _names(locations)):
+            STATS.count("sidecar.hits")
+            return _in_window(sidecar["instances"], window)
+        # Without a sidecar to write, the window is cut out while deriving
+        # the instances (which, for columnar artifacts, skips the requests
+        # outside it without decoding them).
+        instances: TrackingInstances = self._load().get_tracking_instances(
+            locations, None if self.use_sidecar else window)
+        # The measurement isn't needed anymore, and can be much larger than
+        # the instances derived from it.
+        self._measurement = None
+        if not self.use_sidecar:
+            return instances
+        STATS.count("sidecar.misses")
+        with STATS.timer("sidecar"):
+            self._write_sidecar(locations, instances)
+        return _in_window(instances, window)
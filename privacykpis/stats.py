@@ -0,0 +1,144 @@
+"""Per-stage timers and counters for the processing scripts.
+
+Timers and counters are always on, and cost a couple of perf_counter() calls
+and dict updates each, so they can be left on in production runs;
+serialize.py and extract.py only decide whether to write the report out
+(with --stats).
+
+Stage times are inclusive, so a stage that runs inside another (e.g. "filter"
+inside "tracking_insert") is counted in both. When serializing with several
+jobs, stage times and counters are summed across worker processes, but
+cache stats are only those of the main process.
+"""
+import json
+import pathlib
+import resource
+import sys
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+# Timer totals and counters, in a form that can be sent between processes.
+Snapshot = Tuple[Dict[str, Tuple[float, int]], Dict[str, int]]
+
+
+class Timer:
+    """Accumulates the time spent in, and number of calls to, a stage. Use as
+    a context manager, around each call."""
+    __slots__ = ("seconds", "calls", "started")
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.seconds += time.perf_counter() - self.started
+        self.calls += 1
+
+
+class Stats:
+    timers: Dict[str, Timer]
+    counters: Dict[str, int]
+    # Functions returning the stats of caches (see privacykpis.cache), by
+    # name, so they can be included in the report.
+    caches: Dict[str, Callable[[], Dict[str, int]]]
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.timers = {}
+        self.counters = {}
+        self.caches = {}
+
+    def timer(self, name: str) -> Timer:
+        """Returns the timer for the named stage. Hot code paths should look
+        their timers up once, and keep them."""
+        try:
+            return self.timers[name]
+        except KeyError:
+            self.timers[name] = Timer()
+            return self.timers[name]
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_cache(self, name: str,
+                  cache_stats: Callable[[], Dict[str, int]]) -> None:
+        self.caches[name] = cache_stats
+
+    def snapshot(self) -> Snapshot:
+        timers = {name: (timer.seconds, timer.calls)
+                  for name, timer in self.timers.items() if timer.calls}
+        return timers, dict(self.counters)
+
+    def reset(self) -> None:
+        # Timers are zeroed in place, since callers may hold on to them.
+        for timer in self.timers.values():
+            timer.seconds = 0.0
+            timer.calls = 0
+        self.counters = {}
+
+    def merge(self, snapshot: Snapshot) -> None:
+        """Adds the totals from another process's snapshot to this one."""
+        timers, counters = snapshot
+        for name, (seconds, calls) in timers.items():
+            timer = self.timer(name)
+            timer.seconds += seconds
+            timer.calls += calls
+        for name, amount in counters.items():
+            self.count(name, amount)
+
+    def report(self, script: str) -> Dict[str, Any]:
+        wall_seconds = time.perf_counter() - self.started
+        own_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+        rss_scale = 1024 if sys.platform == "darwin" else 1
+
+        tokens: Dict[str, Dict[str, int]] = {}
+        counters: Dict[str, int] = {}
+        for name, amount in sorted(self.counters.items()):
+            if name.startswith("tokens."):
+                _, verdict, location = name.split(".")
+                tokens.setdefault(location, {"kept": 0, "filtered": 0})
+                tokens[location][verdict] = amount
+            else:
+                counters[name] = amount
+
+        requests = self.counters.get("requests", 0)
+        return {
+            "script": script,
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": (own_usage.ru_utime + own_usage.ru_stime +
+                            child_usage.ru_utime + child_usage.ru_stime),
+            "peak_rss_kb": own_usage.ru_maxrss // rss_scale,
+            "peak_child_rss_kb": child_usage.ru_maxrss // rss_scale,
+            "requests_per_second": (requests / wall_seconds
+                                    if requests and wall_seconds else None),
+            "stages": {
+                name: {"seconds": timer.seconds, "calls": timer.calls}
+                for name, timer in sorted(self.timers.items())
+                if timer.calls},
+            "counters": counters,
+            "tokens": tokens,
+            "caches": {name: cache_stats()
+                       for name, cache_stats in self.caches.items()},
+        }
+
+    def write(self, path: Optional[pathlib.Path], script: str) -> bool:
+        if path is None:
+            return False
+        path.write_text(json.dumps(self.report(script), indent=2))
+        return True
+
+
+STATS = Stats()
+
+
+def token_counter(verdict: str, location_name: str) -> str:
+    """Returns the counter name for tokens kept or filtered, per location."""
+    return f"tokens.{verdict}.{location_name}"
@@ -0,0 +1,66 @@
+"""Request timestamps, as integer microseconds since the Unix epoch.
+
+Recorded timestamps are naive local times (see
+resources/scripts/log_headers.py), so they're converted with plain calendar
+arithmetic, as if they were UTC, and convert back to the same string.
+Timestamps with a timezone are converted to UTC first.
+
+Integers take a fraction of the memory of ISO strings, compare without
+parsing, and can be stored as int64 columns (see privacykpis.columnar), so
+that restricting a measurement to a TimeWindow is a comparison per request,
+instead of a re-serialization.
+"""
+import datetime
+from typing import NamedTuple, Optional, Tuple, Union
+
+from privacykpis.types import EpochMicros, ISOTimestamp
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def from_datetime(timestamp: datetime.datetime) -> EpochMicros:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(
+            datetime.timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // _MICROSECOND
+
+
+def parse(timestamp: ISOTimestamp) -> EpochMicros:
+    """Parses a timestamp in any format datetime.fromisoformat() reads."""
+    return from_datetime(datetime.datetime.fromisoformat(timestamp))
+
+
+def epoch_micros(timestamp: Union[EpochMicros, ISOTimestamp]) -> EpochMicros:
+    """Returns timestamp as an integer, parsing it if it's a string (as
+    timestamps in measurements written before they were integers are)."""
+    if isinstance(timestamp, str):
+        return parse(timestamp)
+    return timestamp
+
+
+def isoformat(timestamp: EpochMicros) -> ISOTimestamp:
+    """Returns timestamp as an ISO string, as written in reports."""
+    return (EPOCH + timestamp * _MICROSECOND).isoformat()
+
+
+class TimeWindow(NamedTuple):
+    """The requests made at or after start, and before end. Either bound
+    can be None, for a window open on that side."""
+    start: Optional[EpochMicros] = None
+    end: Optional[EpochMicros] = None
+
+    def bounds(self) -> Tuple[EpochMicros, EpochMicros]:
+        """Returns the window as a half open range of integers, with open
+        sides replaced by the widest bounds an int64 can hold."""
+        start = -(1 << 63) if self.start is None else self.start
+        end = (1 << 63) - 1 if self.end is None else self.end
+        return start, end
+
+    def is_unbounded(self) -> bool:
+        return self.start is None and self.end is None
+
+    def contains(self, timestamp: EpochMicros) -> bool:
+        start, end = self.bounds()
+        return start <= timestamp < end
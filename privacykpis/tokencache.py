@@ -0,0 +1,243 @@
+"""On-disk cache of tokenized requests, shared across runs and processes.
+
+Crawls with several profiles and browsers send many byte-identical requests
+(the same tracker pixels, the same bodies, the same Cookie headers), so each
+request's tokens are cached under a hash of everything
+tokenizing.from_record reads from it. The cache is a SQLite database in WAL
+mode, so any number of serialize.py processes (and worker processes) can
+read and write it at the same time.
+
+New entries are written in batches. Once a run is done with the cache, the
+least recently used entries are evicted until the cache is back under its
+maximum size.
+"""
+import hashlib
+import os
+import pathlib
+import pickle
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import ParseResult
+
+import privacykpis.codec
+import privacykpis.tokenizing
+from privacykpis.stats import STATS
+from privacykpis.tokenizing import BodyDataEncoding, RecordParseResult
+
+
+TOKEN_CACHE_SIZE_MB = 512
+# Number of new entries (and hits) to hold in memory between writes.
+FLUSH_EVERY = 1000
+# Seconds to wait for other processes to finish writing to the cache.
+LOCK_TIMEOUT = 60
+# The only headers tokenizing.from_record reads.
+TOKENIZED_HEADERS = ("cookie", "content-type")
+TOKEN_CACHE_TIMER = STATS.timer("token_cache")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_by_use ON tokens (used, size);
+"""
+
+
+def record_key(record: Dict[str, Any]) -> bytes:
+    """Returns the key a recorded request's tokens are cached under.
+
+    The key also covers the tokenizer's version and settings, so that
+    tokens from older code, or from runs with other settings, are never
+    used (they're evicted once they're the least recently used)."""
+    headers = [[name.lower(), value] for name, value in record["headers"]
+               if name.lower() in TOKENIZED_HEADERS]
+    data = privacykpis.codec.dumps([
+        privacykpis.tokenizing.TOKENIZER_VERSION,
+        privacykpis.tokenizing.MAX_BODY_SIZE,
+        sorted(loc.value for loc in privacykpis.tokenizing.LOCATIONS),
+        record["url"], headers, record["body"]])
+    return hashlib.sha256(data.encode("utf-8", "surrogatepass")).digest()
+
+
+def _encode(result: RecordParseResult) -> bytes:
+    return pickle.dumps((result.cookies, result.path, result.query,
+                         result.body, result.body_encoding.value),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(value: bytes) -> RecordParseResult:
+    result = RecordParseResult()
+    (result.cookies, result.path, result.query, result.body,
+     body_encoding) = pickle.loads(value)
+    result.body_encoding = BodyDataEncoding(body_encoding)
+    return result
+
+
+class TokenCache:
+    path: pathlib.Path
+    max_size: int
+    # New entries, and the keys of entries used, since the last flush.
+    pending: Dict[bytes, bytes]
+    used: List[bytes]
+
+    def __init__(self, path: pathlib.Path, max_size_mb: int) -> None:
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.pending = {}
+        self.used = []
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared with forked worker processes,
+        # so each process opens its own.
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(str(self.path),
+                                         timeout=LOCK_TIMEOUT,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key: bytes) -> Optional[RecordParseResult]:
+        value = self.pending.get(key)
+        if value is None:
+            row = self._connect().execute(
+                "SELECT value FROM tokens WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value = row[0]
+            self.used.append(key)
+        self.hits += 1
+        return _decode(value)
+
+    def put(self, key: bytes, result: RecordParseResult) -> None:
+        self.pending[key] = _encode(result)
+        if len(self.pending) + len(self.used) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending and not self.used:
+            return
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Entries are keyed by their content, so an entry another
+            # process has added in the meantime is the same as ours.
+            connection.executemany(
+                "INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?)",
+                [(key, value, len(key) + len(value), now)
+                 for key, value in self.pending.items()])
+            connection.executemany(
+                "UPDATE tokens SET used = ? WHERE key = ?",
+                [(now, key) for key in self.used])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.pending = {}
+        self.used = []
+
+    def evict(self) -> None:
+        """Removes the least recently used entries, until the cache is no
+        larger than max_size."""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            size = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tokens").fetchone()[0]
+            evicted = []
+            if size > self.max_size:
+                rows = connection.execute(
+                    "SELECT rowid, size FROM tokens ORDER BY used")
+                for rowid, entry_size in rows:
+                    if size <= self.max_size:
+                        break
+                    evicted.append((rowid,))
+                    size -= entry_size
+            connection.executemany("DELETE FROM tokens WHERE rowid = ?",
+                                   evicted)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self.evicted += len(evicted)
+
+    def close(self) -> None:
+        self.flush()
+        self.evict()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+        }
+
+
+TOKEN_CACHE: Optional[TokenCache] = None
+
+
+def open_cache(path: Optional[pathlib.Path], max_size_mb: int) -> bool:
+    global TOKEN_CACHE
+    if path is None:
+        return False
+    TOKEN_CACHE = TokenCache(path, max_size_mb)
+    STATS.add_cache("token_cache", TOKEN_CACHE.stats)
+    return True
+
+
+def flush_cache() -> None:
+    if TOKEN_CACHE is not None:
+        with TOKEN_CACHE_TIMER:
+            TOKEN_CACHE.flush()
+
+
+def close_cache() -> Dict[str, int]:
+    """Writes out and closes the token cache, if one is open, and returns
+    its final stats."""
+    global TOKEN_CACHE
+    if TOKEN_CACHE is None:
+        return {}
+    with TOKEN_CACHE_TIMER:
+        TOKEN_CACHE.close()
+    stats = TOKEN_CACHE.stats()
+    TOKEN_CACHE = None
+    return stats
+
+
+def cache_stats() -> Dict[str, int]:
+    return TOKEN_CACHE.stats() if TOKEN_CACHE is not None else {}
+
+
+def from_record(record: Dict[str, Any],
+                parsed_url: Optional[ParseResult] = None
+                ) -> RecordParseResult:
+    """Tokenizes a recorded request, as tokenizing.from_record does, but
+    using the token cache if one is open."""
+    if TOKEN_CACHE is None:
+        return privacykpis.tokenizing.from_record(record, parsed_url)
+    with TOKEN_CACHE_TIMER:
+        key = record_key(record)
+        result = TOKEN_CACHE.get(key)
+    if result is not None:
+        return result
+    result = privacykpis.tokenizing.from_record(record, parsed_url)
+    with TOKEN_CACHE_TIMER:
+        TOKEN_CACHE.put(key, result)
+    return result
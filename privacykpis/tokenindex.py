@@ -0,0 +1,196 @@
+"""An inverted index from token values (and keys) to where they were sent.
+
+The index is a SQLite database, meant to be added to by every extract.py run
+over months of crawls, and answers "which third parties received this
+value, from which first parties, and when" with a single indexed lookup.
+
+Each run (a measurement file) is indexed under its path. Re-indexing a run
+replaces its postings, so a measurement can be re-indexed after it's been
+extended (with serialize.py --resume).
+
+Keys and values are stored as UTF-8 BLOBs (with lone surrogates kept, as in
+privacykpis.codec), so that prefix lookups are plain index range scans: no
+UTF-8 encoding starts with the byte 0xff, so every value starting with a
+prefix sorts between the prefix and the prefix followed by 0xff.
+"""
+import os
+import pathlib
+import sqlite3
+from typing import Any, Dict, Iterable, List, Tuple
+
+from privacykpis.serialize import TrackingInstances
+from privacykpis.stats import STATS
+from privacykpis.timestamps import isoformat
+from privacykpis.types import TokenLocation
+
+
+STRING_ENCODING = "utf-8"
+STRING_ERRORS = "surrogatepass"
+# Seconds to wait for other processes to finish writing to the index.
+LOCK_TIMEOUT = 60
+INDEX_TIMER = STATS.timer("index")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS domains (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    id INTEGER PRIMARY KEY,
+    value BLOB NOT NULL,
+    key BLOB NOT NULL,
+    location INTEGER NOT NULL,
+    UNIQUE (value, key, location)
+);
+CREATE INDEX IF NOT EXISTS tokens_by_key ON tokens (key);
+CREATE TABLE IF NOT EXISTS postings (
+    token INTEGER NOT NULL,
+    run INTEGER NOT NULL,
+    third_party INTEGER NOT NULL,
+    first_party INTEGER NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_by_token ON postings (token);
+CREATE INDEX IF NOT EXISTS postings_by_run ON postings (run);
+"""
+
+_LOOKUP = """
+SELECT tokens.value, tokens.key, tokens.location, third_parties.name,
+       first_parties.name, postings.timestamp, runs.name
+FROM tokens
+JOIN postings ON postings.token = tokens.id
+JOIN domains AS third_parties ON third_parties.id = postings.third_party
+JOIN domains AS first_parties ON first_parties.id = postings.first_party
+JOIN runs ON runs.id = postings.run
+WHERE {condition}
+ORDER BY tokens.value, tokens.key, postings.timestamp
+"""
+
+Posting = Dict[str, Any]
+
+
+def _encode(string: str) -> bytes:
+    return string.encode(STRING_ENCODING, STRING_ERRORS)
+
+
+def _decode(data: bytes) -> str:
+    return data.decode(STRING_ENCODING, STRING_ERRORS)
+
+
+def _postings(instances: TrackingInstances
+              ) -> Iterable[Tuple[bytes, bytes, int, str, str, str]]:
+    string = instances.strings.string
+    for three_p, tokens_for_three_p in instances.token_collection.items():
+        three_p_str = string(three_p)
+        for (loc, key, value), first_ps in tokens_for_three_p.items():
+            value_bytes = _encode(string(value))
+            key_bytes = _encode(string(key))
+            for first_p, timestamps in first_ps.items():
+                first_p_str = string(first_p)
+                for _, timestamp in timestamps:
+                    yield (value_bytes, key_bytes, loc, three_p_str,
+                           first_p_str, isoformat(timestamp))
+
+
+class TokenIndex:
+    path: pathlib.Path
+    connection: sqlite3.Connection
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(str(path), timeout=LOCK_TIMEOUT,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+
+    def add_run(self, name: str, instances: TrackingInstances) -> int:
+        """Indexes every token in instances under the run name, replacing
+        anything previously indexed for that run. Returns the number of
+        postings added."""
+        connection = self.connection
+        with INDEX_TIMER:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("INSERT OR IGNORE INTO runs (name) "
+                                   "VALUES (?)", (name,))
+                run_id, = connection.execute(
+                    "SELECT id FROM runs WHERE name = ?", (name,)).fetchone()
+                connection.execute("DELETE FROM postings WHERE run = ?",
+                                   (run_id,))
+                # Postings are staged as strings, and the ids of their
+                # tokens and domains are then filled in by SQLite, in bulk.
+                connection.execute(
+                    "CREATE TEMP TABLE staged (value BLOB, key BLOB, "
+                    "location INTEGER, third_party TEXT, first_party TEXT, "
+                    "timestamp TEXT)")
+                connection.executemany(
+                    "INSERT INTO staged VALUES (?, ?, ?, ?, ?, ?)",
+                    _postings(instances))
+                connection.execute(
+                    "INSERT OR IGNORE INTO tokens (value, key, location) "
+                    "SELECT DISTINCT value, key, location FROM staged")
+                connection.execute(
+                    "INSERT OR IGNORE INTO domains (name) "
+                    "SELECT third_party FROM staged "
+                    "UNION SELECT first_party FROM staged")
+                cursor = connection.execute("""
+                    INSERT INTO postings
+                    SELECT tokens.id, ?, third_parties.id, first_parties.id,
+                           staged.timestamp
+                    FROM staged
+                    JOIN tokens ON tokens.value = staged.value
+                        AND tokens.key = staged.key
+                        AND tokens.location = staged.location
+                    JOIN domains AS third_parties
+                        ON third_parties.name = staged.third_party
+                    JOIN domains AS first_parties
+                        ON first_parties.name = staged.first_party
+                """, (run_id,))
+                added: int = cursor.rowcount
+                connection.execute("DROP TABLE staged")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        STATS.count("index.postings", added)
+        return added
+
+    def lookup(self, string: str, prefix: bool = False,
+               by_key: bool = False) -> List[Posting]:
+        """Returns where tokens with the given value (or key, if by_key) were
+        sent. If prefix is set, tokens whose value (or key) starts with
+        string are returned too."""
+        column = "tokens.key" if by_key else "tokens.value"
+        if prefix:
+            condition = f"{column} >= ? AND {column} < ?"
+            params: Tuple[Any, ...] = (_encode(string),
+                                       _encode(string) + b"\xff")
+        else:
+            condition = f"{column} = ?"
+            params = (_encode(string),)
+        with INDEX_TIMER:
+            rows = self.connection.execute(
+                _LOOKUP.format(condition=condition), params).fetchall()
+        return [{
+            "value": _decode(value),
+            "key": _decode(key),
+            "location": TokenLocation.from_int(loc).name,
+            "third_party": third_party,
+            "first_party": first_party,
+            "timestamp": timestamp,
+            "run": run,
+        } for value, key, loc, third_party, first_party, timestamp, run
+            in rows]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def run_name(path: str) -> str:
+    """The name a measurement file is indexed under."""
+    return os.path.abspath(path)
@@ -1,13 +1,91 @@
 from enum import Enum
 import json
+import json.decoder
 import http.cookies
-from typing import Any, Dict, List, Optional, Tuple, Union
-from urllib.parse import parse_qsl, urlparse
-
+import re
+import string
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional
+from typing import Tuple, TYPE_CHECKING, Union
+from urllib.parse import parse_qsl, urlparse, ParseResult
+
+from privacykpis.cache import LRUCache
+import privacykpis.codec
 import privacykpis.filters
+from privacykpis.stats import STATS, token_counter
 from privacykpis.types import TokenKey, TokenValue, TokenLocation, KeyValueList
 from privacykpis.types import Token
 
+if TYPE_CHECKING:
+    from privacykpis.interning import StringTable
+
+
+FILTER_TIMER = STATS.timer("filter")
+TOKENIZE_TIMER = STATS.timer("tokenize")
+KEPT_COUNTERS = {loc: token_counter("kept", loc.name) for loc in TokenLocation}
+FILTERED_COUNTERS = {loc: token_counter("filtered", loc.name)
+                     for loc in TokenLocation}
+
+ALL_LOCATIONS = frozenset(TokenLocation)
+# The locations tokens are extracted from. Requests aren't parsed at all for
+# tokens in the other locations.
+LOCATIONS: FrozenSet[TokenLocation] = ALL_LOCATIONS
+# Bump this whenever a change to the tokenizer could change its output, so
+# that tokens cached (on disk) by older versions are not used.
+TOKENIZER_VERSION = 2
+COOKIE_CACHE_SIZE = 100000
+# Maps Cookie headers to the key/value pairs in them. Pages send the same
+# Cookie header with many of their requests to a third party, so most
+# headers are only parsed once.
+COOKIES: LRUCache[str, Tuple[Tuple[TokenKey, TokenValue], ...]] = LRUCache(
+    COOKIE_CACHE_SIZE)
+STATS.add_cache("cookie_headers", COOKIES.stats)
+
+# The same cookie syntax http.cookies.SimpleCookie accepts.
+_COOKIE_KEY_CHARS = r"\w\d!#%&'~_`><@,:/\$\*\+\-\.\^\|\)\(\?\}\{\="
+_COOKIE_VALUE_CHARS = _COOKIE_KEY_CHARS + r"\[\]"
+COOKIE_PATTERN = re.compile(r"""
+    \s*
+    (?P<key>[""" + _COOKIE_KEY_CHARS + r"""]+?)
+    (
+    \s*=\s*
+    (?P<val>
+    "(?:[^\\"]|\\.)*"
+    |
+    \w{3},\s[\w\d\s-]{9,11}\s[\d:]{8}\sGMT
+    |
+    [""" + _COOKIE_VALUE_CHARS + r"""]*
+    )
+    )?
+    \s*
+    (\s+|;|$)
+    """, re.ASCII | re.VERBOSE)
+LEGAL_COOKIE_KEY = re.compile(
+    "[" + re.escape(string.ascii_letters + string.digits +
+                    "!#$%&'*+-.^_`|~:") + "]+")
+# Cookie attributes, rather than cookies.
+COOKIE_ATTRIBUTES = frozenset([
+    "expires", "path", "comment", "domain", "max-age", "secure", "httponly",
+    "version", "samesite"])
+# Only used to unquote cookie values.
+_COOKIE_DECODER = http.cookies.SimpleCookie()
+
+# Bodies longer than this (in characters) aren't tokenized. Multipart bodies
+# are scanned in place, so are tokenized whatever their size, but their text
+# fields longer than this aren't.
+MAX_BODY_SIZE = 1024 * 1024
+# JSON bodies longer than this are walked incrementally (see
+# _kvs_from_large_json), instead of being decoded in full.
+LARGE_JSON_BODY_SIZE = 64 * 1024
+# Large JSON bodies are walked one value at a time down to this depth, and
+# values nested deeper than this are decoded whole. Must be at least 2, so
+# that the members of objects in top level arrays are walked.
+INCREMENTAL_JSON_DEPTH = 2
+JSON_WHITESPACE = " \t\n\r"
+_JSON_WHITESPACE_RUN = re.compile(f"[{JSON_WHITESPACE}]*")
+# Decodes the JSON value (other than an object or array) starting at an
+# index, as json.loads would.
+_SCAN_JSON_VALUE = json.JSONDecoder().scan_once  # type: ignore
+
 
 class BodyDataEncoding(Enum):
     UNKNOWN = 1
@@ -31,15 +109,36 @@ class RecordParseResult:
         self.body_encoding = BodyDataEncoding.UNKNOWN
 
 
-def flaten_identifiers(graph_data: Dict[Any, Any]) -> List[Token]:
-    identifiers = []
-    for loc in TokenLocation:
-        if graph_data[loc.name] is None:
-            continue
-        for key, value in graph_data[loc.name]:
-            if privacykpis.filters.should_ignore_token(value):
-                continue
-            identifiers.append((loc.value, key, value))
+def flaten_identifiers(graph_data: Dict[Any, Any],
+                       strings: Optional["StringTable"] = None,
+                       locations: FrozenSet[TokenLocation] = ALL_LOCATIONS
+                       ) -> List[Any]:
+    """Returns the tokens in graph_data (from the given locations) that
+    could be identifiers.
+
+    If strings is given, the keys and values in graph_data are ids in that
+    table, and the returned tokens hold ids too."""
+    located_kvs = [(loc, graph_data[loc.name]) for loc in TokenLocation
+                   if loc in locations and graph_data[loc.name] is not None]
+    values = [value for _, kvs in located_kvs for _, value in kvs]
+    if strings is not None:
+        values = [strings.string(value) for value in values]
+    # All the values are filtered at once, which is cheaper than one at a
+    # time.
+    with FILTER_TIMER:
+        ignored = privacykpis.filters.should_ignore_tokens(values)
+
+    identifiers: List[Any] = []
+    index = 0
+    for loc, kvs in located_kvs:
+        num_kept = len(identifiers)
+        for key, value in kvs:
+            if not ignored[index]:
+                identifiers.append((loc.value, key, value))
+            index += 1
+        num_kept = len(identifiers) - num_kept
+        STATS.count(KEPT_COUNTERS[loc], num_kept)
+        STATS.count(FILTERED_COUNTERS[loc], len(kvs) - num_kept)
     return identifiers
 
 
@@ -55,37 +154,83 @@ def guess_body_format(header_content_type: str) -> BodyDataEncoding:
     return BodyDataEncoding.UNKNOWN
 
 
-def from_record(record: Dict[str, Any]) -> RecordParseResult:
+def from_record(record: Dict[str, Any],
+                parsed_url: Optional[ParseResult] = None) -> RecordParseResult:
+    """Tokenizes a recorded request. Callers that have already parsed the
+    request's URL can pass it as parsed_url, to avoid parsing it again."""
+    with TOKENIZE_TIMER:
+        return _from_record(record, parsed_url)
+
+
+def _from_record(record: Dict[str, Any],
+                 parsed_url: Optional[ParseResult]) -> RecordParseResult:
     result = RecordParseResult()
+    locations = LOCATIONS
 
     body_encoding = BodyDataEncoding.UNKNOWN
+    content_type = ""
     for name, value in record["headers"]:
         lower_header = name.lower()
         if lower_header == "cookie":
-            result.cookies = kvs_from_cookies(value)
+            if TokenLocation.COOKIE in locations:
+                result.cookies = kvs_from_cookies(value)
             continue
         if lower_header == "content-type":
             body_encoding = guess_body_format(value)
+            content_type = value
             continue
 
-    parsed_url = urlparse(record["url"])
-    if parsed_url.path:
-        result.path = kvs_from_url_path(parsed_url.path)
-
-    if parsed_url.query:
-        result.query = kvs_from_url_query(parsed_url.query)
-
-    result.body = kvs_from_body(body_encoding, record["body"])
+    if (TokenLocation.PATH in locations or
+            TokenLocation.QUERY_PARAM in locations):
+        if parsed_url is None:
+            parsed_url = urlparse(record["url"])
+        if parsed_url.path and TokenLocation.PATH in locations:
+            result.path = kvs_from_url_path(parsed_url.path)
+        if parsed_url.query and TokenLocation.QUERY_PARAM in locations:
+            result.query = kvs_from_url_query(parsed_url.query)
+
+    if TokenLocation.BODY in locations:
+        result.body = kvs_from_body(body_encoding, record["body"],
+                                    content_type)
     result.body_encoding = body_encoding
     return result
 
 
+def set_locations(locations: Iterable[TokenLocation]) -> None:
+    global LOCATIONS
+    LOCATIONS = frozenset(locations)
+
+
 def kvs_from_cookies(cookie_header: str) -> KeyValueList:
-    try:
-        cookies: Any = http.cookies.SimpleCookie(cookie_header)
-        return [(k, v.value) for k, v in cookies.items()]
-    except http.cookies.CookieError:
-        return []
+    return list(COOKIES.get(cookie_header, _kvs_from_cookies))
+
+
+def _kvs_from_cookies(
+        cookie_header: str) -> Tuple[Tuple[TokenKey, TokenValue], ...]:
+    """Returns the same cookies as http.cookies.SimpleCookie would, except
+    that malformed pairs are skipped, instead of making SimpleCookie drop
+    every pair in the header."""
+    cookies: Dict[TokenKey, TokenValue] = {}
+    index = 0
+    while index < len(cookie_header):
+        match = COOKIE_PATTERN.match(cookie_header, index)
+        if match is None:
+            # Skip to the next pair.
+            index = cookie_header.find(";", index)
+            if index == -1:
+                break
+            index += 1
+            continue
+        index = match.end()
+        key, value = match.group("key"), match.group("val")
+        if (value is None or key[0] == "$" or
+                key.lower() in COOKIE_ATTRIBUTES or
+                not LEGAL_COOKIE_KEY.fullmatch(key)):
+            continue
+        if value.startswith('"'):
+            value = _COOKIE_DECODER.value_decode(value)[0]
+        cookies[key] = value
+    return tuple(cookies.items())
 
 
 def kvs_from_url_path(url_path: str) -> KeyValueList:
@@ -97,10 +242,27 @@ def kvs_from_url_query(url_query: str) -> KeyValueList:
     return parse_qsl(url_query)
 
 
+def _is_json_container(body: str) -> bool:
+    # Only JSON objects and arrays can hold tokens, and any other body is
+    # either some other JSON value or not JSON at all, so the rest of the
+    # body doesn't need to be decoded to tell.
+    start = body.lstrip(JSON_WHITESPACE)[:1]
+    end = body.rstrip(JSON_WHITESPACE)[-1:]
+    return (start == "{" and end == "}") or (start == "[" and end == "]")
+
+
 def kvs_from_json_str(body: str) -> Optional[KeyValueList]:
+    if not _is_json_container(body):
+        return None
+    if len(body) > LARGE_JSON_BODY_SIZE:
+        try:
+            return _kvs_from_large_json(body)
+        except ValueError:
+            return None
+
     try:
-        json_data = json.loads(body)
-    except json.JSONDecodeError:
+        json_data = privacykpis.codec.loads(body)
+    except (json.JSONDecodeError, RecursionError):
         return None
 
     if json_data is None:
@@ -121,29 +283,276 @@ def kvs_from_json_str(body: str) -> Optional[KeyValueList]:
     except AttributeError:
         return None
 
-    for key, value in json_data.items():
-        if isinstance(value, str):
-            kvs.append((key, value))
-        else:
-            longest_child = longest_value_in_json(value)
-            if longest_child is not None:
-                kvs.append((key, longest_child))
+    try:
+        for key, value in json_data.items():
+            if isinstance(value, str):
+                kvs.append((key, value))
+            else:
+                longest_child = longest_value_in_json(value)
+                if longest_child is not None:
+                    kvs.append((key, longest_child))
+    except RecursionError:
+        return None
     return kvs
 
 
-def kvs_from_body(body_format: BodyDataEncoding,
-                  body: str) -> Optional[KeyValueList]:
+def kvs_from_body(body_format: BodyDataEncoding, body: str,
+                  content_type: str = "") -> Optional[KeyValueList]:
+    if body_format == BodyDataEncoding.FORM_MULTIPART:
+        boundary = multipart_boundary(content_type)
+        if boundary is None:
+            return None
+        return kvs_from_multipart(body, boundary, MAX_BODY_SIZE)
+    if len(body) > MAX_BODY_SIZE:
+        STATS.count("bodies.oversized")
+        return None
     if body_format == BodyDataEncoding.JSON:
         return kvs_from_json_str(body)
     if body_format == BodyDataEncoding.UNKNOWN:
         return kvs_from_json_str(body)
     if body_format == BodyDataEncoding.FORM_URL_ENC:
         return parse_qsl(body)
-    if body_format == BodyDataEncoding.FORM_MULTIPART:
-        return None
     return None
 
 
+def _header_params(header_value: str) -> Dict[str, str]:
+    # The parameters of a header like Content-Type or Content-Disposition
+    # (e.g. 'form-data; name="uid"' -> {"name": "uid"}).
+    params = {}
+    for param in header_value.split(";")[1:]:
+        name, separator, value = param.partition("=")
+        if not separator:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        params[name.strip().lower()] = value
+    return params
+
+
+def multipart_boundary(content_type: str) -> Optional[str]:
+    return _header_params(content_type).get("boundary") or None
+
+
+def _find_multipart_delimiter(body: str, delimiter: str, start: int) -> int:
+    # Delimiters only count at the start of a line.
+    index = body.find(delimiter, start)
+    while index > 0 and body[index - 1] != "\n":
+        index = body.find(delimiter, index + 1)
+    return index
+
+
+def iter_multipart_fields(body: str, boundary: str,
+                          max_value_size: Optional[int] = None
+                          ) -> Iterator[Tuple[str, str]]:
+    """Yields the name and value of each text field in a multipart/form-data
+    body (skipping values longer than max_value_size, if given).
+
+    The body is scanned in place, one part at a time. Only the headers and
+    values of text fields are copied out of it, and file parts (parts with
+    a filename) are skipped over without being copied at all."""
+    delimiter = "--" + boundary
+    index = _find_multipart_delimiter(body, delimiter, 0)
+    while index != -1:
+        index += len(delimiter)
+        if body.startswith("--", index):
+            # The closing delimiter.
+            return
+
+        # Read the part's headers, up to the first empty line.
+        name = None
+        is_file = False
+        line_start = body.find("\n", index) + 1
+        while line_start != 0:
+            line_end = body.find("\n", line_start)
+            if line_end == -1:
+                return
+            line = body[line_start:line_end].rstrip("\r")
+            line_start = line_end + 1
+            if not line:
+                break
+            header, _, value = line.partition(":")
+            if header.strip().lower() == "content-disposition":
+                params = _header_params(value)
+                name = params.get("name")
+                is_file = "filename" in params or "filename*" in params
+        else:
+            return
+
+        next_index = _find_multipart_delimiter(body, delimiter, line_start)
+        if next_index == -1:
+            # A truncated part.
+            return
+        if name is not None and not is_file:
+            # The line break before the delimiter is part of the delimiter.
+            value_end = next_index - 1
+            if body[value_end - 1:value_end] == "\r":
+                value_end -= 1
+            if (max_value_size is not None and
+                    value_end - line_start > max_value_size):
+                STATS.count("bodies.oversized_fields")
+            else:
+                yield name, body[line_start:max(value_end, line_start)]
+        index = next_index
+
+
+def kvs_from_multipart(body: str, boundary: str,
+                       max_value_size: Optional[int] = None) -> KeyValueList:
+    return list(iter_multipart_fields(body, boundary, max_value_size))
+
+
+def set_max_body_size(max_size: int) -> None:
+    global MAX_BODY_SIZE
+    MAX_BODY_SIZE = max_size
+
+
+def _shortest_value(values: Iterable[Optional[TokenValue]]
+                    ) -> Optional[TokenValue]:
+    # The same value longest_value_in_json picks from a list of values.
+    shortest = None
+    for value in values:
+        if value is None:
+            continue
+        if shortest is None or len(shortest) > len(value):
+            shortest = value
+    return shortest
+
+
+class _JSONObject:
+    """An object being walked by _kvs_from_large_json."""
+    __slots__ = ("values", "key")
+
+    def __init__(self) -> None:
+        # The value longest_value_in_json would pick for each member.
+        self.values: Dict[str, Optional[TokenValue]] = {}
+        self.key = ""
+
+
+class _JSONArray:
+    """An array being walked by _kvs_from_large_json."""
+    __slots__ = ("shortest", "first", "length")
+
+    def __init__(self) -> None:
+        self.shortest: Optional[TokenValue] = None
+        # The array's first element, if it's an object.
+        self.first: Optional[_JSONObject] = None
+        self.length = 0
+
+
+def _json_object_kvs(obj: Optional[_JSONObject]) -> Optional[KeyValueList]:
+    if obj is None or len(obj.values) == 0:
+        return None
+    return [(key, value) for key, value in obj.values.items()
+            if value is not None]
+
+
+def _skip_json_whitespace(body: str, index: int) -> int:
+    return _JSON_WHITESPACE_RUN.match(body, index).end()  # type: ignore
+
+
+def _json_string(body: str, index: int) -> Tuple[str, int]:
+    # index is the index of the opening quote.
+    return json.decoder.scanstring(body, index + 1)  # type: ignore
+
+
+def _json_key(body: str, index: int) -> Tuple[str, int]:
+    if not body.startswith('"', index):
+        raise ValueError(f"expected a key at {index}")
+    key, index = _json_string(body, index)
+    index = _skip_json_whitespace(body, index)
+    if not body.startswith(":", index):
+        raise ValueError(f"expected ':' at {index}")
+    return key, _skip_json_whitespace(body, index + 1)
+
+
+def _kvs_from_large_json(body: str) -> Optional[KeyValueList]:
+    """Returns the same tokens as kvs_from_json_str, but without decoding
+    the whole body at once.
+
+    The body's structure is followed without recursion, down to
+    INCREMENTAL_JSON_DEPTH levels, and each value is reduced to the value
+    longest_value_in_json would pick for it as soon as it's decoded. So
+    memory use is bounded by the largest value nested deeper than that,
+    rather than by the size of the body. Raises ValueError if the body
+    isn't valid JSON, or is nested too deeply to decode."""
+    stack: List[Union[_JSONObject, _JSONArray]] = []
+    index = _skip_json_whitespace(body, 0)
+    while True:
+        # Decode the value starting at index.
+        value: Union[None, TokenValue, _JSONObject, _JSONArray]
+        char = body[index:index + 1]
+        if (char == "{" or char == "[") and (
+                len(stack) >= INCREMENTAL_JSON_DEPTH):
+            try:
+                nested, index = _SCAN_JSON_VALUE(body, index)
+                value = longest_value_in_json(nested)
+            except StopIteration:
+                raise ValueError(f"expected a value at {index}")
+            except RecursionError:
+                raise ValueError(f"nested too deeply at {index}")
+        elif char == "{" or char == "[":
+            index = _skip_json_whitespace(body, index + 1)
+            container = _JSONObject() if char == "{" else _JSONArray()
+            if not body.startswith("}" if char == "{" else "]", index):
+                stack.append(container)
+                if isinstance(container, _JSONObject):
+                    container.key, index = _json_key(body, index)
+                continue
+            index += 1
+            value = container
+        elif char == '"':
+            value, index = _json_string(body, index)
+        else:
+            try:
+                scalar, index = _SCAN_JSON_VALUE(body, index)
+            except StopIteration:
+                raise ValueError(f"expected a value at {index}")
+            value = None if scalar is None else str(scalar)
+
+        # Add the value to its parents, for as many of them as it closes.
+        while True:
+            if not stack:
+                if _skip_json_whitespace(body, index) != len(body):
+                    raise ValueError(f"extra data at {index}")
+                if isinstance(value, _JSONObject):
+                    return _json_object_kvs(value)
+                if isinstance(value, _JSONArray):
+                    if value.first is None:
+                        return []
+                    return _json_object_kvs(value.first)
+                return None
+
+            parent = stack[-1]
+            if isinstance(value, _JSONObject):
+                reduced = _shortest_value(value.values.values())
+            elif isinstance(value, _JSONArray):
+                reduced = value.shortest
+            else:
+                reduced = value
+            if isinstance(parent, _JSONObject):
+                parent.values[parent.key] = reduced
+                closer = "}"
+            else:
+                # Only the top level array's first element is kept.
+                if (parent.length == 0 and len(stack) == 1 and
+                        isinstance(value, _JSONObject)):
+                    parent.first = value
+                parent.length += 1
+                parent.shortest = _shortest_value([parent.shortest, reduced])
+                closer = "]"
+
+            index = _skip_json_whitespace(body, index)
+            if body.startswith(",", index):
+                index = _skip_json_whitespace(body, index + 1)
+                if isinstance(parent, _JSONObject):
+                    parent.key, index = _json_key(body, index)
+                break
+            if not body.startswith(closer, index):
+                raise ValueError(f"expected '{closer}' at {index}")
+            index += 1
+            value = stack.pop()
+
+
 def longest_value_in_json(value: Any) -> Optional[TokenValue]:
     if isinstance(value, str):
         return value
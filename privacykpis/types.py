@@ -34,11 +34,17 @@ Domain = str
 ThirdPartyDomain = Domain
 FirstPartyDomain = Domain
 ISOTimestamp = str
-RequestTimestamp = Tuple[Url, ISOTimestamp]
+# Microseconds since the Unix epoch (see privacykpis.timestamps).
+EpochMicros = int
+RequestTimestamp = Tuple[Url, EpochMicros]
 TokenKey = str
 TokenValue = str
 KeyValueList = List[Tuple[TokenKey, TokenValue]]
 Token = Tuple[TokenLocation, TokenKey, TokenValue]
+# Id of a string in a privacykpis.interning.StringTable.
+StringId = int
+InternedKeyValueList = List[Tuple[StringId, StringId]]
+InternedToken = Tuple[int, StringId, StringId]
 
 
 class RecordingHandles:
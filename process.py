@@ -4,6 +4,8 @@ from pathlib import Path
 import subprocess
 import sys
 
+from privacykpis.common import package_env
+
 THIS_SCRIPT_PATH = Path(__file__).parent
 PROCESS_SCRIPTS_PATH = THIS_SCRIPT_PATH / Path("process")
 DEFAULT_CODE_PATH = THIS_SCRIPT_PATH.resolve()
@@ -32,7 +34,7 @@ def _run_expand_py(input_dir: Path, output_dir: Path) -> None:
     expand_script_path = PROCESS_SCRIPTS_PATH / Path("expand.py")
     args = [str(expand_script_path), str(input_dir), str(expand_output_path)]
     print(args, file=sys.stderr)
-    subprocess.run(args, check=True)
+    subprocess.run(args, check=True, env=package_env())
 
 
 def _run_serialize_fish(code_dir: Path, output_dir: Path) -> None:
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
-import json
 import pathlib
 import sys
 
+# Needs the repository root on PYTHONPATH (process.py sets it).
+import privacykpis.codec
+
 input_dir = pathlib.Path(sys.argv[1])
 output_dir = sys.argv[2]
 
@@ -11,7 +13,7 @@ for input_file in input_dir.iterdir():
     if input_file.suffix != ".json":
         continue
     for line in input_file.open():
-        data = json.loads(line)
+        data = privacykpis.codec.loads(line, exact_integers=False)
         channel = data["channel"]
         browser = data["browser"]
         date = data["date"]
@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
 import json
 import sys
+from typing import Any, Iterable, Tuple
 
-data = json.load(open(sys.argv[1], 'r'))
-for third_party, tokens in data.items():
-    for token, first_parties in tokens.items():
-        first_party_names = list(first_parties.keys())
-        num_first_parties = len(first_party_names)
-        data_row = [third_party, token, num_first_parties, first_party_names]
-        json.dump(data_row, sys.stdout)
+
+def tokens(path: str) -> Iterable[Tuple[str, str, Any]]:
+    """Yields the third party, token and first parties of each token in a
+    report written by extract.py, in either JSON or JSONL format. JSONL
+    reports are read one line at a time."""
+    with open(path, 'r') as handle:
+        if path.endswith(".jsonl"):
+            for line in handle:
+                if line.strip():
+                    third_party, token, first_parties = json.loads(line)
+                    yield third_party, token, first_parties
+            return
+        data = json.load(handle)
+    for third_party, tokens in data.items():
+        for token, first_parties in tokens.items():
+            yield third_party, token, first_parties
+
+
+for third_party, token, first_parties in tokens(sys.argv[1]):
+    first_party_names = list(first_parties.keys())
+    num_first_parties = len(first_party_names)
+    data_row = [third_party, token, num_first_parties, first_party_names]
+    json.dump(data_row, sys.stdout)
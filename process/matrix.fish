@@ -0,0 +1,54 @@
+#!/usr/bin/env fish
+# Use ./matrix.fish <path to extract.py> <path to graph pickles> <path to write to>
+#
+# Compares every graph in the input directory with every other one, in a
+# single extract.py run. Writes matrix.json, and the difference and overlap
+# of every pair of graphs (the same as running extract.fish on each pair).
+
+set SCRIPT_PATH $argv[1];
+set INPUT_DIR $argv[2];
+set OUTPUT_DIR $argv[3];
+
+if not test -f "$SCRIPT_PATH";
+  echo "First arg should be path to the ./extract.py script.";
+  exit 1;
+end;
+
+if not test -d "$INPUT_DIR"
+  echo "Second arg should be path of pickled graph data.";
+  exit 1;
+end;
+
+if not test -d "$OUTPUT_DIR"
+  echo "Third arg should be directory to write results to."
+  exit 1
+end;
+
+set MATRIX_PATH "$OUTPUT_DIR/matrix.json";
+if test -f "$MATRIX_PATH";
+  echo "Skipping, $MATRIX_PATH already exists.";
+  exit 0;
+end;
+
+set GRAPH_PATHS;
+for BROWSER in chrome-ubo firefox chrome chrome-brave safari;
+  for DATASET in twitter alexa;
+    for CASE in 1 2 3 4;
+      set GRAPH_PATH "$INPUT_DIR/$BROWSER-$DATASET-$CASE.pickle";
+      if test -f "$GRAPH_PATH";
+        set GRAPH_PATHS $GRAPH_PATHS $GRAPH_PATH;
+      end;
+    end;
+  end;
+end;
+
+if test (count $GRAPH_PATHS) -lt 2;
+  echo "Need at least two graphs in $INPUT_DIR to compare.";
+  exit 1;
+end;
+
+echo "Comparing" (count $GRAPH_PATHS) "graphs";
+$SCRIPT_PATH --matrix $GRAPH_PATHS \
+             --pairs $OUTPUT_DIR \
+             --output $MATRIX_PATH;
+echo "Completed matrix";
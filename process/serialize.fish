@@ -31,10 +31,8 @@ for BROWSER in chrome-ubo firefox chrome chrome-brave safari;
       end;
       set INPUTS (ls $GRAPH_DIR/$DESC-*);
       echo $DESC;
-      if test -f $OUTPUT_PATH;
-        continue;
-      end;
-      $SCRIPT_PATH --debug --multi \
+      # --resume only reads the records not already in $OUTPUT_PATH.
+      $SCRIPT_PATH --debug --multi --resume \
         --redirect-cache /tmp/redirects.pickle \
         --input $INPUTS \
         --output $OUTPUT_PATH;
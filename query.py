@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
-import json
 import sys
 from urllib.parse import urlparse
 
+import privacykpis.codec
+
 
 PARSER = argparse.ArgumentParser("Search for records in request data.")
 PARSER.add_argument("-i", "--input",
@@ -29,7 +30,7 @@ INPUT_HANDLE = open(ARGS.input, 'r') if ARGS.input else sys.stdin
 REPORT = []
 
 for line in INPUT_HANDLE:
-    data_record = json.loads(line)
+    data_record = privacykpis.codec.loads(line, exact_integers=False)
     report_entry = {}
     site_url = data_record["url"]
     site_host = urlparse(data_record["url"]).hostname
@@ -61,4 +62,4 @@ for line in INPUT_HANDLE:
                 report_entry["headers"].append([name, value])
     REPORT.append(report_entry)
 
-json.dump(REPORT, sys.stdout)
+privacykpis.codec.dump(REPORT, sys.stdout)
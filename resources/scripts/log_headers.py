@@ -1,16 +1,23 @@
 import base64
 import datetime
-import json
 import sys
 from typing import List
 
 import requests
 
+# record.py puts the privacykpis package on mitmdump's PYTHONPATH. The
+# standalone mitmproxy builds bundle their own Python, and can't import it,
+# so fall back to the standard library there.
+try:
+    from privacykpis.codec import dump, loads
+except ImportError:
+    from json import dump, loads
+
 
 class HeaderLogger:
     def __init__(self):
         proxy_args_str = base64.b64decode(sys.argv[-1]).decode("utf-8")
-        parent_args = json.loads(proxy_args_str)
+        parent_args = loads(proxy_args_str)
 
         self.requests = []
         self.start_time = datetime.datetime.now()
@@ -26,11 +33,11 @@ class HeaderLogger:
             "requests": self.requests
         }
         if self.log_path == '-':
-            json.dump(complete_log, sys.stdout)
+            dump(complete_log, sys.stdout)
             sys.stdout.write("\n")
         else:
             with open(self.log_path, "a") as h:
-                json.dump(complete_log, h)
+                dump(complete_log, h)
                 h.write("\n")
 
     def request(self, flow):
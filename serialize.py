@@ -2,9 +2,14 @@
 import argparse
 import sys
 
-from privacykpis.argparse.types import writeable_path
-from privacykpis.argparse.types import updateable_path
+from privacykpis.argparse.types import token_location, updateable_path
+import privacykpis.filters
 import privacykpis.serialize
+import privacykpis.sketch
+import privacykpis.tokencache
+import privacykpis.tokenizing
+from privacykpis.stats import STATS
+from privacykpis.types import TokenLocation
 
 
 PARSER = argparse.ArgumentParser(description="Serialize requests as a graph.")
@@ -14,19 +19,100 @@ PARSER.add_argument("--input", nargs="*", required=True,
                     default=sys.stdin)
 PARSER.add_argument("--multi", action="store_true", default=False,
                     help="Read multiple JSON documents out of the input file.")
-PARSER.add_argument("--output", required=True, type=writeable_path,
-                    help="Path to write the serialized graph to, in pickle "
-                         "format.")
+PARSER.add_argument("--output", required=True, type=updateable_path,
+                    help="Path to write the serialized graph to. Must not "
+                         "already exist, unless --resume is passed.")
+PARSER.add_argument("--format", default="pickle",
+                    choices=["pickle", "columnar"],
+                    help="Format to write the serialized graph in. Columnar "
+                         "files are memory-mapped by extract.py, instead of "
+                         "being loaded in full.")
+PARSER.add_argument("--stream", action="store_true", default=False,
+                    help="Fold requests directly into tracking instances, "
+                         "instead of building the full request graph. Uses "
+                         "much less memory, but the result can only be "
+                         "used with extract.py.")
+PARSER.add_argument("--jobs", "-j", type=int, default=1,
+                    help="Number of processes to split the input documents "
+                         "across. The result is the same as with a single "
+                         "process.")
 PARSER.add_argument("--debug", action="store_true",
                     help="Print debugging information.")
 PARSER.add_argument("--redirect-cache", "-r", type=updateable_path,
                     help="If passed, use the passed file as a cache for "
                          "filtering out redirects.")
+PARSER.add_argument("--etld-cache", type=updateable_path,
+                    help="If passed, use the passed file as a cache of "
+                         "eTLD+1 lookups, shared across runs.")
+PARSER.add_argument("--filter-cache", type=updateable_path,
+                    help="If passed, use the passed file as a cache of "
+                         "token filter verdicts, shared across runs (and "
+                         "with extract.py).")
+PARSER.add_argument("--filter-cache-size", type=int,
+                    default=privacykpis.filters.FILTER_CACHE_SIZE,
+                    help="Maximum number of token filter verdicts to cache. "
+                         "Check the hit rate in the --stats report when "
+                         "sizing this.")
+PARSER.add_argument("--max-body-size", type=int,
+                    default=privacykpis.tokenizing.MAX_BODY_SIZE,
+                    help="Request bodies longer than this many characters "
+                         "are not tokenized. Multipart bodies of any size "
+                         "are, but not their text fields longer than this.")
+PARSER.add_argument("--token-cache", type=updateable_path,
+                    help="If passed, use the passed file as a cache of "
+                         "tokenized requests, shared across runs (and with "
+                         "serialize.py processes running at the same "
+                         "time).")
+PARSER.add_argument("--token-cache-size", type=int,
+                    default=privacykpis.tokencache.TOKEN_CACHE_SIZE_MB,
+                    help="Maximum size of the --token-cache file, in "
+                         "megabytes.")
+PARSER.add_argument("--locations", nargs="+", type=token_location,
+                    default=list(TokenLocation),
+                    help="Token locations to extract (any of COOKIE, PATH, "
+                         "QUERY_PARAM and BODY). Requests aren't parsed for "
+                         "tokens in the other locations at all, and the "
+                         "result records them as not extracted. Defaults to "
+                         "every location.")
+PARSER.add_argument("--sketch", action="store_true", default=False,
+                    help="With --stream, only keep every request a token is "
+                         "sent in once it has been sent from "
+                         "--sketch-threshold first parties. Until then, only "
+                         "the first request from each first party is kept. "
+                         "Bounds memory use on very large crawls, at the "
+                         "cost of not listing every request in reports.")
+PARSER.add_argument("--sketch-threshold", type=int,
+                    default=privacykpis.sketch.DEFAULT_THRESHOLD,
+                    help="With --sketch, number of first parties a token "
+                         "must be sent from to be kept in full (and "
+                         "reported).")
 
-ARGS = privacykpis.serialize.Args(PARSER.parse_args())
-if not ARGS.valid():
-    sys.exit(-1)
+PARSER.add_argument("--resume", action="store_true", default=False,
+                    help="If --output already exists, add only the input "
+                         "records it doesn't already hold to it, instead of "
+                         "failing. Also periodically checkpoints --output, so "
+                         "that an interrupted run can be resumed.")
+PARSER.add_argument("--checkpoint-every", type=int, default=1000,
+                    help="With --resume, number of input documents to read "
+                         "between checkpoints.")
+PARSER.add_argument("--stats", type=updateable_path,
+                    help="If passed, write the time spent in, and calls to, "
+                         "each processing stage, along with other counters, "
+                         "to this path, as JSON.")
 
-GRAPH = privacykpis.serialize.graph_from_args(ARGS, ARGS.debug)
-OUTPUT_FILE = sys.stdout if ARGS.output is None else ARGS.output
-privacykpis.serialize.write(GRAPH, OUTPUT_FILE)
+if __name__ == "__main__":
+    ARGS = privacykpis.serialize.Args(PARSER.parse_args())
+    if not ARGS.valid():
+        sys.exit(-1)
+
+    if ARGS.resume and privacykpis.serialize.is_up_to_date(ARGS):
+        if ARGS.debug:
+            print(f"{ARGS.output} already holds every input, nothing to do.")
+        sys.exit(0)
+
+    GRAPH = privacykpis.serialize.graph_from_args(ARGS, ARGS.debug)
+    OUTPUT_FILE = sys.stdout if ARGS.output is None else ARGS.output
+    privacykpis.serialize.write(GRAPH, OUTPUT_FILE, ARGS.format)
+    if ARGS.resume:
+        privacykpis.serialize.write_manifest(GRAPH, ARGS.output)
+    STATS.write(ARGS.stats_path, "serialize")